@@ -1,13 +1,17 @@
 #Archivo para realizar visualizaciones con Dash
 
+import contextlib
 import dash
+import flask
 from dash import dcc
 from dash import html
 import plotly.express as px
 import plotly.graph_objects as go
 import pandas as pd
-import numpy as np # Necesario para la función get_df_fuga_base (si no está ya importado en queries.py)
 import os # Solo si necesitas configurar el entorno de conexión, aunque no se usa directamente en el código de Dash
+import threading
+import time
+from sqlalchemy.exc import SQLAlchemyError
 
 DURACION_DIURNA_SEMESTRES = 8 # 4 años
 DURACION_VESPERTINA_SEMESTRES = 9 # 4.5 años
@@ -15,164 +19,266 @@ DURACION_VESPERTINA_SEMESTRES = 9 # 4.5 años
 # Asumimos que todas las funciones están en queries.py
 from queries import (
     kpi1_permanencia_ecas, 
-    get_df_fuga_base, 
-    kpi2_institucion_destino,
-    kpi3_carrera_destino,
-    kpi4_area_destino,
-    kpi5_titulacion_fuga_estimada
+    kpis_destino_fuga,
+    kpi5_titulacion_fuga_estimada,
+    kpi6_supervivencia,
+    kpi7_trayectoria_fugados,
+    COD_INST_ECAS,
+    MOTOR_FUGA
 )
+from matriz_transiciones import get_matriz_transiciones
 # Asumimos que get_db_engine viene de connector.py
-from connector_db import get_db_engine
-
-app = dash.Dash(__name__, title="ECAS Fuga y Permanencia")
-engine = get_db_engine() # Establecer conexión a la DB
-
-# Obtener la lista de años disponibles (para el Dropdown) y la tasa promedio para KPI 1
-try:
-    df_permanencia_full, tasa_general_permanencia = kpi1_permanencia_ecas(engine)
-    years_available = sorted(df_permanencia_full['Año'].unique())
-except Exception as e:
-    print(f"Error al cargar datos iniciales de permanencia: {e}")
-    df_permanencia_full = pd.DataFrame()
-    tasa_general_permanencia = 0
-    years_available = []
-
-# Opciones para el Dropdown
-year_options = [{'label': 'Total General (Promedio)', 'value': 'ALL'}]
-if years_available:
-    year_options.extend([{'label': str(y), 'value': y} for y in years_available])
-
-app.layout = html.Div(style={'backgroundColor': '#f8f9fa', 'padding': '20px'}, children=[
-    html.H1("📈 Análisis de Permanencia y Fuga de Estudiantes ECAS", style={'textAlign': 'center', 'color': '#007bff', 'marginBottom': '20px'}),
-    
-    html.Div(style={'width': '30%', 'margin': '0 auto 30px auto'}, children=[
-        html.Label("Seleccionar Cohorte de Fuga (Año N -> N+1):", style={'fontWeight': 'bold', 'color': '#495057'}),
-        dcc.Dropdown(
-            id='year-selector',
-            options=year_options,
-            value='ALL', # Valor inicial: Total General
-            clearable=False,
-            style={'borderRadius': '5px'}
-        )
-    ]),
-    
-    html.Hr(style={'borderColor': '#ced4da'}),
+from connector_db import get_db_engine, medir_consultas, estadisticas_conexion, en_paralelo
+from instrumentacion import medir_etapa, traza, trazas_recientes, resumen_etapas, metricas_prometheus
+from cache_kpis import version_datos
+from snapshot_kpis import CARPETA_SNAPSHOT, leer_manifest, leer_cohorte, version_snapshot
+from exportar_kpis import (CONJUNTOS_EXPORTACION, CONJUNTOS_SOLO_ECAS, FORMATOS_EXPORTACION, lotes_conjunto, lotes_snapshot, csv_por_lotes,
+                           parquet_por_lotes, tomar_turno_exportacion, liberar_turno_exportacion)
 
-    # Contenedor para la Gráfica de Permanencia (KPI 1)
-    html.Div(id='kpi1-output', style={'padding': '20px', 'backgroundColor': 'white', 'borderRadius': '8px', 'boxShadow': '0 2px 4px rgba(0,0,0,.1)'}),
-    
-    html.Hr(style={'borderColor': '#ced4da', 'marginTop': '30px'}),
-
-    # Contenedores para Gráficos de Fuga (KPI 2, 3, 4 y 5)
-    html.Div(style={'display': 'flex', 'flexWrap': 'wrap', 'justifyContent': 'space-around', 'gap': '20px'}, children=[
-        html.Div(id='kpi2-output', style={'width': '48%', 'minWidth': '300px', 'backgroundColor': 'white', 'padding': '15px', 'borderRadius': '8px', 'boxShadow': '0 2px 4px rgba(0,0,0,.1)'}),
-        html.Div(id='kpi3-output', style={'width': '48%', 'minWidth': '300px', 'backgroundColor': 'white', 'padding': '15px', 'borderRadius': '8px', 'boxShadow': '0 2px 4px rgba(0,0,0,.1)'}),
-        html.Div(id='kpi4-output', style={'width': '48%', 'minWidth': '300px', 'backgroundColor': 'white', 'padding': '15px', 'borderRadius': '8px', 'boxShadow': '0 2px 4px rgba(0,0,0,.1)'}),
-        html.Div(id='kpi5-output', style={'width': '48%', 'minWidth': '300px', 'backgroundColor': 'white', 'padding': '15px', 'borderRadius': '8px', 'boxShadow': '0 2px 4px rgba(0,0,0,.1)'}),
-    ])
-])
+# KPI 5 en segundo plano (ECAS_KPI5_SEGUNDO_PLANO=1). Por defecto corre en el proceso del dashboard, que ya tiene
+# el engine, el caché por cohorte (lo llena el precálculo) y, con ECAS_MOTOR_FUGA=memoria, las trayectorias: el
+# DiskcacheManager lanza cada job en un proceso nuevo, que tendría que abrir su propia conexión y recalcular.
+# Sirve cuando el caché está frío y la consulta es lenta; sus resultados se guardan en diskcache por versión de datos.
+# Con el motor en memoria no se usa: cada job volvería a cargar la matrícula y las trayectorias en su proceso.
+KPI5_SEGUNDO_PLANO = os.environ.get('ECAS_KPI5_SEGUNDO_PLANO', '0') == '1'
+if KPI5_SEGUNDO_PLANO and MOTOR_FUGA == 'memoria':
+    print("Advertencia: ECAS_KPI5_SEGUNDO_PLANO=1 no aplica con ECAS_MOTOR_FUGA=memoria; el KPI 5 corre en el proceso del dashboard.")
+    KPI5_SEGUNDO_PLANO = False
+background_callback_manager = None
+if KPI5_SEGUNDO_PLANO:
+    try:
+        import diskcache
+        background_callback_manager = dash.DiskcacheManager(diskcache.Cache(os.path.join('cache', 'callbacks')),
+                                                            cache_by=[version_datos])
+    except ImportError:
+        print("Advertencia: ECAS_KPI5_SEGUNDO_PLANO=1 requiere el paquete diskcache; el KPI 5 corre en el proceso del dashboard.")
+
+app = dash.Dash(__name__, title="ECAS Fuga y Permanencia", background_callback_manager=background_callback_manager)
+
+# Panel de depuración con las etapas de cada callback (SQL, pandas, gráficos). Se activa con ECAS_DEPURACION=1.
+MODO_DEPURACION = os.environ.get('ECAS_DEPURACION', '0') == '1'
+TRAZAS_PANEL = 10
+
+# Modo snapshot (ECAS_MODO_SNAPSHOT=1): los callbacks se responden desde los archivos de snapshot_kpis.py,
+# sin conexión a la base de datos. El snapshot se genera con 'python snapshot_kpis.py'.
+MODO_SNAPSHOT = os.environ.get('ECAS_MODO_SNAPSHOT', '0') == '1'
 
 # ----------------------------------------------------------------------
-# 3. DEFINICIÓN DEL CALLBACK (Manejo de la Interacción)
+# 1. INICIALIZACIÓN DIFERIDA Y PRECÁLCULO DE COHORTES
 # ----------------------------------------------------------------------
+# La conexión y la serie del KPI 1 se cargan en la primera petición (no al importar el módulo),
+# y luego un hilo en segundo plano precalcula todas las cohortes para dejarlas en el caché.
 
-@app.callback(
-    [
-        dash.Output('kpi1-output', 'children'),
-        dash.Output('kpi2-output', 'children'),
-        dash.Output('kpi3-output', 'children'),
-        dash.Output('kpi4-output', 'children'),
-        dash.Output('kpi5-output', 'children'),
-    ],
-    [dash.Input('year-selector', 'value')]
-)
-def update_dashboard(selected_year):
-    
-    # 1. Ajustar el parámetro para las queries
+_estado = {
+    'engine': None,
+    'df_permanencia_full': pd.DataFrame(),
+    'tasa_general_permanencia': 0,
+    'years_available': [],
+    'cohortes_precalculadas': 0,
+    'cohortes_totales': 0,
+    'precalculo_terminado': False,
+    'snapshot': None,   # Manifest del snapshot en MODO_SNAPSHOT
+    'instituciones': {COD_INST_ECAS: 'ECAS'},   # Instituciones de origen de la matriz de transiciones (cod_inst -> nombre)
+}
+_lock_estado = threading.Lock()
+_cohortes_consultadas = set()
+
+def get_estado():
+    """
+    Inicializa (una sola vez por proceso) el engine y la serie del KPI 1, y lanza el precálculo.
+    El engine solo queda registrado si la serie del KPI 1 se cargó: si algo falla, la siguiente petición reintenta.
+    En MODO_SNAPSHOT el manifest se vuelve a leer cuando se publica una versión nueva del snapshot.
+    """
+    with _lock_estado:
+        if MODO_SNAPSHOT:
+            if _estado['snapshot'] is not None and _estado['snapshot']['version_snapshot'] == version_snapshot():
+                return _estado
+            return cargar_estado_snapshot()
+        if _estado['engine'] is not None:
+            return _estado
+
+        inicio = time.perf_counter()
+        engine = get_db_engine() # Establecer conexión a la DB
+        if engine is None:
+            return _estado
+
+        # Obtener la lista de años disponibles (para el Dropdown) y la tasa promedio para KPI 1
+        try:
+            df_permanencia_full, tasa_general_permanencia = kpi1_permanencia_ecas(engine)
+            _estado['df_permanencia_full'] = df_permanencia_full
+            _estado['tasa_general_permanencia'] = tasa_general_permanencia
+            _estado['years_available'] = sorted(df_permanencia_full['Año'].unique())
+        except Exception as e:
+            print(f"Error al cargar datos iniciales de permanencia: {e}")
+            return _estado
+
+        # Instituciones de origen para el Dropdown (la matriz queda cargada para las búsquedas de los callbacks)
+        try:
+            df_instituciones = get_matriz_transiciones(engine)['instituciones']
+            _estado['instituciones'] = {COD_INST_ECAS: 'ECAS', **{
+                int(cod): nombre for cod, nombre in zip(df_instituciones['COD_INST_ORIGEN'], df_instituciones['INST_ORIGEN'])
+                if int(cod) != COD_INST_ECAS
+            }}
+        except (RuntimeError, SQLAlchemyError) as e:
+            print(f"Advertencia: sin la matriz de transiciones el selector de institución solo ofrece ECAS. {e}")
+
+        _estado['engine'] = engine
+        _estado['cohortes_totales'] = len(_estado['years_available']) + 1
+        print(f"Inicialización del dashboard completada en {time.perf_counter() - inicio:.2f} s.")
+
+        threading.Thread(target=precalcular_cohortes, daemon=True).start()
+        return _estado
+
+def cargar_estado_snapshot():
+    """Carga el estado desde el manifest del snapshot (en lugar de la DB); no hay precálculo que hacer."""
+    try:
+        manifest = leer_manifest()
+    except (OSError, ValueError) as e:
+        print(f"Error al leer el snapshot en '{CARPETA_SNAPSHOT}': {e}")
+        return _estado
+
+    # Sin registro local de cargas ('0') no hay con qué comparar: es el caso de un despliegue sin DB
+    if version_datos() not in ('0', manifest['version_datos']):
+        print(f"Advertencia: el snapshot del {manifest['fecha']} no corresponde a la última carga de datos registrada.")
+    _estado['df_permanencia_full'] = manifest['df_permanencia_full']
+    _estado['tasa_general_permanencia'] = manifest['tasa_general_permanencia']
+    _estado['years_available'] = manifest['years_available']
+    _estado['cohortes_totales'] = _estado['cohortes_precalculadas'] = len(manifest['years_available']) + 1
+    _estado['precalculo_terminado'] = True
+    _estado['snapshot'] = manifest
+    return _estado
+
+def precalcular_cohorte(anio_n):
+    """Calcula la fuga y los KPI 2 a 7 de una cohorte (quedan en el caché). Devuelve la medición de sus consultas."""
+    engine = _estado['engine']
+    with medir_consultas('Precálculo') as medicion:
+        kpis_destino_fuga(engine, anio_n=anio_n)
+        # Sin df_fuga: los fugados van a la historia como subconsulta (una sentencia fija) y 'ALL' también queda en caché
+        kpi5_titulacion_fuga_estimada(engine, anio_n=anio_n)
+        kpi6_supervivencia(engine, anio_n=anio_n)
+        kpi7_trayectoria_fugados(engine, anio_n=anio_n)
+    return medicion
+
+def precalcular_cohortes():
+    """
+    Precalcula 'ALL' y cada año para que queden en el caché. Las cohortes se reparten en WORKERS_CONSULTAS hilos
+    (ECAS_WORKERS_CONSULTAS), que comparten el pool del engine con los callbacks.
+    """
+    inicio_total = time.perf_counter()
+
+    for anio_n, medicion in en_paralelo(precalcular_cohorte, [None] + list(_estado['years_available'])):
+        _estado['cohortes_precalculadas'] += 1
+        if isinstance(medicion, Exception):
+            print(f"Error al precalcular la cohorte {anio_n or 'ALL'}: {medicion}")
+        else:
+            print(f"Cohorte {anio_n or 'ALL'} precalculada en {medicion['segundos_total']:.2f} s (SQL {medicion['segundos_sql']:.2f} s).")
+
+    _estado['precalculo_terminado'] = True
+    print(f"Precálculo de {_estado['cohortes_totales']} cohortes terminado en {time.perf_counter() - inicio_total:.2f} s.")
+
+# ----------------------------------------------------------------------
+# 2. CONSTRUCCIÓN DE GRÁFICOS
+# ----------------------------------------------------------------------
+
+def parametros_cohorte(selected_year, cod_inst=COD_INST_ECAS):
+    """Traduce el valor del Dropdown al parámetro anio_n de las queries y al sufijo de los títulos."""
+    # Para otra institución de origen, su nombre encabeza el sufijo
+    prefijo = '' if cod_inst == COD_INST_ECAS else f"{_estado['instituciones'].get(cod_inst, cod_inst)}, "
     if selected_year == 'ALL':
         # Cuando es 'ALL', la query debe procesar el total (anio_n=None)
-        anio_n_param = None
-        title_suffix = "Total General"
-    else:
-        # Cuando es un año, la query debe filtrar por esa cohorte
-        anio_n_param = selected_year
-        title_suffix = f"Cohorte {selected_year} → {selected_year + 1}"
-    
-    # 2. Lógica y Gráficos para KPI 1 (Permanencia)
-    
+        return None, f"{prefijo}Total General"
+    # Cuando es un año, la query debe filtrar por esa cohorte
+    return selected_year, f"{prefijo}Cohorte {selected_year} → {selected_year + 1}"
+
+def contenido_sin_datos(title_suffix):
+    """Mensaje de "Datos no disponibles" para los gráficos de fuga."""
+    return html.Div(
+        [html.H5("Datos no disponibles", style={'textAlign': 'center'}),
+         html.P(f"No hay datos de fuga para la {title_suffix} o la cohorte no tiene actividad posterior.", style={'textAlign': 'center'})],
+        style={'paddingTop': '50px', 'paddingBottom': '50px'}
+    )
+
+def contenido_sin_conexion():
+    """Mensaje para los gráficos cuando no hay conexión a la base de datos (ni snapshot)."""
+    return html.Div(
+        [html.H5("Sin conexión", style={'textAlign': 'center'}),
+         html.P("No hay conexión a la base de datos; se reintentará en la próxima consulta.", style={'textAlign': 'center'})],
+        style={'paddingTop': '50px', 'paddingBottom': '50px'}
+    )
+
+def contenido_snapshot(selected_year, kpi):
+    """Gráfico de un KPI de fuga (kpi2 a kpi5) tal como quedó guardado en el snapshot de la cohorte."""
+    datos = leer_cohorte(selected_year)
+    figura = datos.get(kpi, {}).get('figura')   # Un snapshot anterior a un KPI no lo incluye
+    return contenido_sin_datos(datos['title_suffix']) if figura is None else dcc.Graph(figure=figura)
+
+@medir_etapa('plotly.kpi1')
+def build_fig_kpi1(df_permanencia_full, tasa_general_permanencia, nombre_inst='ECAS'):
+    """Gráfico base del KPI 1 (serie completa + promedio). El año seleccionado se agrega con Patch."""
+    if df_permanencia_full.empty:
+        return go.Figure().update_layout(title=f'KPI 1: Tasa de Permanencia Anual en {nombre_inst}', template="plotly_white")
+
     # KPI 1 siempre usa la serie completa para mostrar el contexto temporal
     fig1 = px.line(df_permanencia_full, x='Año', y='Tasa_Permanencia_ECAS', 
-                   title=f'KPI 1: Tasa de Permanencia Anual en ECAS', markers=True,
+                   title=f'KPI 1: Tasa de Permanencia Anual en {nombre_inst}', markers=True,
                    template="plotly_white", line_shape='spline')
     
     # Añadir línea de promedio general
     fig1.add_hline(y=tasa_general_permanencia, line_dash="dash", line_color="red",
                    annotation_text=f"Promedio Total: {tasa_general_permanencia}%", 
                    annotation_position="top right")
+    return fig1
+
+@medir_etapa('plotly.kpi1_decoraciones')
+def decoraciones_kpi1(selected_year, df_permanencia_full, tasa_general_permanencia):
+    """Devuelve (shapes, annotations) del KPI 1: el promedio general y, si corresponde, el año resaltado."""
+    fig = go.Figure()
+    fig.add_hline(y=tasa_general_permanencia, line_dash="dash", line_color="red",
+                  annotation_text=f"Promedio Total: {tasa_general_permanencia}%", 
+                  annotation_position="top right")
     
     # Resaltar el año seleccionado
-    if selected_year != 'ALL':
-         fig1.add_vline(x=selected_year, line_dash="dot", line_color="blue", opacity=0.8)
-         # Mostrar la tasa específica del año seleccionado
-         tasa_anual = df_permanencia_full[df_permanencia_full['Año'] == selected_year]['Tasa_Permanencia_ECAS'].iloc[0]
-         fig1.add_annotation(x=selected_year, y=tasa_anual, text=f"{tasa_anual}%", showarrow=True, arrowhead=1)
+    df_anio = df_permanencia_full[df_permanencia_full['Año'] == selected_year] if not df_permanencia_full.empty else df_permanencia_full
+    if selected_year != 'ALL' and not df_anio.empty:
+        fig.add_vline(x=selected_year, line_dash="dot", line_color="blue", opacity=0.8)
+        # Mostrar la tasa específica del año seleccionado
+        tasa_anual = df_anio['Tasa_Permanencia_ECAS'].iloc[0]
+        fig.add_annotation(x=selected_year, y=tasa_anual, text=f"{tasa_anual}%", showarrow=True, arrowhead=1)
 
-    kpi1_chart = dcc.Graph(figure=fig1)
+    shapes = [shape.to_plotly_json() for shape in fig.layout.shapes]
+    annotations = [annotation.to_plotly_json() for annotation in fig.layout.annotations]
+    return shapes, annotations
 
-    
-    # 3. Lógica y Gráficos para KPI 2, 3, 4 y 5 (Fuga y Destino)
-
-    # Obtener el DataFrame base de fugados (una sola llamada optimizada)
-    df_fuga = get_df_fuga_base(engine, anio_n=anio_n_param)
-    
-    # Si no hay fugados, mostrar mensajes de "Datos no disponibles"
-    if df_fuga.empty:
-        # Mensaje para los gráficos de la segunda fila
-        error_content = html.Div(
-            [html.H5("Datos no disponibles", style={'textAlign': 'center'}),
-             html.P(f"No hay datos de fuga para la {title_suffix} o la cohorte no tiene actividad posterior.", style={'textAlign': 'center'})],
-            style={'paddingTop': '50px', 'paddingBottom': '50px'}
-        )
-        empty_graph_container = dcc.Graph(figure=go.Figure())
-        
-        # Retornar los 5 Outputs (KPI 1 ya está calculado)
-        return kpi1_chart, error_content, error_content, error_content, error_content
-
-    
-    # --- KPI 2: Institución de Destino ---
-    df_kpi2 = kpi2_institucion_destino(df_fuga)
+@medir_etapa('plotly.kpi2')
+def build_chart_kpi2(df_kpi2, title_suffix):
     df_kpi2_top = df_kpi2.head(10).sort_values(by='Porcentaje', ascending=True)
     fig2 = px.bar(df_kpi2_top, x='Porcentaje', y='INST_DESTINO', orientation='h',
                   title=f'KPI 2: Top 10 Instituciones de Destino ({title_suffix})',
                   text='Porcentaje', template="plotly_white")
     fig2.update_traces(texttemplate='%{text:.2f}%', textposition='outside')
     fig2.update_layout(uniformtext_minsize=8, uniformtext_mode='hide')
-    kpi2_chart = dcc.Graph(figure=fig2)
-
+    return dcc.Graph(figure=fig2)
 
-    # --- KPI 3: Carrera de Destino ---
-    df_kpi3 = kpi3_carrera_destino(df_fuga)
+@medir_etapa('plotly.kpi3')
+def build_chart_kpi3(df_kpi3, title_suffix):
     df_kpi3_top = df_kpi3.head(10).sort_values(by='Porcentaje', ascending=True)
     fig3 = px.bar(df_kpi3_top, x='Porcentaje', y='CARRERA_DESTINO', orientation='h',
                   title=f'KPI 3: Top 10 Carreras de Destino ({title_suffix})',
                   text='Porcentaje', template="plotly_white")
     fig3.update_traces(texttemplate='%{text:.2f}%', textposition='outside')
     fig3.update_layout(uniformtext_minsize=8, uniformtext_mode='hide')
-    kpi3_chart = dcc.Graph(figure=fig3)
+    return dcc.Graph(figure=fig3)
 
-
-    # --- KPI 4: Cambio de Área ---
-    df_kpi4 = kpi4_area_destino(df_fuga, solo_cambio=False) # Analiza la distribución de ÁREAS de destino (no solo Sí/No)
+@medir_etapa('plotly.kpi4')
+def build_chart_kpi4(df_kpi4, title_suffix):
     fig4 = px.pie(df_kpi4, names='AREA_DESTINO', values='Total_Fuga',
                   title=f'KPI 4: Distribución de Fuga por Área de Destino ({title_suffix})',
                   template="plotly_white")
     fig4.update_traces(textposition='inside', textinfo='percent+label')
-    kpi4_chart = dcc.Graph(figure=fig4)
-    
-    
-    # --- KPI 5: Titulación Estimada ---
-    df_kpi5, total_estimado = kpi5_titulacion_fuga_estimada(engine, anio_n=anio_n_param)
-    
+    return dcc.Graph(figure=fig4)
+
+@medir_etapa('plotly.kpi5')
+def build_chart_kpi5(df_kpi5, total_estimado, title_suffix):
     if df_kpi5.empty:
         fig5 = go.Figure().update_layout(title=f'KPI 5: Titulación Estimada ({title_suffix})', annotations=[dict(text="No hay titulados estimados en esta cohorte.", showarrow=False)])
     else:
@@ -183,12 +289,433 @@ def update_dashboard(selected_year):
                       template="plotly_white")
         fig5.update_traces(texttemplate='%{x}', textposition='outside')
         fig5.update_layout(uniformtext_minsize=8, uniformtext_mode='hide')
+    return dcc.Graph(figure=fig5)
+
+@medir_etapa('plotly.kpi6')
+def build_chart_kpi6(df_kpi6, title_suffix):
+    fig6 = go.Figure([
+        go.Scatter(x=df_kpi6['Años'], y=df_kpi6['Tasa_Institucion'], mode='lines+markers', name='En la institución'),
+        go.Scatter(x=df_kpi6['Años'], y=df_kpi6['Tasa_Sistema'], mode='lines+markers', name='En el sistema'),
+    ])
+    fig6.update_layout(title=f'KPI 6: Supervivencia a k Años ({title_suffix})', xaxis_title='Años después del año N',
+                       yaxis_title='% de la cohorte', template="plotly_white")
+    return dcc.Graph(figure=fig6)
+
+@medir_etapa('plotly.kpi7')
+def build_chart_kpi7(df_kpi7, title_suffix):
+    fig7 = go.Figure([
+        go.Scatter(x=df_kpi7['Años'], y=df_kpi7['Tasa_Retorno'], mode='lines+markers', name='Volvió a la institución'),
+        go.Scatter(x=df_kpi7['Años'], y=df_kpi7['Tasa_Titulacion'], mode='lines+markers', name='Titulado estimado'),
+    ])
+    fig7.update_layout(title=f'KPI 7: Trayectoria de los Fugados ({title_suffix})', xaxis_title='Años después de la fuga',
+                       yaxis_title='% acumulado de los fugados', template="plotly_white")
+    return dcc.Graph(figure=fig7)
+
+# ----------------------------------------------------------------------
+# 3. LAYOUT (se construye en cada carga de página)
+# ----------------------------------------------------------------------
+
+def panel_depuracion():
+    """Componentes del panel de depuración (ninguno si MODO_DEPURACION está desactivado)."""
+    if not MODO_DEPURACION:
+        return []
+    return [
+        html.Hr(style={'borderColor': '#ced4da', 'marginTop': '30px'}),
+        html.Details(style={'backgroundColor': 'white', 'padding': '15px', 'borderRadius': '8px'}, children=[
+            html.Summary("🛠️ Depuración: etapas de los últimos callbacks", style={'fontWeight': 'bold', 'color': '#495057'}),
+            html.A("Métricas del proceso (JSON)", href='/metricas', target='_blank'),
+            html.Div(id='depuracion-contenido'),
+        ]),
+        dcc.Interval(id='depuracion-intervalo', interval=5000),
+    ]
+
+def serve_layout():
+    # Dash llama a esta función al asignar app.layout (fuera de una petición) solo para validar
+    # los ids del layout: en ese caso no se inicializa la conexión.
+    estado = get_estado() if flask.has_request_context() else _estado
+
+    # Opciones para el Dropdown
+    year_options = [{'label': 'Total General (Promedio)', 'value': 'ALL'}]
+    if estado['years_available']:
+        year_options.extend([{'label': str(y), 'value': y} for y in estado['years_available']])
+    inst_options = [{'label': nombre, 'value': cod} for cod, nombre in estado['instituciones'].items()]
+
+    return html.Div(style={'backgroundColor': '#f8f9fa', 'padding': '20px'}, children=[
+        html.H1("📈 Análisis de Permanencia y Fuga de Estudiantes ECAS", style={'textAlign': 'center', 'color': '#007bff', 'marginBottom': '20px'}),
+    
+        html.Div(style={'width': '30%', 'margin': '0 auto 15px auto'}, children=[
+            html.Label("Institución de origen:", style={'fontWeight': 'bold', 'color': '#495057'}),
+            dcc.Dropdown(
+                id='inst-selector',
+                options=inst_options,
+                value=COD_INST_ECAS,
+                clearable=False,
+                style={'borderRadius': '5px'}
+            )
+        ]),
+
+        html.Div(style={'width': '30%', 'margin': '0 auto 30px auto'}, children=[
+            html.Label("Seleccionar Cohorte de Fuga (Año N -> N+1):", style={'fontWeight': 'bold', 'color': '#495057'}),
+            dcc.Dropdown(
+                id='year-selector',
+                options=year_options,
+                value='ALL', # Valor inicial: Total General
+                clearable=False,
+                style={'borderRadius': '5px'}
+            )
+        ]),
+
+        # Enlaces de descarga de los datos de la cohorte seleccionada (ver /exportar)
+        html.Div(id='descargas', style={'textAlign': 'center', 'fontSize': '14px', 'marginBottom': '10px'}),
+
+        # Estado de la carga: se consulta periódicamente hasta que termina el precálculo de cohortes
+        html.Div(id='estado-carga', style={'textAlign': 'center', 'color': '#6c757d', 'marginBottom': '10px'}),
+        dcc.Interval(id='estado-intervalo', interval=2000, disabled=estado['precalculo_terminado']),
+    
+        html.Hr(style={'borderColor': '#ced4da'}),
+
+        # Contenedor para la Gráfica de Permanencia (KPI 1)
+        html.Div(id='kpi1-output', style={'padding': '20px', 'backgroundColor': 'white', 'borderRadius': '8px', 'boxShadow': '0 2px 4px rgba(0,0,0,.1)'}, children=[
+            dcc.Graph(id='kpi1-graph', figure=estado['snapshot']['kpi1']['figura'] if estado['snapshot'] else
+                      build_fig_kpi1(estado['df_permanencia_full'], estado['tasa_general_permanencia']))
+        ]),
+    
+        html.Hr(style={'borderColor': '#ced4da', 'marginTop': '30px'}),
+
+        # Contenedores para Gráficos de Fuga (KPI 2 a 5) y de trayectorias (KPI 6 y 7)
+        html.Div(style={'display': 'flex', 'flexWrap': 'wrap', 'justifyContent': 'space-around', 'gap': '20px'}, children=[
+            html.Div(id='kpi2-output', style={'width': '48%', 'minWidth': '300px', 'backgroundColor': 'white', 'padding': '15px', 'borderRadius': '8px', 'boxShadow': '0 2px 4px rgba(0,0,0,.1)'}),
+            html.Div(id='kpi3-output', style={'width': '48%', 'minWidth': '300px', 'backgroundColor': 'white', 'padding': '15px', 'borderRadius': '8px', 'boxShadow': '0 2px 4px rgba(0,0,0,.1)'}),
+            html.Div(id='kpi4-output', style={'width': '48%', 'minWidth': '300px', 'backgroundColor': 'white', 'padding': '15px', 'borderRadius': '8px', 'boxShadow': '0 2px 4px rgba(0,0,0,.1)'}),
+            html.Div(id='kpi5-output', style={'width': '48%', 'minWidth': '300px', 'backgroundColor': 'white', 'padding': '15px', 'borderRadius': '8px', 'boxShadow': '0 2px 4px rgba(0,0,0,.1)'}),
+            html.Div(id='kpi6-output', style={'width': '48%', 'minWidth': '300px', 'backgroundColor': 'white', 'padding': '15px', 'borderRadius': '8px', 'boxShadow': '0 2px 4px rgba(0,0,0,.1)'}),
+            html.Div(id='kpi7-output', style={'width': '48%', 'minWidth': '300px', 'backgroundColor': 'white', 'padding': '15px', 'borderRadius': '8px', 'boxShadow': '0 2px 4px rgba(0,0,0,.1)'}),
+        ]),
+
+        *panel_depuracion(),
+    ])
+
+app.layout = serve_layout
+
+@app.callback(
+    [dash.Output('estado-carga', 'children'), dash.Output('estado-intervalo', 'disabled')],
+    [dash.Input('estado-intervalo', 'n_intervals')]
+)
+def update_estado_carga(n_intervals):
+    if _estado['snapshot'] is not None:
+        return f"📦 Datos del snapshot generado el {_estado['snapshot']['fecha']}.", True
+    if _estado['engine'] is None:
+        return "⚠️ Sin conexión a la base de datos.", False
+    if _estado['precalculo_terminado']:
+        return "✅ Datos listos.", True
+    return f"⏳ Precalculando cohortes ({_estado['cohortes_precalculadas']}/{_estado['cohortes_totales']})...", False
+
+# ----------------------------------------------------------------------
+# 4. DEFINICIÓN DE LOS CALLBACKS (uno por KPI)
+# ----------------------------------------------------------------------
+# Cada KPI se actualiza por separado: los KPI 2 a 4 comparten la fuga base cacheada por cohorte
+# (kpis_destino_fuga), el KPI 1 solo mueve el marcador del año con Patch y el KPI 5, que consulta
+# la historia de los fugados, corre en segundo plano solo si se activa KPI5_SEGUNDO_PLANO.
+# Los KPI 6 y 7 (varios años por estudiante) se responden con el motor de trayectorias del proceso (trayectorias.py).
+
+def registrar_latencia(nombre_kpi, selected_year, medicion):
+    """
+    Informa el tiempo del callback, con el tiempo en SQL y la espera por una conexión del pool
+    (medicion viene de medir_consultas). La primera consulta de cada cohorte en el proceso se marca aparte.
+    """
+    detalle = (f"{medicion['segundos_total']:.2f} s (SQL {medicion['segundos_sql']:.2f} s en {medicion['consultas']} consultas, "
+               f"espera de conexión {medicion['segundos_espera_pool']:.3f} s).")
+    if (nombre_kpi, selected_year) not in _cohortes_consultadas:
+        _cohortes_consultadas.add((nombre_kpi, selected_year))
+        print(f"{nombre_kpi}: primera consulta de la cohorte {selected_year}: {detalle}")
+    else:
+        print(f"{nombre_kpi}: consulta de la cohorte {selected_year}: {detalle}")
+
+@contextlib.contextmanager
+def medir_callback(nombre_kpi, selected_year):
+    """Traza del callback (etapas) y medición de sus consultas y esperas del pool; al salir se informa la latencia."""
+    with traza(nombre_kpi, cohorte=selected_year) as registro, medir_consultas(nombre_kpi) as medicion:
+        yield registro
+    registro['consultas_sql'] = medicion['consultas']
+    registro['ms_espera_pool'] = round(1000 * medicion['segundos_espera_pool'], 2)
+    registrar_latencia(nombre_kpi, selected_year, medicion)
+
+@app.callback(
+    dash.Output('kpi1-graph', 'figure'),
+    [dash.Input('year-selector', 'value'), dash.Input('inst-selector', 'value')]
+)
+def update_kpi1(selected_year, cod_inst):
+    with medir_callback('KPI 1', selected_year):
+        estado = get_estado()
+        if estado['engine'] is None and estado['snapshot'] is None:
+            return go.Figure().update_layout(title='KPI 1: Tasa de Permanencia Anual', template="plotly_white",
+                                             annotations=[dict(text="Sin conexión a la base de datos.", showarrow=False)])
+        
+        if cod_inst == COD_INST_ECAS or estado['engine'] is None:
+            df_permanencia_full, tasa_general_permanencia = estado['df_permanencia_full'], estado['tasa_general_permanencia']
+        else:
+            df_permanencia_full, tasa_general_permanencia = kpi1_permanencia_ecas(estado['engine'], cod_inst=cod_inst)
+        shapes, annotations = decoraciones_kpi1(selected_year, df_permanencia_full, tasa_general_permanencia)
+        
+        # Al cambiar de institución cambia la serie completa; al cambiar de año solo se mueve el marcador
+        if dash.ctx.triggered_id == 'inst-selector':
+            fig1 = build_fig_kpi1(df_permanencia_full, tasa_general_permanencia, estado['instituciones'].get(cod_inst, cod_inst))
+            return fig1.update_layout(shapes=shapes, annotations=annotations)
         
-    kpi5_chart = dcc.Graph(figure=fig5)
+        fig1_patch = dash.Patch()
+        fig1_patch['layout']['shapes'] = shapes
+        fig1_patch['layout']['annotations'] = annotations
+    
+    return fig1_patch
+
+def resultados_destino(selected_year, cod_inst=COD_INST_ECAS):
+    """
+    Fuga base y KPI 2 a 4 de la cohorte (cacheados por cohorte y compartidos por sus callbacks).
+    Para otra institución de origen los KPIs salen de la matriz de transiciones (una búsqueda, sin leer la matrícula).
+    """
+    estado = get_estado()
+    anio_n_param, title_suffix = parametros_cohorte(selected_year, cod_inst)
+    if cod_inst != COD_INST_ECAS and anio_n_param is None:
+        # La matriz guarda conteos por cohorte: el total de otra institución es la suma de sus cohortes
+        title_suffix += " (suma de cohortes)"
+    df_fuga, df_kpi2, df_kpi3, df_kpi4 = kpis_destino_fuga(estado['engine'], anio_n=anio_n_param, cod_inst=cod_inst)
+    return df_fuga, df_kpi2, df_kpi3, df_kpi4, title_suffix
+
+@app.callback(
+    dash.Output('kpi2-output', 'children'),
+    [dash.Input('year-selector', 'value'), dash.Input('inst-selector', 'value')]
+)
+def update_kpi2(selected_year, cod_inst):
+    with medir_callback('KPI 2', selected_year):
+        if MODO_SNAPSHOT:
+            return contenido_snapshot(selected_year, 'kpi2')
+        if get_estado()['engine'] is None:
+            return contenido_sin_conexion()
+        df_fuga, df_kpi2, _, _, title_suffix = resultados_destino(selected_year, cod_inst)
+        
+        # Si no hay fugados, mostrar mensajes de "Datos no disponibles"
+        contenido = contenido_sin_datos(title_suffix) if df_fuga.empty else build_chart_kpi2(df_kpi2, title_suffix)
+    return contenido
+
+@app.callback(
+    dash.Output('kpi3-output', 'children'),
+    [dash.Input('year-selector', 'value'), dash.Input('inst-selector', 'value')]
+)
+def update_kpi3(selected_year, cod_inst):
+    with medir_callback('KPI 3', selected_year):
+        if MODO_SNAPSHOT:
+            return contenido_snapshot(selected_year, 'kpi3')
+        if get_estado()['engine'] is None:
+            return contenido_sin_conexion()
+        df_fuga, _, df_kpi3, _, title_suffix = resultados_destino(selected_year, cod_inst)
+        
+        contenido = contenido_sin_datos(title_suffix) if df_fuga.empty else build_chart_kpi3(df_kpi3, title_suffix)
+    return contenido
+
+@app.callback(
+    dash.Output('kpi4-output', 'children'),
+    [dash.Input('year-selector', 'value'), dash.Input('inst-selector', 'value')]
+)
+def update_kpi4(selected_year, cod_inst):
+    with medir_callback('KPI 4', selected_year):
+        if MODO_SNAPSHOT:
+            return contenido_snapshot(selected_year, 'kpi4')
+        if get_estado()['engine'] is None:
+            return contenido_sin_conexion()
+        df_fuga, _, _, df_kpi4, title_suffix = resultados_destino(selected_year, cod_inst)
+        
+        contenido = contenido_sin_datos(title_suffix) if df_fuga.empty else build_chart_kpi4(df_kpi4, title_suffix)
+    return contenido
+
+@app.callback(
+    dash.Output('kpi5-output', 'children'),
+    [dash.Input('year-selector', 'value'), dash.Input('inst-selector', 'value')],
+    background=background_callback_manager is not None and not MODO_SNAPSHOT,
+)
+def update_kpi5(selected_year, cod_inst):
+    with medir_callback('KPI 5', selected_year):
+        if MODO_SNAPSHOT:
+            return contenido_snapshot(selected_year, 'kpi5')
+        anio_n_param, title_suffix = parametros_cohorte(selected_year)
+        if cod_inst != COD_INST_ECAS:
+            # La titulación estimada sigue la historia de los fugados de ECAS ('transiciones_ecas')
+            return html.Div(html.P("El KPI 5 (titulación estimada de los fugados) solo está disponible para ECAS.",
+                                   style={'textAlign': 'center'}), style={'paddingTop': '50px', 'paddingBottom': '50px'})
+        
+        # En segundo plano el callback corre en otro proceso: get_db_engine entrega el engine compartido de ese proceso.
+        engine = _estado['engine'] or get_db_engine()
+        if engine is None:
+            return contenido_sin_conexion()
+        df_kpi5, total_estimado = kpi5_titulacion_fuga_estimada(engine, anio_n=anio_n_param)
+        contenido = build_chart_kpi5(df_kpi5, total_estimado, title_suffix)
+    
+    return contenido
+
+@app.callback(
+    dash.Output('kpi6-output', 'children'),
+    [dash.Input('year-selector', 'value'), dash.Input('inst-selector', 'value')]
+)
+def update_kpi6(selected_year, cod_inst):
+    with medir_callback('KPI 6', selected_year):
+        if MODO_SNAPSHOT:
+            return contenido_snapshot(selected_year, 'kpi6')
+        if get_estado()['engine'] is None:
+            return contenido_sin_conexion()
+        anio_n_param, title_suffix = parametros_cohorte(selected_year, cod_inst)
+        
+        df_kpi6 = kpi6_supervivencia(get_estado()['engine'], anio_n=anio_n_param, cod_inst=cod_inst)
+        contenido = contenido_sin_datos(title_suffix) if df_kpi6.empty else build_chart_kpi6(df_kpi6, title_suffix)
+    return contenido
+
+@app.callback(
+    dash.Output('kpi7-output', 'children'),
+    [dash.Input('year-selector', 'value'), dash.Input('inst-selector', 'value')]
+)
+def update_kpi7(selected_year, cod_inst):
+    with medir_callback('KPI 7', selected_year):
+        if MODO_SNAPSHOT:
+            return contenido_snapshot(selected_year, 'kpi7')
+        if get_estado()['engine'] is None:
+            return contenido_sin_conexion()
+        anio_n_param, title_suffix = parametros_cohorte(selected_year, cod_inst)
+        
+        df_kpi7 = kpi7_trayectoria_fugados(get_estado()['engine'], anio_n=anio_n_param, cod_inst=cod_inst)
+        contenido = contenido_sin_datos(title_suffix) if df_kpi7.empty else build_chart_kpi7(df_kpi7, title_suffix)
+    return contenido
+
+# ----------------------------------------------------------------------
+# 5. DEPURACIÓN Y MÉTRICAS
+# ----------------------------------------------------------------------
+# Las trazas y métricas son del proceso que atiende la petición: con varios workers, cada uno tiene las suyas,
+# y el KPI 5 en segundo plano (otro proceso) no aparece en el panel.
+
+def formato_bytes(n_bytes):
+    for unidad in ['B', 'KB', 'MB']:
+        if n_bytes < 1024:
+            return f"{n_bytes:.0f} {unidad}"
+        n_bytes /= 1024
+    return f"{n_bytes:.1f} GB"
+
+def contenido_depuracion():
+    """Texto de las últimas trazas (etapas anidadas con su tiempo, filas y bytes en memoria) y tabla resumen por etapa."""
+    bloques = []
+    for registro in reversed(trazas_recientes()[-TRAZAS_PANEL:]):
+        lineas = [f"{registro['traza']} · cohorte {registro.get('cohorte')} · {registro['ms_total']:.1f} ms · "
+                  f"{registro.get('consultas_sql', 0)} consultas SQL · espera de conexión {registro.get('ms_espera_pool', 0)} ms"]
+        for e in registro['etapas']:
+            detalle = f"{'    ' * (e['nivel'] + 1)}{e['etapa']}: {e.get('ms', 0):.1f} ms"
+            if e.get('filas') is not None:
+                detalle += f" · {e['filas']} filas"
+            if e.get('bytes_memoria'):
+                detalle += f" · {formato_bytes(e['bytes_memoria'])} en memoria"
+            lineas.append(detalle)
+        if 'perfil' in registro:
+            lineas.append(f"cProfile ({registro['perfil']['archivo']}):\n{registro['perfil']['resumen']}")
+        bloques.append(html.Pre('\n'.join(lineas), style={'fontSize': '12px', 'marginBottom': '8px'}))
+
+    resumen = resumen_etapas()
+    tabla = html.Table(style={'fontSize': '12px'}, children=[
+        html.Tr([html.Th(c) for c in ['Etapa', 'Ejecuciones', 'Promedio (ms)', 'Máximo (ms)', 'Filas', 'Bytes en memoria']])
+    ] + [
+        html.Tr([html.Td(nombre), html.Td(r['n']), html.Td(r['promedio_ms']), html.Td(r['max_ms']),
+                 html.Td(r['filas']), html.Td(formato_bytes(r['bytes_memoria']))])
+        for nombre, r in resumen.items()
+    ])
+    return [html.H6("Trazas recientes"), *bloques, html.H6("Resumen por etapa (proceso)"), tabla]
+
+if MODO_DEPURACION:
+    @app.callback(
+        dash.Output('depuracion-contenido', 'children'),
+        [dash.Input('depuracion-intervalo', 'n_intervals')]
+    )
+    def update_depuracion(n_intervals):
+        return contenido_depuracion()
+
+@app.server.route('/metricas')
+def metricas():
+    """Métricas del proceso para monitoreo: JSON (por defecto) o texto de Prometheus con ?formato=prometheus."""
+    if flask.request.args.get('formato') == 'prometheus':
+        return flask.Response(metricas_prometheus(), mimetype='text/plain; version=0.0.4')
+    return flask.jsonify({'conexion': estadisticas_conexion(), 'etapas': resumen_etapas(), 'trazas': trazas_recientes()})
+
+# ----------------------------------------------------------------------
+# 6. DESCARGAS DE DATOS
+# ----------------------------------------------------------------------
+# /exportar/<conjunto>?cohorte=AÑO|ALL&inst=COD_INST&formato=csv|parquet entrega la fuga fila a fila o la tabla de un KPI
+# de la institución de origen elegida (por defecto ECAS; la fuga fila a fila y el KPI 5 solo existen para ECAS).
+# La respuesta se arma por lotes mientras se envía, y las descargas simultáneas por proceso están limitadas
+# (ECAS_MAX_EXPORTACIONES): una descarga de más recibe 429 en vez de competir con los callbacks.
+
+NOMBRES_CONJUNTOS = {'fuga': 'Fugados', 'kpi1': 'KPI 1', 'kpi2': 'KPI 2', 'kpi3': 'KPI 3', 'kpi4': 'KPI 4', 'kpi5': 'KPI 5'}
+
+@app.callback(
+    dash.Output('descargas', 'children'),
+    [dash.Input('year-selector', 'value'), dash.Input('inst-selector', 'value')]
+)
+def update_descargas(selected_year, cod_inst):
+    es_ecas = cod_inst == COD_INST_ECAS
+    if MODO_SNAPSHOT and not es_ecas:
+        return "Las descargas del snapshot solo incluyen ECAS."
+    # En modo snapshot la fuga fila a fila no está disponible (el snapshot solo guarda agregados)
+    parametros = f"cohorte={selected_year}&inst={cod_inst}"
+    enlaces = [(f"{NOMBRES_CONJUNTOS[c]} (CSV)", f"/exportar/{c}?{parametros}&formato=csv")
+               for c in CONJUNTOS_EXPORTACION
+               if not (MODO_SNAPSHOT and c == 'fuga') and (es_ecas or c not in CONJUNTOS_SOLO_ECAS)]
+    if not MODO_SNAPSHOT and es_ecas:
+        enlaces.append(("Fugados (Parquet)", f"/exportar/fuga?{parametros}&formato=parquet"))
+
+    contenido = ["⬇️ Descargar: "]
+    for i, (texto, href) in enumerate(enlaces):
+        contenido += ([" · "] if i else []) + [html.A(texto, href=href)]
+    return contenido
+
+@app.server.route('/exportar/<conjunto>')
+def exportar(conjunto):
+    """Descarga de un conjunto de datos de la cohorte en CSV o Parquet, enviada por lotes."""
+    formato = flask.request.args.get('formato', 'csv')
+    cohorte = flask.request.args.get('cohorte', 'ALL')
+    inst = flask.request.args.get('inst', str(COD_INST_ECAS))
+    if conjunto not in CONJUNTOS_EXPORTACION or formato not in FORMATOS_EXPORTACION:
+        return flask.Response(f"Conjunto o formato no válido. Conjuntos: {', '.join(CONJUNTOS_EXPORTACION)}; "
+                              f"formatos: {', '.join(FORMATOS_EXPORTACION)}.", status=404, mimetype='text/plain')
+
+    estado = get_estado()
+    selected_year = cohorte if cohorte == 'ALL' else int(cohorte) if cohorte.isdigit() else None
+    if selected_year is None or (selected_year != 'ALL' and selected_year not in estado['years_available']):
+        return flask.Response(f"Cohorte no disponible: {cohorte}", status=404, mimetype='text/plain')
+    cod_inst = int(inst) if inst.isdigit() else None
+    if cod_inst not in estado['instituciones'] or (MODO_SNAPSHOT and cod_inst != COD_INST_ECAS):
+        return flask.Response(f"Institución no disponible: {inst}", status=404, mimetype='text/plain')
+    if cod_inst != COD_INST_ECAS and conjunto in CONJUNTOS_SOLO_ECAS:
+        return flask.Response(f"El conjunto '{conjunto}' solo está disponible para ECAS.", status=404, mimetype='text/plain')
+
+    if MODO_SNAPSHOT and conjunto == 'fuga':
+        return flask.Response("La fuga fila a fila no está incluida en el snapshot.", status=404, mimetype='text/plain')
+    if not MODO_SNAPSHOT and estado['engine'] is None:
+        return flask.Response("Sin conexión a la base de datos.", status=503, mimetype='text/plain')
+
+    if not tomar_turno_exportacion():
+        return flask.Response("Hay demasiadas descargas en curso; intenta de nuevo en unos segundos.",
+                              status=429, mimetype='text/plain', headers={'Retry-After': '30'})
 
+    # Las tablas de los KPIs se calculan aquí, antes de empezar a responder; solo la fuga se lee mientras se envía
+    try:
+        if MODO_SNAPSHOT:
+            lotes = lotes_snapshot(conjunto, selected_year)
+        else:
+            lotes = lotes_conjunto(estado['engine'], conjunto, anio_n=parametros_cohorte(selected_year)[0], cod_inst=cod_inst)
+    except Exception:
+        liberar_turno_exportacion()
+        raise
 
-    # 4. Retornar todos los gráficos
-    return kpi1_chart, kpi2_chart, kpi3_chart, kpi4_chart, kpi5_chart
+    partes = csv_por_lotes(lotes) if formato == 'csv' else parquet_por_lotes(lotes)
+    sufijo_inst = '' if cod_inst == COD_INST_ECAS else f"_inst_{cod_inst}"
+    respuesta = flask.Response(partes, mimetype=FORMATOS_EXPORTACION[formato], headers={
+        'Content-Disposition': f'attachment; filename="{conjunto}{sufijo_inst}_cohorte_{selected_year}.{formato}"',
+    })
+    # El turno se libera al terminar de enviar la respuesta (o si el cliente corta la descarga)
+    respuesta.call_on_close(liberar_turno_exportacion)
+    return respuesta
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True)
@@ -0,0 +1,159 @@
+#Archivo para medir el tiempo y la memoria de las funciones de KPIs sobre matrícula sintética de distintos tamaños.
+#Los resultados se guardan en JSON en CARPETA_BENCHMARK para comparar entre versiones (--comparar).
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import time
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import sqlalchemy
+from sqlalchemy import create_engine
+import queries
+from datos_sinteticos import crear_base_sintetica
+from matricula_memoria import cargar_matricula_memoria, calcular_fuga_memoria
+from trayectorias import cargar_trayectorias, curva_supervivencia, trayectoria_fugados
+
+CARPETA_BENCHMARK = 'benchmark'
+TAMANIOS = [100000, 1000000, 10000000]
+REPETICIONES = 3
+UMBRAL_REGRESION = 0.20   # Una función se marca como regresión si es más de 20% más lenta que la referencia
+
+def get_engine_sintetico(n_filas, semilla=0):
+    """Engine de la base sintética de n_filas (se genera solo la primera vez)."""
+    ruta = os.path.join(CARPETA_BENCHMARK, f'sinteticos_{n_filas}.db')
+    if os.path.exists(ruta):
+        return create_engine(f"sqlite:///{ruta}")
+
+    os.makedirs(CARPETA_BENCHMARK, exist_ok=True)
+    inicio = time.perf_counter()
+    engine, success, message = crear_base_sintetica(ruta, n_filas=n_filas, semilla=semilla)
+    print(f"{message} ({time.perf_counter() - inicio:.1f} s)")
+    if not success:
+        os.remove(ruta)
+        raise RuntimeError(message)
+    return engine
+
+def medir(func, repeticiones=REPETICIONES):
+    """
+    Ejecuta func() 'repeticiones' veces sin instrumentar (tiempo mínimo y mediana) y una vez más con
+    tracemalloc para el pico de memoria asignada, que incluye los arreglos de numpy/pandas.
+    """
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        resultado = func()
+        tiempos.append(time.perf_counter() - inicio)
+
+    tracemalloc.start()
+    func()
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return resultado, {
+        'segundos_min': round(min(tiempos), 4),
+        'segundos_mediana': round(statistics.median(tiempos), 4),
+        'pico_memoria_mb': round(pico / 1e6, 2),
+    }
+
+def filas_resultado(resultado):
+    """Cantidad de filas del DataFrame principal de un resultado (para verificar que cada tamaño hizo trabajo)."""
+    if isinstance(resultado, tuple):
+        resultado = resultado[0]
+    return len(resultado) if isinstance(resultado, pd.DataFrame) else None
+
+def benchmark_tamanio(n_filas, cohorte=None, repeticiones=REPETICIONES):
+    """Mide cada KPI para una cohorte y para 'ALL' sobre la base sintética de n_filas."""
+    engine = get_engine_sintetico(n_filas)
+    anios = queries.get_df_ecas_anual(engine)[1]
+    cohorte = cohorte or anios[len(anios) // 2]
+    resultados = []
+
+    def registrar(nombre, anio, func):
+        resultado, medicion = medir(func, repeticiones)
+        resultados.append({'filas': n_filas, 'cohorte': anio or 'ALL', 'funcion': nombre,
+                           'filas_resultado': filas_resultado(resultado), **medicion})
+        print(f"{n_filas:>10} {str(anio or 'ALL'):>5} {nombre:<35} {medicion['segundos_mediana']:>9.4f} s {medicion['pico_memoria_mb']:>9.1f} MB")
+        return resultado
+
+    almacen = registrar('cargar_matricula_memoria', None, lambda: cargar_matricula_memoria(engine))
+    tray = registrar('cargar_trayectorias', None, lambda: cargar_trayectorias(almacen))
+
+    for anio in [cohorte, None]:
+        desde, hasta = (anio, anio + 1) if anio else (None, None)
+        registrar('calcular_permanencia', anio, lambda: queries.calcular_permanencia(*queries.get_df_ecas_anual(engine, desde, hasta)))
+        registrar('kpi1_permanencia_ecas', anio, lambda: queries.kpi1_permanencia_ecas.sin_cache(engine, anio=anio))
+        df_fuga = registrar('get_df_fuga_base', anio, lambda: queries.get_df_fuga_base.sin_cache(engine, anio_n=anio))
+        registrar('calcular_fuga_memoria', anio, lambda: calcular_fuga_memoria(almacen, anio_n=anio))
+        registrar('kpi2_institucion_destino', anio, lambda: queries.kpi2_institucion_destino(df_fuga))
+        registrar('kpi3_carrera_destino', anio, lambda: queries.kpi3_carrera_destino(df_fuga))
+        registrar('kpi4_area_destino', anio, lambda: queries.kpi4_area_destino(df_fuga))
+        registrar('kpi5_titulacion_fuga_estimada', anio, lambda: queries.kpi5_titulacion_fuga_estimada.sin_cache(engine, anio_n=anio))
+        # Formas de entregar los fugados a la consulta de historia del KPI 5 (ver queries.ESTRATEGIA_HISTORIA_FUGADOS)
+        for estrategia in ('subconsulta', 'lista_in', 'tabla_temporal'):
+            mruns = None if estrategia == 'subconsulta' else df_fuga['MRUN'].unique()
+            registrar(f'historia_fugados.{estrategia}', anio,
+                      lambda: queries._leer_historia_fugados(engine, anio_n=anio, mruns_fugados=mruns, estrategia=estrategia))
+        registrar('curva_supervivencia', anio, lambda: curva_supervivencia(tray, queries.COD_INST_ECAS, anio))
+        registrar('trayectoria_fugados', anio, lambda: trayectoria_fugados(tray, queries.COD_INST_ECAS, anio))
+
+    engine.dispose()
+    return resultados
+
+def comparar_resultados(resultados, ruta_referencia, umbral=UMBRAL_REGRESION):
+    """Imprime las funciones cuya mediana empeoró más que 'umbral' respecto de un JSON anterior. Devuelve la lista."""
+    with open(ruta_referencia, 'r', encoding='utf-8') as f:
+        referencia = {(r['filas'], str(r['cohorte']), r['funcion']): r for r in json.load(f)['resultados']}
+
+    regresiones = []
+    for r in resultados:
+        anterior = referencia.get((r['filas'], str(r['cohorte']), r['funcion']))
+        if anterior and anterior['segundos_mediana'] > 0:
+            razon = r['segundos_mediana'] / anterior['segundos_mediana']
+            if razon > 1 + umbral:
+                regresiones.append({**r, 'razon': round(razon, 2)})
+                print(f"REGRESIÓN: {r['funcion']} ({r['filas']} filas, cohorte {r['cohorte']}): "
+                      f"{anterior['segundos_mediana']:.4f} s -> {r['segundos_mediana']:.4f} s (x{razon:.2f})")
+
+    if not regresiones:
+        print(f"Sin regresiones mayores a {umbral:.0%} respecto de '{ruta_referencia}'.")
+    return regresiones
+
+def ejecutar_benchmark(tamanios=TAMANIOS, cohorte=None, repeticiones=REPETICIONES):
+    """Corre el benchmark para cada tamaño y guarda el JSON. Devuelve (ruta del JSON, resultados)."""
+    resultados = []
+    for n_filas in tamanios:
+        resultados.extend(benchmark_tamanio(n_filas, cohorte=cohorte, repeticiones=repeticiones))
+
+    salida = {
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'entorno': {
+            'python': platform.python_version(), 'plataforma': platform.platform(),
+            'pandas': pd.__version__, 'numpy': np.__version__, 'sqlalchemy': sqlalchemy.__version__,
+        },
+        'repeticiones': repeticiones,
+        'resultados': resultados,
+    }
+    os.makedirs(CARPETA_BENCHMARK, exist_ok=True)
+    ruta = os.path.join(CARPETA_BENCHMARK, f"resultados_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(ruta, 'w', encoding='utf-8') as f:
+        json.dump(salida, f, indent=2, ensure_ascii=False)
+
+    return ruta, resultados
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark de los KPIs sobre matrícula sintética.")
+    parser.add_argument('--tamanios', type=int, nargs='+', default=TAMANIOS)
+    parser.add_argument('--cohorte', type=int, default=None, help="Año de la cohorte (por defecto, el año central)")
+    parser.add_argument('--repeticiones', type=int, default=REPETICIONES)
+    parser.add_argument('--comparar', default=None, help="JSON de una ejecución anterior para detectar regresiones")
+    args = parser.parse_args()
+
+    ruta, resultados = ejecutar_benchmark(args.tamanios, args.cohorte, args.repeticiones)
+    print(f"Resultados guardados en '{ruta}'.")
+    if args.comparar:
+        comparar_resultados(resultados, args.comparar)
@@ -0,0 +1,163 @@
+#Archivo para el caché de resultados de las consultas de KPIs por cohorte.
+#Las entradas se identifican por función, argumentos (la cohorte) y la versión de los datos,
+#que se actualiza cada vez que se recargan los CSV o se recrea la vista unificada.
+
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_DIR = 'cache'
+ARCHIVO_VERSION = os.path.join(CACHE_DIR, 'version_datos.txt')
+MAX_ENTRADAS_MEMORIA = 64   # Alcanza para ~18 cohortes + 'ALL' en todas las funciones cacheadas
+CACHE_EN_DISCO = False      # Si es True, los resultados también se guardan como pickle en CACHE_DIR
+
+_cache_memoria = OrderedDict()
+_lock = threading.Lock()
+_locks_calculo = {}   # Un lock por clave en cálculo, para que llamadas simultáneas calculen una sola vez
+
+_version = {'actual': (None, '0')}   # (inodo y mtime del archivo, sello leído), se reemplaza de una vez
+
+def version_datos():
+    """
+    Devuelve el sello de versión de los datos ('0' si nunca se ha registrado una carga).
+    Se consulta en cada búsqueda del caché, así que el archivo solo se vuelve a leer si cambió su inodo o su
+    mtime (ej. una carga de CSV en otro proceso); en este proceso lo refresca actualizar_version_datos().
+    """
+    try:
+        info = os.stat(ARCHIVO_VERSION)
+    except FileNotFoundError:
+        return '0'
+    archivo, valor = _version['actual']
+    if archivo != (info.st_ino, info.st_mtime_ns):
+        try:
+            with open(ARCHIVO_VERSION, 'r') as f:
+                valor = f.read().strip() or '0'
+        except FileNotFoundError:
+            return '0'
+        _version['actual'] = ((info.st_ino, info.st_mtime_ns), valor)
+    return valor
+
+def actualizar_version_datos():
+    """Registra una nueva versión de los datos e invalida el caché en memoria y en disco."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    nueva_version = str(time.time_ns())
+    # Se reemplaza el archivo (inodo nuevo): los otros procesos notan el cambio aunque el mtime no avance
+    with open(ARCHIVO_VERSION + '.tmp', 'w') as f:
+        f.write(nueva_version)
+    os.replace(ARCHIVO_VERSION + '.tmp', ARCHIVO_VERSION)
+    info = os.stat(ARCHIVO_VERSION)
+    _version['actual'] = ((info.st_ino, info.st_mtime_ns), nueva_version)
+
+    limpiar_cache()
+    return nueva_version
+
+def limpiar_cache():
+    """Elimina todas las entradas del caché en memoria y los archivos del caché en disco."""
+    with _lock:
+        _cache_memoria.clear()
+
+    if os.path.exists(CACHE_DIR):
+        for filename in os.listdir(CACHE_DIR):
+            if filename.endswith('.pkl'):
+                os.remove(os.path.join(CACHE_DIR, filename))
+
+def _ruta_disco(clave):
+    nombre = hashlib.sha1(repr(clave).encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, f'{nombre}.pkl')
+
+def _leer(clave):
+    with _lock:
+        if clave in _cache_memoria:
+            _cache_memoria.move_to_end(clave)
+            return True, _cache_memoria[clave]
+
+    if CACHE_EN_DISCO:
+        try:
+            with open(_ruta_disco(clave), 'rb') as f:
+                valor = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return False, None
+        _guardar_memoria(clave, valor)
+        return True, valor
+
+    return False, None
+
+def _guardar_memoria(clave, valor):
+    with _lock:
+        _cache_memoria[clave] = valor
+        _cache_memoria.move_to_end(clave)
+        # Expulsión LRU: se descartan las entradas usadas hace más tiempo
+        while len(_cache_memoria) > MAX_ENTRADAS_MEMORIA:
+            _cache_memoria.popitem(last=False)
+
+def _guardar(clave, valor):
+    _guardar_memoria(clave, valor)
+
+    if CACHE_EN_DISCO:
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            ruta = _ruta_disco(clave)
+            with open(ruta + '.tmp', 'wb') as f:
+                pickle.dump(valor, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(ruta + '.tmp', ruta)
+        except Exception as e:
+            print(f"ADVERTENCIA: No se pudo guardar el caché en disco: {e}")
+
+def cache_por_cohorte(derivados=()):
+    """
+    Decorador para funciones de queries.py cuyo primer argumento es la conexión (db_conn).
+    La clave se arma con el resto de argumentos (ej. anio_n) y la versión de los datos.
+    Los argumentos en 'derivados' (ej. df_fuga) se calculan a partir de la cohorte y no forman
+    parte de la clave, así que solo se usa el caché si se entregan junto con la cohorte: con
+    anio_n=None no hay forma de saber a qué cohorte corresponden y la llamada se ejecuta sin caché.
+    Tampoco se usa el caché si algún argumento no es hashable.
+    Todas las llamadas con la misma clave reciben el mismo resultado (sin copiar los DataFrames): quien
+    necesite modificarlo debe hacer su propia copia.
+    """
+    def decorador(func):
+        firma = inspect.signature(func)
+
+        @functools.wraps(func)
+        def envoltura(db_conn, *args, **kwargs):
+            argumentos = firma.bind(db_conn, *args, **kwargs)
+            argumentos.apply_defaults()
+            parametros = tuple(
+                (nombre, valor) for nombre, valor in list(argumentos.arguments.items())[1:]
+                if nombre not in derivados
+            )
+            if (any(argumentos.arguments.get(nombre) is not None for nombre in derivados)
+                    and argumentos.arguments.get('anio_n') is None):
+                return func(db_conn, *args, **kwargs)
+
+            clave = (func.__name__, str(getattr(db_conn, 'url', '')), version_datos(), parametros)
+            try:
+                hash(clave)
+            except TypeError:
+                return func(db_conn, *args, **kwargs)
+
+            encontrado, valor = _leer(clave)
+            if encontrado:
+                return valor
+
+            with _lock:
+                lock_calculo = _locks_calculo.setdefault(clave, threading.Lock())
+
+            with lock_calculo:
+                # Otro hilo pudo haber calculado el mismo resultado mientras se esperaba el lock
+                encontrado, valor = _leer(clave)
+                if not encontrado:
+                    valor = func(db_conn, *args, **kwargs)
+                    _guardar(clave, valor)
+
+            with _lock:
+                _locks_calculo.pop(clave, None)
+            return valor
+
+        envoltura.sin_cache = func
+        return envoltura
+    return decorador
@@ -1,13 +1,179 @@
 #Archivo para generar conexión con base de datos
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import contextvars
+import os
+import threading
+import time
 import urllib
 
-SERVER = 'QUPARDO'
-DATABASE = 'DBMatriculas'
-DRIVER_NAME = 'ODBC Driver 17 for SQL Server' 
+# Configuración de la conexión. Todos los valores se pueden cambiar con variables de entorno,
+# por ejemplo al desplegar el dashboard con varios workers.
+SERVER = os.environ.get('ECAS_DB_SERVER', 'QUPARDO')
+DATABASE = os.environ.get('ECAS_DB_DATABASE', 'DBMatriculas')
+DRIVER_NAME = os.environ.get('ECAS_DB_DRIVER', 'ODBC Driver 17 for SQL Server')
 
-def get_db_engine():
+# Fuente de datos de los KPIs: 'sqlserver' (por defecto), 'parquet' (DuckDB embebido generado con exportar_parquet.py)
+# o 'sqlite' (base local de prueba con las mismas tablas). Con 'parquet', los KPIs leen las tablas que exportar_parquet.py
+# copia dentro de la base DuckDB (matrícula deduplicada, transiciones, serie del KPI 1 y matriz); solo la historia de
+# los fugados del KPI 5 y las cargas completas de la matrícula (motor en memoria, trayectorias) leen la vista
+# unificada, que recorre los Parquet por año.
+FUENTE_DATOS = os.environ.get('ECAS_FUENTE_DATOS', 'sqlserver')
+CARPETA_PARQUET = os.environ.get('ECAS_CARPETA_PARQUET', 'datos_parquet')
+ARCHIVO_DUCKDB = os.path.join(CARPETA_PARQUET, 'ecas.duckdb')
+ARCHIVO_SQLITE = os.environ.get('ECAS_ARCHIVO_SQLITE', 'ecas_local.db')
+
+# Pool de conexiones de cada proceso (un worker de Dash = un proceso = un engine compartido).
+# Conexiones máximas por worker = POOL_SIZE + MAX_OVERFLOW.
+POOL_SIZE = int(os.environ.get('ECAS_POOL_SIZE', 5))
+MAX_OVERFLOW = int(os.environ.get('ECAS_MAX_OVERFLOW', 5))
+POOL_TIMEOUT = int(os.environ.get('ECAS_POOL_TIMEOUT', 30))      # Segundos de espera por una conexión libre
+POOL_RECYCLE = int(os.environ.get('ECAS_POOL_RECYCLE', 1800))    # Segundos antes de renovar una conexión
+POOL_PRE_PING = os.environ.get('ECAS_POOL_PRE_PING', '1') != '0'  # Verifica la conexión antes de entregarla
+
+# Hilos para calcular varias cohortes a la vez (precálculo y snapshot). Cada hilo toma su propia conexión
+# del pool: se limitan a POOL_SIZE - 1 para dejar al menos una conexión base libre a los callbacks,
+# sin depender de las conexiones de overflow (que se abren y cierran en cada uso).
+MAX_WORKERS_CONSULTAS = max(1, POOL_SIZE - 1)
+WORKERS_CONSULTAS = max(1, min(int(os.environ.get('ECAS_WORKERS_CONSULTAS', 3)), MAX_WORKERS_CONSULTAS))
+
+MAX_MUESTRAS_METRICAS = 1000   # Muestras recientes que se guardan por métrica (para el percentil 95)
+
+_engines = {}
+_lock_engines = threading.Lock()
+
+# ----------------------------------------------------------------------
+# MÉTRICAS DEL POOL Y DE LAS CONSULTAS
+# ----------------------------------------------------------------------
+
+_metricas = {}
+_lock_metricas = threading.Lock()
+_medicion_actual = contextvars.ContextVar('medicion_actual', default=None)
+
+def _registrar_muestra(nombre, segundos):
+    with _lock_metricas:
+        metrica = _metricas.setdefault(nombre, {'n': 0, 'total': 0.0, 'max': 0.0, 'muestras': deque(maxlen=MAX_MUESTRAS_METRICAS)})
+        metrica['n'] += 1
+        metrica['total'] += segundos
+        metrica['max'] = max(metrica['max'], segundos)
+        metrica['muestras'].append(segundos)
+
+class PoolMedido(QueuePool):
+    """QueuePool que registra cuánto tarda cada checkout (espera por una conexión libre o apertura de una nueva)."""
+    def _do_get(self):
+        inicio = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            duracion = time.perf_counter() - inicio
+            _registrar_muestra('pool.espera_checkout', duracion)
+            medicion = _medicion_actual.get()
+            if medicion is not None:
+                medicion['checkouts'] += 1
+                medicion['segundos_espera_pool'] += duracion
+
+def _medir_consultas_sql(engine):
+    """Registra el tiempo de ejecución de cada sentencia del engine en la medición en curso."""
+    @event.listens_for(engine, 'before_cursor_execute')
+    def antes_de_ejecutar(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('inicios_consulta', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def despues_de_ejecutar(conn, cursor, statement, parameters, context, executemany):
+        duracion = time.perf_counter() - conn.info['inicios_consulta'].pop()
+        _registrar_muestra('sql.ejecucion', duracion)
+        medicion = _medicion_actual.get()
+        if medicion is not None:
+            medicion['consultas'] += 1
+            medicion['segundos_sql'] += duracion
+
+    @event.listens_for(engine, 'handle_error')
+    def al_fallar(contexto):
+        # Una sentencia que falla no llega a after_cursor_execute: se descarta su inicio para que la pila no crezca
+        # con cada error en una conexión del pool
+        if contexto.connection is None or contexto.execution_context is None:
+            return
+        inicios = contexto.connection.info.get('inicios_consulta')
+        if inicios:
+            _registrar_muestra('sql.error', time.perf_counter() - inicios.pop())
+
+@contextlib.contextmanager
+def medir_consultas(nombre_kpi):
+    """
+    Atribuye a 'nombre_kpi' las consultas y los checkouts del pool hechos dentro del bloque (en el mismo hilo).
+    Entrega un diccionario con la medición del bloque y al salir la acumula en las métricas del proceso.
+    """
+    medicion = {'consultas': 0, 'segundos_sql': 0.0, 'checkouts': 0, 'segundos_espera_pool': 0.0}
+    token = _medicion_actual.set(medicion)
+    inicio = time.perf_counter()
+    try:
+        yield medicion
+    finally:
+        _medicion_actual.reset(token)
+        medicion['segundos_total'] = time.perf_counter() - inicio
+        _registrar_muestra(f'{nombre_kpi}.total', medicion['segundos_total'])
+        _registrar_muestra(f'{nombre_kpi}.sql', medicion['segundos_sql'])
+        _registrar_muestra(f'{nombre_kpi}.espera_pool', medicion['segundos_espera_pool'])
+
+def estadisticas_conexion():
+    """Resumen de las métricas del proceso (en ms) y el estado del pool del engine compartido."""
+    resumen = {}
+    with _lock_metricas:
+        for nombre, metrica in sorted(_metricas.items()):
+            muestras = sorted(metrica['muestras'])
+            resumen[nombre] = {
+                'n': metrica['n'],
+                'promedio_ms': round(1000 * metrica['total'] / metrica['n'], 2),
+                'p95_ms': round(1000 * muestras[int(0.95 * (len(muestras) - 1))], 2),
+                'max_ms': round(1000 * metrica['max'], 2),
+            }
+
+    engine = _engines.get((FUENTE_DATOS, os.getpid()))
+    pool = engine.pool.status() if engine is not None else 'Sin engine'
+    return {'pid': os.getpid(), 'fuente': FUENTE_DATOS, 'pool': pool, 'metricas': resumen}
+
+# ----------------------------------------------------------------------
+# EJECUCIÓN EN PARALELO
+# ----------------------------------------------------------------------
+
+def en_paralelo(func, valores, max_workers=WORKERS_CONSULTAS):
+    """
+    Ejecuta func(valor) para cada valor en un pool de hilos y entrega (valor, resultado) en el orden de 'valores'
+    (resultado es la excepción si func falló). Mientras un hilo espera a la DB, los otros avanzan en pandas
+    o Plotly, y quien consume los resultados puede procesarlos a medida que llegan.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, MAX_WORKERS_CONSULTAS)), thread_name_prefix='ecas') as executor:
+        futuros = [(valor, executor.submit(func, valor)) for valor in valores]
+        for valor, futuro in futuros:
+            try:
+                yield valor, futuro.result()
+            except Exception as e:
+                yield valor, e
+
+# ----------------------------------------------------------------------
+# CREACIÓN DE ENGINES
+# ----------------------------------------------------------------------
+
+def _crear_engine(url, **kwargs):
+    """Crea un Engine con la configuración de pool del módulo y la medición de consultas."""
+    engine = create_engine(
+        url,
+        poolclass=PoolMedido,
+        pool_size=POOL_SIZE,
+        max_overflow=MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT,
+        pool_recycle=POOL_RECYCLE,
+        pool_pre_ping=POOL_PRE_PING,
+        **kwargs
+    )
+    _medir_consultas_sql(engine)
+    return engine
+
+def get_sqlserver_engine():
     """Establece y devuelve el motor de conexión (Engine) a SQL Server usando Autenticación de Windows."""
     try:
         
@@ -15,7 +181,7 @@ def get_db_engine():
         
         DB_URL = f"mssql+pyodbc://{SERVER}/{DATABASE}?driver={DRIVER}&trusted_connection=yes"
         
-        engine = create_engine(DB_URL, fast_executemany=True)
+        engine = _crear_engine(DB_URL, fast_executemany=True)
         
         # Probar la conexión
         with engine.connect():
@@ -28,7 +194,71 @@ def get_db_engine():
         print("="*50)
         return None
 
+def get_duckdb_engine(read_only=True):
+    """
+    Devuelve un Engine sobre la base DuckDB con los mismos nombres que SQL Server: vista_matriculas_unificada
+    es una vista sobre los Parquet por año y el resto (matricula_deduplicada, transiciones_ecas, ...) son tablas
+    copiadas dentro de la base al crearla.
+    Requiere los paquetes duckdb y duckdb_engine.
+    """
+    try:
+        if read_only and not os.path.exists(ARCHIVO_DUCKDB):
+            raise FileNotFoundError(f"No existe '{ARCHIVO_DUCKDB}'. Ejecuta exportar_parquet.py primero.")
+
+        engine = _crear_engine(f"duckdb:///{ARCHIVO_DUCKDB}", connect_args={'read_only': read_only})
+
+        # Probar la conexión
+        with engine.connect():
+            return engine
+
+    except Exception as e:
+        print("="*50)
+        print(f"ERROR DE CONEXIÓN A DUCKDB: {e}")
+        print("="*50)
+        return None
+
+def get_sqlite_engine():
+    """
+    Devuelve un Engine sobre la base SQLite local (ARCHIVO_SQLITE), que reemplaza a SQL Server
+    en pruebas y desarrollo. Se crea vacía si no existe (cárgala con load_csv.py).
+    """
+    try:
+        engine = _crear_engine(f"sqlite:///{ARCHIVO_SQLITE}", connect_args={'check_same_thread': False})
+
+        # Probar la conexión
+        with engine.connect():
+            return engine
+
+    except Exception as e:
+        print("="*50)
+        print(f"ERROR DE CONEXIÓN A SQLITE: {e}")
+        print("="*50)
+        return None
+
+def get_db_engine():
+    """
+    Devuelve el Engine compartido del proceso para la fuente configurada en FUENTE_DATOS.
+    Se crea (y se prueba) solo la primera vez; si la conexión falla devuelve None y se reintenta en la próxima llamada.
+    """
+    # La clave incluye el pid: un proceso hijo (fork) no debe reutilizar las conexiones del padre
+    clave = (FUENTE_DATOS, os.getpid())
+    with _lock_engines:
+        if clave not in _engines:
+            if FUENTE_DATOS == 'parquet':
+                engine = get_duckdb_engine()
+            elif FUENTE_DATOS == 'sqlite':
+                engine = get_sqlite_engine()
+            else:
+                engine = get_sqlserver_engine()
+
+            if engine is None:
+                return None
+            _engines[clave] = engine
+
+        return _engines[clave]
+
 if __name__ == '__main__':
     # Prueba de conexión rápida
     if get_db_engine():
-        print("conector_db.py: Conexión exitosa. Engine listo.")
\ No newline at end of file
+        print(f"conector_db.py: Conexión exitosa ({FUENTE_DATOS}). Engine listo.")
+        print(f"Pool: pool_size={POOL_SIZE}, max_overflow={MAX_OVERFLOW}, timeout={POOL_TIMEOUT} s, recycle={POOL_RECYCLE} s, pre_ping={POOL_PRE_PING}.")
@@ -0,0 +1,143 @@
+#Archivo para generar matrícula sintética (tablas matricula_AÑO) y cargarla en una base SQLite local,
+#con la vista unificada y las tablas materializadas, para pruebas y benchmarks sin SQL Server.
+
+import argparse
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+from connector_db import ARCHIVO_SQLITE
+from queries import COD_INST_ECAS
+from views import create_unified_view
+
+CARRERAS_POR_INSTITUCION = 12
+NOMBRES_CARRERA = 60      # Cantidad de nombres de carrera distintos (se repiten entre instituciones)
+AREAS_CONOCIMIENTO = ['Administración y Comercio', 'Ciencias Sociales', 'Derecho', 'Educación', 'Humanidades',
+                      'Salud', 'Tecnología', 'Arte y Arquitectura', 'Ciencias Básicas', 'Agropecuaria']
+
+def _catalogo_carreras(rng, n_instituciones, duraciones_semestres, tasa_vespertina):
+    """Catálogo de instituciones (ECAS primero) y de sus carreras, indexado por inst * CARRERAS_POR_INSTITUCION + carrera."""
+    otros_codigos = [cod for cod in range(1, n_instituciones + 2) if cod != COD_INST_ECAS][:n_instituciones - 1]
+    cod_inst = np.array([COD_INST_ECAS] + otros_codigos, dtype='int32')
+
+    n_carreras = n_instituciones * CARRERAS_POR_INSTITUCION
+    nombre = rng.integers(0, NOMBRES_CARRERA, n_carreras)
+    vespertina = rng.random(n_carreras) < tasa_vespertina
+    inst_carrera = np.repeat(cod_inst, CARRERAS_POR_INSTITUCION)
+
+    return {
+        'cod_inst': cod_inst,
+        'nomb_inst': np.array([f'INSTITUCION {cod}' for cod in cod_inst], dtype=object),
+        'nomb_carrera': np.array([f'CARRERA {n}' for n in nombre], dtype=object),
+        'area_conocimiento': np.array([AREAS_CONOCIMIENTO[n % len(AREAS_CONOCIMIENTO)] for n in nombre], dtype=object),
+        'jornada': np.where(vespertina, 'Vespertino', 'Diurno').astype(object),
+        'codigo_unico': np.array([f'I{i}C{n}J{1 + v}' for i, n, v in zip(inst_carrera, nombre, vespertina)], dtype=object),
+        'dur_estudio_carr': rng.choice(duraciones_semestres, n_carreras).astype('int16'),
+        'dur_proceso_tit': rng.integers(0, 3, n_carreras).astype('int16'),
+    }
+
+def generar_matricula(n_filas=100000, anio_inicio=2007, anio_fin=2024, n_instituciones=40, proporcion_ecas=0.1,
+                      tasa_cambio_institucion=0.08, tasa_cambio_carrera=0.05, tasa_desercion=0.12,
+                      duraciones_semestres=(8, 9, 10, 12), tasa_vespertina=0.3, tasa_doble_matricula=0.02, semilla=0):
+    """
+    Genera aprox. n_filas de matrícula con las columnas de la vista unificada (más cat_periodo), en forma vectorizada.
+    Cada estudiante ingresa a una carrera y se matricula año a año hasta completar su duración o desertar
+    (tasa_desercion por año). Cada año puede cambiarse de institución (tasa_cambio_institucion) o de carrera
+    dentro de la misma institución (tasa_cambio_carrera); proporcion_ecas es la probabilidad de elegir ECAS.
+    Una fracción de filas (tasa_doble_matricula) se duplica en otra institución el mismo año.
+    """
+    rng = np.random.default_rng(semilla)
+    catalogo = _catalogo_carreras(rng, n_instituciones, duraciones_semestres, tasa_vespertina)
+    peso_inst = np.full(n_instituciones, (1 - proporcion_ecas) / (n_instituciones - 1))
+    peso_inst[0] = proporcion_ecas
+
+    # Años de matrícula por estudiante: duración teórica de su primera carrera, cortada por la deserción.
+    # Se estiman cuántos estudiantes hacen falta para n_filas: E[min(geométrica, años)] por estudiante,
+    # corregido por los ingresos anteriores a anio_inicio (solo aportan sus últimos años) y la doble matrícula.
+    anios_max = int(np.ceil(max(duraciones_semestres) / 2))
+    anios_promedio = np.mean([((1 - tasa_desercion) ** np.arange(np.ceil(d / 2))).sum() for d in duraciones_semestres])
+    anios_ingreso = anio_fin - anio_inicio + anios_max
+    n_estudiantes = max(1, int(n_filas / anios_promedio / (1 + tasa_doble_matricula) * anios_ingreso / (anio_fin - anio_inicio + 1)))
+
+    carrera_inicial = rng.choice(n_instituciones, n_estudiantes, p=peso_inst) * CARRERAS_POR_INSTITUCION + \
+        rng.integers(0, CARRERAS_POR_INSTITUCION, n_estudiantes)
+    anios_carrera = np.ceil(catalogo['dur_estudio_carr'][carrera_inicial] / 2).astype('int64')
+    anios_matricula = np.minimum(rng.geometric(tasa_desercion, n_estudiantes), anios_carrera)
+    anio_ingreso = rng.integers(anio_inicio - anios_max + 1, anio_fin + 1, n_estudiantes)
+
+    # Una fila por estudiante y año
+    estudiante = np.repeat(np.arange(n_estudiantes), anios_matricula)
+    inicio_estudiante = np.repeat(np.cumsum(anios_matricula) - anios_matricula, anios_matricula)
+    anio_en_carrera = np.arange(len(estudiante)) - inicio_estudiante
+    cat_periodo = anio_ingreso[estudiante] + anio_en_carrera
+
+    # Tramos: una institución se mantiene hasta un cambio de institución; una carrera, hasta cualquier cambio
+    sorteo = rng.random(len(estudiante))
+    cambio_inst = (anio_en_carrera > 0) & (sorteo < tasa_cambio_institucion)
+    cambio_carrera = (anio_en_carrera > 0) & (sorteo >= tasa_cambio_institucion) & \
+        (sorteo < tasa_cambio_institucion + tasa_cambio_carrera)
+    tramo_inst = np.cumsum((anio_en_carrera == 0) | cambio_inst) - 1
+    inicio_tramo = (anio_en_carrera == 0) | cambio_inst | cambio_carrera
+    tramo_carrera = np.cumsum(inicio_tramo) - 1
+
+    inst_tramo = rng.choice(n_instituciones, tramo_inst[-1] + 1, p=peso_inst)
+    inst_tramo[tramo_inst[anio_en_carrera == 0]] = carrera_inicial // CARRERAS_POR_INSTITUCION
+    carrera_tramo = rng.integers(0, CARRERAS_POR_INSTITUCION, tramo_carrera[-1] + 1)
+    carrera_tramo[tramo_carrera[anio_en_carrera == 0]] = carrera_inicial % CARRERAS_POR_INSTITUCION
+    carrera = inst_tramo[tramo_inst] * CARRERAS_POR_INSTITUCION + carrera_tramo[tramo_carrera]
+    anio_ing_carr_ori = cat_periodo[inicio_tramo][tramo_carrera]
+
+    # Doble matrícula: copia de la fila en una carrera de otra institución, el mismo año
+    doble = rng.random(len(estudiante)) < tasa_doble_matricula
+    otra_inst = (carrera[doble] // CARRERAS_POR_INSTITUCION + rng.integers(1, n_instituciones, doble.sum())) % n_instituciones
+    carrera = np.concatenate([carrera, otra_inst * CARRERAS_POR_INSTITUCION + rng.integers(0, CARRERAS_POR_INSTITUCION, doble.sum())])
+    estudiante = np.concatenate([estudiante, estudiante[doble]])
+    cat_periodo = np.concatenate([cat_periodo, cat_periodo[doble]])
+    anio_ing_carr_ori = np.concatenate([anio_ing_carr_ori, cat_periodo[len(doble):]])
+
+    dentro_rango = (cat_periodo >= anio_inicio) & (cat_periodo <= anio_fin)
+    carrera, estudiante = carrera[dentro_rango], estudiante[dentro_rango]
+    cat_periodo, anio_ing_carr_ori = cat_periodo[dentro_rango], anio_ing_carr_ori[dentro_rango]
+
+    df = pd.DataFrame({
+        'cat_periodo': cat_periodo.astype('int16'),
+        'mrun': estudiante + 1,
+        'nomb_inst': catalogo['nomb_inst'][carrera // CARRERAS_POR_INSTITUCION],
+        'nomb_carrera': catalogo['nomb_carrera'][carrera],
+        'area_conocimiento': catalogo['area_conocimiento'][carrera],
+        'codigo_unico': catalogo['codigo_unico'][carrera],
+        'dur_total_carr': (catalogo['dur_estudio_carr'] + catalogo['dur_proceso_tit'])[carrera].astype('float32'),
+        'cod_inst': catalogo['cod_inst'][carrera // CARRERAS_POR_INSTITUCION],
+        'jornada': catalogo['jornada'][carrera],
+        'dur_estudio_carr': catalogo['dur_estudio_carr'][carrera],
+        'dur_proceso_tit': catalogo['dur_proceso_tit'][carrera],
+        'anio_ing_carr_ori': anio_ing_carr_ori.astype('float32'),
+    })
+
+    # Datos faltantes como en la fuente real (el KPI 5 descarta duraciones nulas y la fuga, años de ingreso nulos)
+    df.loc[rng.random(len(df)) < 0.02, 'dur_total_carr'] = np.nan
+    df.loc[rng.random(len(df)) < 0.01, 'anio_ing_carr_ori'] = np.nan
+    return df.sort_values(by=['cat_periodo', 'mrun'], kind='stable').reset_index(drop=True)
+
+def cargar_matricula_sintetica(df, engine):
+    """Guarda una tabla matricula_AÑO por año y crea la vista unificada y las tablas materializadas."""
+    for anio, df_anio in df.groupby('cat_periodo'):
+        df_anio.to_sql(f'matricula_{anio}', engine, if_exists='replace', index=False, chunksize=100000)
+
+    return create_unified_view(engine=engine)
+
+def crear_base_sintetica(ruta=ARCHIVO_SQLITE, n_filas=100000, **parametros):
+    """Genera la matrícula sintética y la carga en la base SQLite 'ruta'. Devuelve (engine, éxito, mensaje)."""
+    engine = create_engine(f"sqlite:///{ruta}")
+    df = generar_matricula(n_filas=n_filas, **parametros)
+    success, message = cargar_matricula_sintetica(df, engine)
+    return engine, success, f"{len(df)} filas sintéticas en '{ruta}'. {message}"
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Genera matrícula sintética en una base SQLite local.")
+    parser.add_argument('--filas', type=int, default=100000)
+    parser.add_argument('--archivo', default=ARCHIVO_SQLITE)
+    parser.add_argument('--semilla', type=int, default=0)
+    args = parser.parse_args()
+
+    engine, success, message = crear_base_sintetica(args.archivo, n_filas=args.filas, semilla=args.semilla)
+    print(message)
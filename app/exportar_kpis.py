@@ -0,0 +1,122 @@
+#Archivo para las descargas de datos del dashboard: la fuga fila a fila y las tablas de los KPI 1 a 5 de una
+#cohorte, en CSV o Parquet. Los archivos se arman por lotes a medida que se envían (nunca un DataFrame completo
+#de la fuga en memoria), y un semáforo limita las descargas simultáneas para no quitarle conexiones ni CPU
+#a los callbacks del dashboard.
+
+import io
+import os
+import threading
+import pandas as pd
+from queries import (COD_INST_ECAS, iter_fuga_base, kpi1_permanencia_ecas, kpis_destino_fuga, kpi5_titulacion_fuga_estimada)
+from snapshot_kpis import leer_manifest, leer_cohorte
+
+TAMANIO_LOTE_EXPORTACION = int(os.environ.get('ECAS_TAMANIO_LOTE_EXPORTACION', 50000))
+MAX_EXPORTACIONES = int(os.environ.get('ECAS_MAX_EXPORTACIONES', 2))   # Descargas simultáneas por proceso
+
+CONJUNTOS_EXPORTACION = ('fuga', 'kpi1', 'kpi2', 'kpi3', 'kpi4', 'kpi5')
+# Conjuntos que solo existen para ECAS: la fuga fila a fila ('transiciones_ecas') y el KPI 5 (historia de sus fugados)
+CONJUNTOS_SOLO_ECAS = ('fuga', 'kpi5')
+FORMATOS_EXPORTACION = {
+    'csv': 'text/csv; charset=utf-8',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+_exportaciones = threading.BoundedSemaphore(MAX_EXPORTACIONES)
+
+def tomar_turno_exportacion():
+    """Reserva un turno de descarga sin esperar; False si ya hay MAX_EXPORTACIONES en curso."""
+    return _exportaciones.acquire(blocking=False)
+
+def liberar_turno_exportacion():
+    _exportaciones.release()
+
+# ----------------------------------------------------------------------
+# LOTES DE CADA CONJUNTO
+# ----------------------------------------------------------------------
+
+def lotes_conjunto(db_conn, conjunto, anio_n=None, cod_inst=COD_INST_ECAS, tamanio_lote=TAMANIO_LOTE_EXPORTACION):
+    """
+    Lotes (DataFrames) del conjunto pedido para la cohorte anio_n (None = todas) y la institución de origen cod_inst.
+    La fuga se lee por lotes desde la base mientras se envía; las tablas de los KPIs son agregados chicos (del caché
+    por cohorte) y se calculan aquí, antes de responder, así un error no corta una descarga ya empezada.
+    """
+    if conjunto in CONJUNTOS_SOLO_ECAS and cod_inst != COD_INST_ECAS:
+        raise ValueError(f"El conjunto '{conjunto}' solo está disponible para ECAS")
+    if conjunto == 'fuga':
+        return iter_fuga_base(db_conn, anio_n=anio_n, tamanio_lote=tamanio_lote)
+    if conjunto == 'kpi1':
+        df_permanencia, _ = kpi1_permanencia_ecas(db_conn, cod_inst=cod_inst)
+        return [df_permanencia[df_permanencia['Año'] == anio_n] if anio_n else df_permanencia]
+    if conjunto in ('kpi2', 'kpi3', 'kpi4'):
+        return [kpis_destino_fuga(db_conn, anio_n=anio_n, cod_inst=cod_inst)[int(conjunto[-1]) - 1]]
+    if conjunto == 'kpi5':
+        return [kpi5_titulacion_fuga_estimada(db_conn, anio_n=anio_n)[0]]
+    raise ValueError(f"Conjunto de exportación desconocido: {conjunto}")
+
+def lotes_snapshot(conjunto, selected_year):
+    """Tablas de los KPIs de ECAS guardadas en el snapshot (la fuga fila a fila no se guarda en él)."""
+    if conjunto == 'kpi1':
+        df_permanencia = leer_manifest()['df_permanencia_full']
+        return [df_permanencia[df_permanencia['Año'] == selected_year] if selected_year != 'ALL' else df_permanencia]
+    if conjunto in ('kpi2', 'kpi3', 'kpi4', 'kpi5'):
+        return [pd.DataFrame(leer_cohorte(selected_year)[conjunto]['tabla'])]
+    raise ValueError(f"El conjunto '{conjunto}' no está disponible en el snapshot")
+
+# ----------------------------------------------------------------------
+# FORMATOS
+# ----------------------------------------------------------------------
+
+def csv_por_lotes(lotes):
+    """Texto CSV de cada lote a medida que llega; el encabezado va solo en el primero."""
+    encabezado = True
+    for df in lotes:
+        yield df.to_csv(index=False, header=encabezado)
+        encabezado = False
+
+class _SalidaEnMemoria(io.RawIOBase):
+    """Destino del ParquetWriter que solo guarda lo escrito desde el último vaciar()."""
+    def __init__(self):
+        super().__init__()
+        self._partes = []
+        self._posicion = 0
+
+    def writable(self):
+        return True
+
+    def write(self, datos):
+        self._partes.append(bytes(datos))
+        self._posicion += len(datos)
+        return len(datos)
+
+    def tell(self):
+        return self._posicion
+
+    def vaciar(self):
+        datos = b''.join(self._partes)
+        self._partes = []
+        return datos
+
+def _esquema_parquet(tabla):
+    """Esquema del archivo según el primer lote; las columnas que vienen todas nulas se declaran como texto."""
+    import pyarrow as pa
+    return pa.schema([pa.field(campo.name, pa.string()) if pa.types.is_null(campo.type) else campo
+                      for campo in tabla.schema], metadata=tabla.schema.metadata)
+
+def parquet_por_lotes(lotes):
+    """Un archivo Parquet con un row group por lote, entregado en bytes a medida que se escribe cada uno."""
+    # Import diferido: pyarrow solo se necesita al descargar en Parquet, no para levantar el dashboard
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    salida = _SalidaEnMemoria()
+    writer = None
+    try:
+        for df in lotes:
+            if writer is None:
+                esquema = _esquema_parquet(pa.Table.from_pandas(df, preserve_index=False))
+                writer = pq.ParquetWriter(salida, esquema)
+            writer.write_table(pa.Table.from_pandas(df, schema=esquema, preserve_index=False))
+            yield salida.vaciar()
+    finally:
+        if writer is not None:
+            writer.close()
+    yield salida.vaciar()
@@ -0,0 +1,105 @@
+#Archivo para exportar la matrícula unificada a Parquet (una partición por cat_periodo) y preparar
+#la base DuckDB que usan los KPIs cuando FUENTE_DATOS = 'parquet' (ver connector_db.py).
+
+import os
+import shutil
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import text
+from connector_db import CARPETA_PARQUET, ARCHIVO_DUCKDB, get_sqlserver_engine, get_duckdb_engine
+from cache_kpis import actualizar_version_datos
+from views import SELECT_MATRICULA_DEDUPLICADA, SELECT_TRANSICIONES_ECAS
+from queries import guardar_serie_permanencia
+from matriz_transiciones import guardar_matriz_transiciones
+
+CHUNK_SIZE = 200000
+
+# Esquema fijo de los Parquet: las columnas de la vista unificada, sin cat_periodo (va en la ruta de la partición)
+ESQUEMA_MATRICULA = pa.schema([
+    ('mrun', pa.int64()),
+    ('nomb_inst', pa.string()),
+    ('nomb_carrera', pa.string()),
+    ('area_conocimiento', pa.string()),
+    ('codigo_unico', pa.string()),
+    ('dur_total_carr', pa.int16()),
+    ('cod_inst', pa.int32()),
+    ('jornada', pa.string()),
+    ('dur_estudio_carr', pa.int16()),
+    ('dur_proceso_tit', pa.int16()),
+    ('anio_ing_carr_ori', pa.int16()),
+])
+
+def _a_tabla_arrow(df):
+    """Convierte un bloque de la vista al esquema fijo (los textos se normalizan a string)."""
+    df = df[ESQUEMA_MATRICULA.names].copy()
+    for campo in ESQUEMA_MATRICULA:
+        if pa.types.is_string(campo.type):
+            df[campo.name] = df[campo.name].astype('string')
+        else:
+            df[campo.name] = pd.to_numeric(df[campo.name], errors='coerce').astype('Int64')
+    return pa.Table.from_pandas(df, schema=ESQUEMA_MATRICULA, preserve_index=False)
+
+def exportar_parquet(engine_origen, carpeta=CARPETA_PARQUET):
+    """
+    Escribe vista_matriculas_unificada en carpeta/cat_periodo=AÑO/matricula.parquet, por bloques.
+    Cada bloque se ordena por cod_inst para que las estadísticas por row group permitan descartar
+    el resto de instituciones al filtrar por cod_inst. Devuelve la cantidad de filas exportadas.
+    """
+    anios = pd.read_sql("SELECT DISTINCT cat_periodo FROM vista_matriculas_unificada ORDER BY cat_periodo;", engine_origen)['cat_periodo']
+    filas = 0
+
+    for anio in anios:
+        carpeta_anio = os.path.join(carpeta, f'cat_periodo={int(anio)}')
+        if os.path.exists(carpeta_anio):
+            shutil.rmtree(carpeta_anio)
+        os.makedirs(carpeta_anio)
+
+        query = text("SELECT * FROM vista_matriculas_unificada WHERE cat_periodo = :anio;")
+        with pq.ParquetWriter(os.path.join(carpeta_anio, 'matricula.parquet'), ESQUEMA_MATRICULA) as writer:
+            for df in pd.read_sql(query, engine_origen, params={'anio': int(anio)}, chunksize=CHUNK_SIZE):
+                writer.write_table(_a_tabla_arrow(df.sort_values(by=['cod_inst', 'mrun'])))
+                filas += len(df)
+
+        print(f"Año {int(anio)} exportado.")
+
+    return filas
+
+def crear_base_duckdb(carpeta=CARPETA_PARQUET):
+    """
+    Crea la base DuckDB con los mismos nombres que usa queries.py: la vista unificada lee los Parquet
+    (con poda de particiones por cat_periodo) y la matrícula deduplicada, las transiciones y la
+    serie del KPI 1 y la matriz de transiciones se materializan como tablas columnares.
+    """
+    if os.path.exists(ARCHIVO_DUCKDB):
+        os.remove(ARCHIVO_DUCKDB)
+
+    engine = get_duckdb_engine(read_only=False)
+    if not engine:
+        return False, "Error al crear la base DuckDB."
+
+    ruta_parquet = os.path.join(os.path.abspath(carpeta), 'cat_periodo=*', '*.parquet').replace('\\', '/')
+    with engine.begin() as connection:
+        connection.execute(text(f"""
+        CREATE VIEW vista_matriculas_unificada AS
+        SELECT * REPLACE (CAST(cat_periodo AS INTEGER) AS cat_periodo)
+        FROM read_parquet('{ruta_parquet}', hive_partitioning = true);
+        """))
+        connection.execute(text(f"CREATE TABLE matricula_deduplicada AS {SELECT_MATRICULA_DEDUPLICADA} ORDER BY cat_periodo, cod_inst, mrun;"))
+        connection.execute(text(f"CREATE TABLE transiciones_ecas AS {SELECT_TRANSICIONES_ECAS} ORDER BY ANIO_INICIAL, MRUN;"))
+
+    guardar_serie_permanencia(engine)
+    guardar_matriz_transiciones(engine)
+    engine.dispose()
+
+    # Los datos de la fuente 'parquet' cambiaron: invalidar los resultados cacheados de los KPIs
+    actualizar_version_datos()
+    return True, f"Base DuckDB creada en '{ARCHIVO_DUCKDB}'."
+
+if __name__ == '__main__':
+    engine_origen = get_sqlserver_engine()
+    if engine_origen:
+        filas = exportar_parquet(engine_origen)
+        print(f"{filas} filas exportadas a '{CARPETA_PARQUET}'.")
+        success, message = crear_base_duckdb()
+        print(message)
@@ -0,0 +1,168 @@
+#Archivo para medir por etapas cada petición del dashboard: lectura SQL, procesamiento en pandas y
+#construcción de gráficos, con las filas y los bytes en memoria del DataFrame resultante (memory_usage(deep=True),
+#no los bytes transferidos desde la base). Las etapas se agrupan en la traza de la petición
+#en curso (si la hay) y se acumulan en un resumen por proceso que expone el endpoint /metricas.
+
+import contextlib
+import contextvars
+import cProfile
+import functools
+import io
+import os
+import pstats
+import threading
+import time
+from collections import deque
+from datetime import datetime
+import pandas as pd
+
+INSTRUMENTACION_ACTIVA = os.environ.get('ECAS_INSTRUMENTACION', '1') != '0'
+PERFIL_ACTIVO = os.environ.get('ECAS_PERFIL', '0') == '1'   # cProfile por petición (agrega bastante costo)
+CARPETA_PERFILES = 'perfiles'
+MAX_TRAZAS = 50          # Trazas recientes que se muestran en el panel de depuración
+LINEAS_PERFIL = 15       # Funciones del resumen de cProfile (ordenadas por tiempo acumulado)
+
+_traza_actual = contextvars.ContextVar('traza_actual', default=None)
+_profundidad = contextvars.ContextVar('profundidad', default=0)
+_trazas_recientes = deque(maxlen=MAX_TRAZAS)
+_resumen_etapas = {}
+_lock = threading.Lock()
+_lock_perfil = threading.Lock()   # cProfile admite un solo perfilador activo a la vez
+
+def _tamanio(resultado, contar_bytes=False):
+    """(filas, bytes en memoria) del DataFrame de un resultado; en tuplas se usa el primer DataFrame."""
+    if isinstance(resultado, tuple):
+        resultado = next((r for r in resultado if isinstance(r, pd.DataFrame)), None)
+    if not isinstance(resultado, pd.DataFrame):
+        return None, None
+    return len(resultado), int(resultado.memory_usage(index=False, deep=True).sum()) if contar_bytes else None
+
+def _registrar_etapa(registro):
+    with _lock:
+        resumen = _resumen_etapas.setdefault(registro['etapa'], {'n': 0, 'ms_total': 0.0, 'ms_max': 0.0, 'filas': 0, 'bytes_memoria': 0})
+        resumen['n'] += 1
+        resumen['ms_total'] += registro['ms']
+        resumen['ms_max'] = max(resumen['ms_max'], registro['ms'])
+        resumen['filas'] += registro.get('filas') or 0
+        resumen['bytes_memoria'] += registro.get('bytes_memoria') or 0
+
+@contextlib.contextmanager
+def etapa(nombre):
+    """Mide un bloque como una etapa. El bloque puede agregar 'filas' y 'bytes_memoria' al registro que recibe."""
+    registro = {'etapa': nombre}
+    if not INSTRUMENTACION_ACTIVA:
+        yield registro
+        return
+
+    # La etapa se agrega a la traza al comenzar, así las etapas quedan en orden de inicio (con su nivel de anidación)
+    traza = _traza_actual.get()
+    if traza is not None:
+        traza['etapas'].append(registro)
+    registro['nivel'] = _profundidad.get()
+    token = _profundidad.set(registro['nivel'] + 1)
+    inicio = time.perf_counter()
+    try:
+        yield registro
+    finally:
+        registro['ms'] = round(1000 * (time.perf_counter() - inicio), 2)
+        _profundidad.reset(token)
+        _registrar_etapa(registro)
+
+def medir_etapa(nombre, contar_bytes=False):
+    """Decorador: mide la función como la etapa 'nombre' y registra las filas (y bytes en memoria) de su resultado."""
+    def decorador(func):
+        @functools.wraps(func)
+        def envoltura(*args, **kwargs):
+            with etapa(nombre) as registro:
+                resultado = func(*args, **kwargs)
+                if INSTRUMENTACION_ACTIVA:
+                    registro['filas'], registro['bytes_memoria'] = _tamanio(resultado, contar_bytes)
+            return resultado
+        return envoltura
+    return decorador
+
+def leer_sql(nombre, query, db_conn, **kwargs):
+    """pd.read_sql medido como la etapa 'nombre', con las filas y los bytes en memoria del DataFrame leído."""
+    with etapa(nombre) as registro:
+        df = pd.read_sql(query, db_conn, **kwargs)
+        if INSTRUMENTACION_ACTIVA:
+            registro['filas'], registro['bytes_memoria'] = _tamanio(df, contar_bytes=True)
+    return df
+
+def _guardar_perfil(perfil, nombre):
+    """Guarda el perfil en CARPETA_PERFILES y devuelve la ruta y el resumen de las funciones más costosas."""
+    os.makedirs(CARPETA_PERFILES, exist_ok=True)
+    nombre_archivo = f"{nombre.replace(' ', '_')}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.prof"
+    ruta = os.path.join(CARPETA_PERFILES, nombre_archivo)
+    perfil.dump_stats(ruta)
+
+    salida = io.StringIO()
+    pstats.Stats(perfil, stream=salida).sort_stats('cumulative').print_stats(LINEAS_PERFIL)
+    return {'archivo': ruta, 'resumen': salida.getvalue()}
+
+@contextlib.contextmanager
+def traza(nombre, **etiquetas):
+    """
+    Agrupa las etapas de una petición (ej. un callback) y la deja en las trazas recientes.
+    Con PERFIL_ACTIVO además se captura un cProfile de la petición, salvo que otra ya esté perfilando.
+    """
+    registro = {'traza': nombre, **etiquetas, 'inicio': datetime.now().isoformat(timespec='seconds'), 'etapas': []}
+    if not INSTRUMENTACION_ACTIVA:
+        yield registro
+        return
+
+    token = _traza_actual.set(registro)
+    perfil = None
+    if PERFIL_ACTIVO and _lock_perfil.acquire(blocking=False):
+        perfil = cProfile.Profile()
+        perfil.enable()
+
+    inicio = time.perf_counter()
+    try:
+        yield registro
+    finally:
+        registro['ms_total'] = round(1000 * (time.perf_counter() - inicio), 2)
+        if perfil is not None:
+            perfil.disable()
+            _lock_perfil.release()
+            registro['perfil'] = _guardar_perfil(perfil, nombre)
+        _traza_actual.reset(token)
+        with _lock:
+            _trazas_recientes.append(registro)
+
+def trazas_recientes():
+    """Copia de las últimas MAX_TRAZAS trazas del proceso (la más reciente al final)."""
+    with _lock:
+        return list(_trazas_recientes)
+
+def resumen_etapas():
+    """Resumen por etapa: ejecuciones, ms promedio y máximo, filas y bytes en memoria acumulados."""
+    with _lock:
+        return {
+            nombre: {
+                'n': r['n'],
+                'promedio_ms': round(r['ms_total'] / r['n'], 2),
+                'max_ms': round(r['ms_max'], 2),
+                'filas': r['filas'],
+                'bytes_memoria': r['bytes_memoria'],
+            }
+            for nombre, r in sorted(_resumen_etapas.items())
+        }
+
+def metricas_prometheus():
+    """Resumen de etapas en el formato de texto de Prometheus (contadores acumulados desde el inicio del proceso)."""
+    with _lock:
+        resumen = [(nombre, dict(r)) for nombre, r in sorted(_resumen_etapas.items())]
+
+    familias = [
+        ('ecas_etapa_ejecuciones_total', lambda r: r['n']),
+        ('ecas_etapa_segundos_total', lambda r: f"{r['ms_total'] / 1000:.6f}"),
+        ('ecas_etapa_filas_total', lambda r: r['filas']),
+        ('ecas_etapa_bytes_memoria_total', lambda r: r['bytes_memoria']),
+    ]
+    lineas = []
+    for familia, valor in familias:
+        lineas.append(f'# TYPE {familia} counter')
+        for nombre, r in resumen:
+            lineas.append(f'{familia}{{etapa="{nombre}",pid="{os.getpid()}"}} {valor(r)}')
+    return '\n'.join(lineas) + '\n'
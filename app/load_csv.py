@@ -1,42 +1,374 @@
 #Archivo para la carga de los csvs en la base de datos
 
 import pandas as pd
+import hashlib
 import os
-from connecto_db import get_db_engine
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sqlalchemy import text
+from connector_db import get_db_engine
+from cache_kpis import actualizar_version_datos
+from views import create_unified_view
 
-FOLDER_PATH = 'datos' 
+FOLDER_PATH = 'datos'
+CHUNK_SIZE = 100000   # Filas por bloque leído del CSV: acota la memoria máxima por proceso
+MAX_WORKERS = 4       # Archivos anuales que se cargan en paralelo
+PREFIJO_STAGING = 'stg_'
+TABLA_MANIFEST = 'manifest_carga'   # Registro de los archivos cargados: hash, tamaño, mtime y filas por tabla
+BACKEND_CARGA = 'to_sql'            # 'to_sql' (INSERT por lotes) o 'bulk' (archivo de staging + carga masiva nativa)
+CARPETA_STAGING = os.path.abspath('staging')   # Archivos planos para 'bulk'; debe ser legible por SQL Server
+DIALECTOS_BULK = ('mssql', 'duckdb')   # Motores con carga masiva nativa; en SQLite se usa 'to_sql'
+
+# Tipos compactos para las columnas conocidas (nombres en minúscula). Los enteros son "nullable"
+# porque los CSV traen celdas vacías; el resto de columnas conserva el tipo que infiere pandas.
+DTYPES_MATRICULA = {
+    'cat_periodo': 'Int16',
+    'mrun': 'Int32',
+    'cod_inst': 'Int16',
+    'dur_estudio_carr': 'Int8',
+    'dur_proceso_tit': 'Int8',
+    'dur_total_carr': 'Int8',
+    'anio_ing_carr_ori': 'Int16',
+    'nomb_inst': 'category',
+    'nomb_carrera': 'category',
+    'area_conocimiento': 'category',
+    'jornada': 'category',
+}
+
+# Tipos SQL explícitos de las tablas matricula_AÑO; el resto de columnas toma el tipo según su dtype en pandas
+# (TIPOS_SQL_POR_DTYPE) y, si es texto o no se reconoce, TIPO_SQL_POR_DEFECTO
+TIPOS_SQL_MATRICULA = {
+    'cat_periodo': 'SMALLINT',
+    'mrun': 'INT',
+    'cod_inst': 'SMALLINT',
+    'dur_estudio_carr': 'TINYINT',
+    'dur_proceso_tit': 'TINYINT',
+    'dur_total_carr': 'TINYINT',
+    'anio_ing_carr_ori': 'SMALLINT',
+    'codigo_unico': 'NVARCHAR(50)',
+    'nomb_inst': 'NVARCHAR(400)',
+    'nomb_carrera': 'NVARCHAR(400)',
+    'area_conocimiento': 'NVARCHAR(200)',
+    'jornada': 'NVARCHAR(50)',
+}
+TIPOS_SQL_POR_DTYPE = [
+    (pd.api.types.is_bool_dtype, 'BIT'),
+    (pd.api.types.is_integer_dtype, 'BIGINT'),
+    (pd.api.types.is_float_dtype, 'FLOAT'),
+    (pd.api.types.is_datetime64_any_dtype, 'DATETIME2'),
+]
+TIPO_SQL_POR_DEFECTO = 'NVARCHAR(255)'
+# Equivalentes de los tipos de SQL Server en SQLite y DuckDB
+TIPOS_SQL_LOCALES = {'NVARCHAR': 'VARCHAR', 'DATETIME2': 'TIMESTAMP', 'BIT': 'BOOLEAN'}
+
+def get_dtypes_csv(file_path):
+    """Mapea DTYPES_MATRICULA a los nombres de columna tal como vienen en el encabezado del CSV."""
+    columnas = pd.read_csv(file_path, sep=';', nrows=0).columns
+    return {col: DTYPES_MATRICULA[col.lower()] for col in columnas if col.lower() in DTYPES_MATRICULA}
+
+def get_tipo_sql(columna, dtype, dialecto):
+    """Tipo SQL explícito de una columna (evita los NVARCHAR(max) que infiere pandas)."""
+    tipo = TIPOS_SQL_MATRICULA.get(columna)
+    if tipo is None:
+        tipo = next((tipo_dtype for es_dtype, tipo_dtype in TIPOS_SQL_POR_DTYPE if es_dtype(dtype)), TIPO_SQL_POR_DEFECTO)
+    if dialecto != 'mssql':
+        for tipo_mssql, tipo_local in TIPOS_SQL_LOCALES.items():
+            tipo = tipo.replace(tipo_mssql, tipo_local)
+    return tipo
+
+def get_dtypes_muestra(file_path):
+    """dtypes de las columnas (en minúscula) según el primer bloque del CSV, que es el que se carga primero."""
+    df = pd.read_csv(file_path, sep=';', dtype=get_dtypes_csv(file_path), nrows=CHUNK_SIZE)
+    return {col.lower(): dtype for col, dtype in df.dtypes.items()}
+
+def nombre_tabla(connection, nombre):
+    """Nombre de la tabla entre comillas del motor (con el esquema dbo en SQL Server)."""
+    preparer = connection.dialect.identifier_preparer
+    if connection.dialect.name == 'mssql':
+        return f"{preparer.quote_schema('dbo')}.{preparer.quote(nombre)}"
+    return preparer.quote(nombre)
+
+def crear_tabla_staging(connection, staging_name, dtypes):
+    """Crea (o recrea) la tabla de staging con tipos explícitos; dtypes es {columna: dtype de pandas}."""
+    dialecto = connection.dialect.name
+    preparer = connection.dialect.identifier_preparer
+    tabla = nombre_tabla(connection, staging_name)
+    definicion = ',\n        '.join(f'{preparer.quote(col)} {get_tipo_sql(col, dtype, dialecto)}' for col, dtype in dtypes.items())
+
+    if dialecto == 'mssql':
+        connection.execute(text(f"IF OBJECT_ID('dbo.{staging_name}', 'U') IS NOT NULL DROP TABLE {tabla};"))
+    else:
+        connection.execute(text(f"DROP TABLE IF EXISTS {tabla};"))
+    connection.execute(text(f"CREATE TABLE {tabla} (\n        {definicion}\n    );"))
+    return tabla
+
+def leer_csv_por_bloques(file_path):
+    """Itera el CSV en bloques de CHUNK_SIZE filas, con tipos compactos y columnas en minúscula."""
+    for df in pd.read_csv(file_path, sep=';', dtype=get_dtypes_csv(file_path), chunksize=CHUNK_SIZE):
+        df.columns = [col.lower() for col in df.columns]
+        yield df
+
+def cargar_con_to_sql(connection, staging_name, bloques):
+    """Backend 'to_sql': INSERT parametrizados por lotes (fast_executemany en SQL Server)."""
+    filas = 0
+    schema = 'dbo' if connection.dialect.name == 'mssql' else None
+    for df in bloques:
+        df.to_sql(name=staging_name, con=connection, schema=schema, if_exists='append', index=False, chunksize=CHUNK_SIZE)
+        filas += len(df)
+    return filas
+
+def escribir_archivo_staging(bloques, ruta_archivo):
+    """Escribe los bloques ya limpios en un archivo plano para la carga masiva. Devuelve las filas escritas."""
+    filas = 0
+    for i, df in enumerate(bloques):
+        df.to_csv(ruta_archivo, sep=';', index=False, header=(i == 0), mode='w' if i == 0 else 'a',
+                  na_rep='', encoding='utf-8', lineterminator='\n')
+        filas += len(df)
+    return filas
+
+def literal_ruta_staging(ruta_archivo):
+    """
+    Ruta del archivo como literal SQL entre comillas simples, para BULK INSERT y COPY (que no aceptan la
+    ruta como parámetro; se ejecutan con exec_driver_sql para que un ':' de la ruta no se lea como parámetro).
+    Solo se aceptan archivos dentro de CARPETA_STAGING y las comillas se duplican.
+    """
+    ruta = os.path.abspath(ruta_archivo)
+    if os.path.realpath(os.path.dirname(ruta)) != os.path.realpath(CARPETA_STAGING):
+        raise ValueError(f"El archivo '{ruta_archivo}' no está en la carpeta de staging '{CARPETA_STAGING}'.")
+    return "'" + ruta.replace("'", "''") + "'"
+
+def cargar_con_bulk(connection, tabla, bloques, staging_name):
+    """
+    Backend 'bulk': escribe un archivo de staging y lo carga con el mecanismo nativo del motor.
+    SQL Server usa BULK INSERT (la ruta debe ser visible para el servicio de SQL Server) y DuckDB usa COPY.
+    SQLite no tiene carga masiva desde archivo, así que ahí el backend no se ofrece (ver DIALECTOS_BULK).
+    """
+    dialecto = connection.dialect.name
+    if dialecto not in DIALECTOS_BULK:
+        raise ValueError(f"El backend 'bulk' no está disponible para el motor '{dialecto}'.")
+
+    os.makedirs(CARPETA_STAGING, exist_ok=True)
+    ruta_archivo = os.path.join(CARPETA_STAGING, f'{staging_name}.csv')
+    ruta_sql = literal_ruta_staging(ruta_archivo)
+    try:
+        filas = escribir_archivo_staging(bloques, ruta_archivo)
+        if filas == 0:
+            return 0
+
+        if dialecto == 'mssql':
+            connection.exec_driver_sql(f"""
+            BULK INSERT {tabla} FROM {ruta_sql}
+            WITH (FORMAT = 'CSV', FIELDTERMINATOR = ';', ROWTERMINATOR = '0x0a', FIRSTROW = 2, CODEPAGE = '65001', TABLOCK);
+            """)
+        else:
+            connection.exec_driver_sql(f"COPY {tabla} FROM {ruta_sql} (HEADER, DELIMITER ';');")
+    finally:
+        if os.path.exists(ruta_archivo):
+            os.remove(ruta_archivo)
+
+    return filas
+
+def load_csv_to_staging(file_path, table_name, backend=None):
+    """
+    Carga un CSV por bloques en la tabla de staging de 'table_name' usando el backend indicado
+    ('to_sql' o 'bulk'; por defecto BACKEND_CARGA). Se ejecuta en un proceso del pool, por lo que
+    abre su propia conexión. Devuelve (filas cargadas, segundos).
+    """
+    backend = backend or BACKEND_CARGA
+    engine = get_db_engine()
+    if not engine:
+        raise ConnectionError("Error de conexión a la DB.")
+
+    inicio = time.perf_counter()
+    staging_name = f'{PREFIJO_STAGING}{table_name}'
+    dtypes = get_dtypes_muestra(file_path)
+
+    with engine.begin() as connection:
+        tabla = crear_tabla_staging(connection, staging_name, dtypes)
+        if backend == 'bulk':
+            filas = cargar_con_bulk(connection, tabla, leer_csv_por_bloques(file_path), staging_name)
+        elif backend == 'to_sql':
+            filas = cargar_con_to_sql(connection, staging_name, leer_csv_por_bloques(file_path))
+        else:
+            raise ValueError(f"Backend de carga desconocido: '{backend}'.")
+
+    engine.dispose()
+    return filas, time.perf_counter() - inicio
+
+def get_hash_archivo(file_path):
+    """SHA-256 del archivo, leído por bloques para no cargarlo completo en memoria."""
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for bloque in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(bloque)
+    return sha.hexdigest()
+
+def leer_manifest(engine):
+    """Devuelve el manifest de carga como diccionario {table_name: fila}; vacío si aún no existe."""
+    try:
+        df_manifest = pd.read_sql(f"SELECT * FROM {TABLA_MANIFEST};", engine)
+    except Exception:
+        return {}
+    return {fila['table_name']: fila for fila in df_manifest.to_dict('records')}
+
+def guardar_manifest(engine, manifest):
+    df_manifest = pd.DataFrame(list(manifest.values()), columns=['table_name', 'filename', 'sha256', 'size', 'mtime', 'filas'])
+    df_manifest.to_sql(name=TABLA_MANIFEST, con=engine, if_exists='replace', index=False)
+
+def archivos_modificados(archivos, manifest):
+    """
+    Compara cada CSV con el manifest y devuelve (archivos a cargar, manifest actualizado).
+    Si el tamaño y el mtime coinciden el archivo se da por igual sin calcular el hash; si solo
+    cambió el mtime pero el hash es el mismo, se actualiza el mtime y tampoco se recarga.
+    """
+    a_cargar = {}
+    manifest = dict(manifest)
+
+    for filename, table_name in archivos.items():
+        file_path = os.path.join(FOLDER_PATH, filename)
+        stat = os.stat(file_path)
+        registro = manifest.get(table_name)
+
+        if registro and registro['filename'] == filename and registro['size'] == stat.st_size and registro['mtime'] == stat.st_mtime:
+            continue
+
+        sha256 = get_hash_archivo(file_path)
+        if registro and registro['filename'] == filename and registro['sha256'] == sha256:
+            manifest[table_name] = {**registro, 'size': stat.st_size, 'mtime': stat.st_mtime}
+            continue
+
+        a_cargar[filename] = table_name
+        manifest[table_name] = {'table_name': table_name, 'filename': filename, 'sha256': sha256,
+                                'size': stat.st_size, 'mtime': stat.st_mtime, 'filas': None}
+
+    return a_cargar, manifest
+
+def swap_staging_tables(engine, table_names, eliminadas=()):
+    """
+    Reemplaza cada tabla 'matricula_AÑO' por su staging y elimina las de 'eliminadas' (su CSV ya no está
+    en FOLDER_PATH), todo en una sola transacción.
+    """
+    with engine.begin() as connection:
+        if connection.dialect.name == 'sqlite':
+            # SQLite valida las vistas al renombrar una tabla y la vista unificada apunta a las tablas que se
+            # reemplazan; se elimina aquí y create_unified_view la vuelve a crear a continuación
+            connection.execute(text("DROP VIEW IF EXISTS vista_matriculas_unificada;"))
+        for table_name in eliminadas:
+            tabla = nombre_tabla(connection, table_name)
+            if connection.dialect.name == 'mssql':
+                connection.execute(text(f"IF OBJECT_ID('dbo.{table_name}', 'U') IS NOT NULL DROP TABLE {tabla};"))
+            else:
+                connection.execute(text(f"DROP TABLE IF EXISTS {tabla};"))
+        for table_name in table_names:
+            tabla = nombre_tabla(connection, table_name)
+            if connection.dialect.name == 'mssql':
+                connection.execute(text(f"IF OBJECT_ID('dbo.{table_name}', 'U') IS NOT NULL DROP TABLE {tabla};"))
+                connection.execute(text(f"EXEC sp_rename 'dbo.{PREFIJO_STAGING}{table_name}', '{table_name}';"))
+            else:
+                connection.execute(text(f"DROP TABLE IF EXISTS {tabla};"))
+                connection.execute(text(f"ALTER TABLE {nombre_tabla(connection, PREFIJO_STAGING + table_name)} RENAME TO {tabla};"))
+
+def load_all_csv_to_sql(forzar=False, backend=None):
+    """
+    Carga en la DB los CSV nuevos o modificados de FOLDER_PATH (todos si forzar=True) y elimina las tablas
+    cuyo CSV ya no está. La vista unificada, las tablas materializadas y el caché solo se actualizan si alguna
+    tabla cambió. El manifest se guarda recién cuando la vista quedó reconstruida: si algo falla antes, la
+    próxima carga vuelve a detectar los mismos cambios y reintenta.
+    backend elige el método de carga ('to_sql' o 'bulk'); por defecto se usa BACKEND_CARGA.
+    """
 
-def load_all_csv_to_sql():
-   
     engine = get_db_engine()
     if not engine:
         return False, "Error de conexión a la DB."
 
-    cargados = 0
+    if (backend or BACKEND_CARGA) == 'bulk' and engine.dialect.name not in DIALECTOS_BULK:
+        return False, f"El backend 'bulk' no está disponible para el motor '{engine.dialect.name}'; usa 'to_sql'."
 
     if not os.path.exists(FOLDER_PATH):
         return False, f"La carpeta '{FOLDER_PATH}' no existe."
-        
+
+    archivos = {}
     for filename in os.listdir(FOLDER_PATH):
         if filename.endswith(".csv"):
-            file_path = os.path.join(FOLDER_PATH, filename)
-            try:
-                año = filename.split('_')[-1].replace('.csv', '')
-                table_name = f'matricula_{año}'
+            año = filename.split('_')[-1].replace('.csv', '')
+            archivos[filename] = f'matricula_{año}'
+
+    manifest_guardado = leer_manifest(engine)
+    manifest_anterior = {} if forzar else manifest_guardado
+    a_cargar, manifest = archivos_modificados(archivos, manifest_anterior)
 
-                df = pd.read_csv(file_path, sep=';')
-                df.columns = [col.lower() for col in df.columns]
+    # Tablas cargadas antes cuyo CSV se eliminó de la carpeta: salen del manifest y de la vista
+    eliminadas = sorted(t for t in manifest_guardado if t not in archivos.values())
+    for table_name in eliminadas:
+        manifest.pop(table_name, None)
+        print(f"{table_name}: su CSV ya no está en '{FOLDER_PATH}', se elimina la tabla.")
 
-                # Cargar el DataFrame a SQL Server
-                df.to_sql(name=table_name, con=engine, if_exists='replace', index=False, schema='dbo', chunksize=100000)
-                cargados += 1
+    if not a_cargar and not eliminadas:
+        guardar_manifest(engine, manifest)
+        return True, "Sin cambios: todas las tablas están al día."
 
+    inicio = time.perf_counter()
+    cargadas = []
+    errores = []
+    filas_totales = 0
+
+    # Cada archivo anual se carga en paralelo a su tabla de staging; un error no detiene al resto
+    with ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futuros = {
+            executor.submit(load_csv_to_staging, os.path.join(FOLDER_PATH, filename), table_name, backend): filename
+            for filename, table_name in a_cargar.items()
+        }
+        for futuro in as_completed(futuros):
+            filename = futuros[futuro]
+            try:
+                filas, segundos = futuro.result()
             except Exception as e:
                 print(f"ERROR DE CARGA: Falló el archivo {filename}: {e}")
-                return False, f"Error al cargar {filename}. Revisa el formato CSV."
-                
-    return True, f"Carga masiva completada. {cargados} tablas cargadas."
+                errores.append(filename)
+                # Se conserva el registro anterior para reintentar el archivo en la próxima carga
+                table_name = a_cargar[filename]
+                if table_name in manifest_anterior:
+                    manifest[table_name] = manifest_anterior[table_name]
+                else:
+                    manifest.pop(table_name, None)
+                continue
+
+            cargadas.append(a_cargar[filename])
+            manifest[a_cargar[filename]]['filas'] = filas
+            filas_totales += filas
+            print(f"{filename}: {filas} filas en {segundos:.1f} s ({filas / max(segundos, 1e-9):,.0f} filas/s).")
+
+    # Las tablas definitivas se reemplazan (y las eliminadas se borran) todas juntas al final
+    if cargadas or eliminadas:
+        try:
+            swap_staging_tables(engine, cargadas, eliminadas)
+        except Exception as e:
+            return False, f"ERROR al reemplazar las tablas de staging: {e}"
+
+    segundos_totales = time.perf_counter() - inicio
+    print(f"Total: {filas_totales} filas en {segundos_totales:.1f} s ({filas_totales / max(segundos_totales, 1e-9):,.0f} filas/s).")
+
+    # Los datos cambiaron: invalidar los resultados cacheados de los KPIs y
+    # reconstruir la vista unificada junto con sus tablas materializadas
+    # Si solo se agregó el año más reciente, la serie del KPI 1 se actualiza de forma incremental
+    if cargadas or eliminadas:
+        anio_nuevo = None
+        anios_anteriores = [int(t.split('_')[-1]) for t in manifest_anterior]
+        if len(cargadas) == 1 and not eliminadas and cargadas[0] not in manifest_anterior and anios_anteriores:
+            anio_cargado = int(cargadas[0].split('_')[-1])
+            if anio_cargado > max(anios_anteriores):
+                anio_nuevo = anio_cargado
+
+        actualizar_version_datos()
+        success, message = create_unified_view(anio_nuevo=anio_nuevo)
+        if not success:
+            return False, message
+        guardar_manifest(engine, manifest)
+
+    if errores:
+        return False, f"Carga parcial: {len(cargadas)} tablas cargadas. Fallaron: {', '.join(sorted(errores))}. Revisa el formato CSV."
+    return True, f"Carga masiva completada. {len(cargadas)} tablas cargadas, {len(eliminadas)} eliminadas."
 
 if __name__ == '__main__':
     success, message = load_all_csv_to_sql()
-    print(message)
\ No newline at end of file
+    print(message)
@@ -0,0 +1,162 @@
+#Archivo para la matrícula en memoria, compacta y compartida por el proceso (un worker de Dash).
+#Los textos se guardan como categorías, la jornada como bandera booleana, los años como int32 y los MRUN
+#como ids enteros densos; las filas quedan ordenadas por (ANIO, MRUN_ID, codigo_unico) con el rango de filas
+#de cada año, así la primera fila de cada estudiante en un año es la misma que elige la deduplicación en SQL.
+#El motor de trayectorias (trayectorias.py) se arma sobre este mismo almacén, sin volver a leer la vista.
+
+import threading
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+from cache_kpis import version_datos
+from instrumentacion import medir_etapa
+from queries import COD_INST_ECAS, DURACION_DIURNA_SEMESTRES, DURACION_VESPERTINA_SEMESTRES
+
+CHUNK_SIZE = 200000
+COD_INST_NULO = -1   # cod_inst nulo: la fila cuenta como primera del año, pero no es origen ni destino de fuga (como en SQL)
+COLUMNAS_TEXTO = ['nomb_inst', 'nomb_carrera', 'area_conocimiento', 'codigo_unico']
+
+QUERY_MATRICULA = """
+SELECT
+    cat_periodo, mrun, cod_inst, nomb_inst, nomb_carrera, area_conocimiento,
+    codigo_unico, jornada, anio_ing_carr_ori, CAST(dur_total_carr AS INT) AS duracion
+FROM
+    vista_matriculas_unificada;
+"""
+
+_almacenes = {}
+_lock = threading.Lock()
+
+def _compactar_bloque(df):
+    """
+    Convierte un bloque leído de la DB a los tipos compactos (la jornada pasa a la bandera VESPERTINA).
+    Las filas sin año o sin MRUN se descartan: en SQL tampoco cruzan en ningún join de año a año.
+    """
+    df = df[df['cat_periodo'].notna() & df['mrun'].notna()]
+    bloque = {
+        'ANIO': df['cat_periodo'].astype('int32'),
+        'mrun': df['mrun'].astype('int64'),
+        'cod_inst': df['cod_inst'].fillna(COD_INST_NULO).astype('int32'),
+        'VESPERTINA': df['jornada'].str.contains('Vespertino', na=False),
+        'anio_ing_carr_ori': pd.to_numeric(df['anio_ing_carr_ori'], errors='coerce').astype('float32'),
+        'duracion': pd.to_numeric(df['duracion'], errors='coerce').fillna(-1).astype('int16'),   # -1 = duración nula
+    }
+    for columna in COLUMNAS_TEXTO:
+        bloque[columna] = df[columna].astype('string').astype('category')
+    # codigo_unico conserva su tipo si es numérico, para que el orden de sus categorías sea el mismo de SQL
+    if pd.api.types.is_numeric_dtype(df['codigo_unico']):
+        bloque['codigo_unico'] = df['codigo_unico'].astype('float64').astype('category')
+    return pd.DataFrame(bloque)
+
+@medir_etapa('memoria.carga')
+def cargar_matricula_memoria(db_conn):
+    """
+    Lee la vista unificada por bloques y arma el almacén compacto:
+    {'df': filas ordenadas por (ANIO, MRUN_ID, codigo_unico), 'mruns': MRUN original de cada id, 'rangos': {año: (inicio, fin)}}.
+    """
+    bloques = [_compactar_bloque(df) for df in pd.read_sql(QUERY_MATRICULA, db_conn, chunksize=CHUNK_SIZE)]
+    if not bloques:
+        return {'df': pd.DataFrame(), 'mruns': np.array([], dtype='int64'), 'rangos': {}}
+
+    # Las categorías se unen columna por columna para no volver a texto (object) al concatenar
+    columnas = {}
+    for columna in bloques[0].columns:
+        if columna in COLUMNAS_TEXTO:
+            columnas[columna] = union_categoricals([b[columna] for b in bloques], sort_categories=True)
+        else:
+            columnas[columna] = np.concatenate([b[columna].to_numpy() for b in bloques])
+    del bloques
+
+    # MRUN -> id denso (np.unique ordena, así el orden por id es el mismo que por MRUN)
+    mruns, mrun_id = np.unique(columnas.pop('mrun'), return_inverse=True)
+    columnas['MRUN_ID'] = mrun_id.astype('int32')
+
+    df = pd.DataFrame(columnas)
+    # Las categorías de codigo_unico están ordenadas y el nulo tiene código -1: queda primero, como en SQL
+    orden = np.lexsort((df['codigo_unico'].cat.codes.to_numpy(), df['MRUN_ID'].to_numpy(), df['ANIO'].to_numpy()))
+    df = df.iloc[orden].reset_index(drop=True)
+
+    anios = np.unique(df['ANIO'].to_numpy())
+    inicios = np.searchsorted(df['ANIO'].to_numpy(), anios, side='left')
+    fines = np.searchsorted(df['ANIO'].to_numpy(), anios, side='right')
+    rangos = {int(anio): (int(inicio), int(fin)) for anio, inicio, fin in zip(anios, inicios, fines)}
+
+    return {'df': df, 'mruns': mruns, 'rangos': rangos}
+
+def get_matricula_memoria(db_conn):
+    """Devuelve el almacén del proceso, cargándolo una sola vez por versión de los datos."""
+    clave = (str(getattr(db_conn, 'url', '')), version_datos())
+    with _lock:
+        if clave not in _almacenes:
+            _almacenes.clear()   # Una versión nueva de los datos reemplaza a la anterior
+            _almacenes[clave] = cargar_matricula_memoria(db_conn)
+        return _almacenes[clave]
+
+def filas_anio(almacen, anio):
+    """Matrícula de un año como vista de las filas contiguas del almacén (sin recorrer los demás años)."""
+    inicio, fin = almacen['rangos'].get(int(anio), (0, 0))
+    return almacen['df'].iloc[inicio:fin]
+
+def _primeras_filas(df):
+    """Primera fila de cada MRUN_ID (las filas de un año ya vienen ordenadas por MRUN_ID y codigo_unico)."""
+    ids = df['MRUN_ID'].to_numpy()
+    return df[np.concatenate([[True], ids[1:] != ids[:-1]])] if len(ids) else df
+
+def _fuga_anio(almacen, anio):
+    """
+    Fugados de ECAS entre anio y anio + 1, con las mismas columnas que QUERY_FUGA: el origen es la primera
+    fila de ECAS del estudiante en N y el destino su primera fila en N+1, como en 'transiciones_ecas'.
+    """
+    df_n = filas_anio(almacen, anio)
+    df_n_mas_1 = _primeras_filas(filas_anio(almacen, anio + 1))
+    if df_n.empty or df_n_mas_1.empty:
+        return None
+
+    # Origen: ECAS en el año N, sin haber cumplido la duración teórica (diurna o vespertina)
+    df_n = _primeras_filas(df_n[df_n['cod_inst'].to_numpy() == COD_INST_ECAS])
+    duracion_teorica = np.where(df_n['VESPERTINA'].to_numpy(), DURACION_VESPERTINA_SEMESTRES, DURACION_DIURNA_SEMESTRES)
+    dentro_duracion = (anio - df_n['anio_ing_carr_ori'].to_numpy()) * 2 < duracion_teorica
+    origen = df_n[dentro_duracion]
+
+    # Destino: ambos años están ordenados por MRUN_ID, así que el cruce es una búsqueda binaria
+    ids_destino = df_n_mas_1['MRUN_ID'].to_numpy()
+    posiciones = np.searchsorted(ids_destino, origen['MRUN_ID'].to_numpy())
+    posiciones = np.minimum(posiciones, len(ids_destino) - 1)
+    encontrados = ids_destino[posiciones] == origen['MRUN_ID'].to_numpy()
+
+    origen = origen[encontrados]
+    destino = df_n_mas_1.iloc[posiciones[encontrados]]
+    # Un destino con cod_inst nulo no cuenta como fuga: en SQL 'COD_INST_DESTINO <> ECAS' es desconocido para NULL
+    cod_inst_destino = destino['cod_inst'].to_numpy()
+    es_fuga = (cod_inst_destino != COD_INST_ECAS) & (cod_inst_destino != COD_INST_NULO)
+    origen, destino = origen[es_fuga], destino[es_fuga]
+
+    return pd.DataFrame({
+        'MRUN': almacen['mruns'][origen['MRUN_ID'].to_numpy()],
+        'INST_ORIGEN': origen['nomb_inst'].astype(object).to_numpy(),
+        'CARRERA_ORIGEN': origen['nomb_carrera'].astype(object).to_numpy(),
+        'AREA_ORIGEN': origen['area_conocimiento'].astype(object).to_numpy(),
+        'COD_INST_DESTINO': destino['cod_inst'].to_numpy().astype('int64'),
+        'INST_DESTINO': destino['nomb_inst'].astype(object).to_numpy(),
+        'CARRERA_DESTINO': destino['nomb_carrera'].astype(object).to_numpy(),
+        'AREA_DESTINO': destino['area_conocimiento'].astype(object).to_numpy(),
+        'ANIO_INICIAL': np.full(len(origen), anio, dtype='int64'),
+    })
+
+@medir_etapa('memoria.fuga')
+def calcular_fuga_memoria(almacen, anio_n=None):
+    """Fuga de la cohorte anio_n (None = todas) sobre el almacén; mismo resultado que get_df_fuga_base en SQL."""
+    anios = [int(anio_n)] if anio_n else sorted(almacen['rangos'])
+    partes = [parte for parte in (_fuga_anio(almacen, anio) for anio in anios) if parte is not None]
+
+    cols_fuga = ['MRUN', 'INST_ORIGEN', 'CARRERA_ORIGEN', 'AREA_ORIGEN',
+                 'COD_INST_DESTINO', 'INST_DESTINO', 'CARRERA_DESTINO', 'AREA_DESTINO', 'ANIO_INICIAL']
+    if not partes:
+        return pd.DataFrame(columns=cols_fuga)
+
+    # Cada parte ya viene ordenada por MRUN (orden de los ids), y los años se recorren en orden
+    return pd.concat(partes, ignore_index=True)[cols_fuga]
+
+def uso_memoria(almacen):
+    """Bytes que ocupa el almacén (incluye diccionarios de las categorías y el arreglo de MRUN)."""
+    return int(almacen['df'].memory_usage(deep=True).sum() + almacen['mruns'].nbytes)
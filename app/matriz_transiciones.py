@@ -0,0 +1,204 @@
+#Archivo para la matriz de transiciones entre instituciones: MRUN distintos por (año N, institución de origen,
+#institución, carrera y área de destino en N+1). Se calcula en una sola pasada por la vista unificada y se guarda
+#en la tabla 'matriz_transiciones'; el dashboard la carga una vez por proceso, así que cambiar de institución o de
+#cohorte es una búsqueda en la matriz y no una nueva lectura de la matrícula.
+
+import threading
+import numpy as np
+import pandas as pd
+from sqlalchemy import inspect, text
+from cache_kpis import version_datos
+from instrumentacion import leer_sql, medir_etapa
+from queries import DURACION_DIURNA_SEMESTRES, DURACION_VESPERTINA_SEMESTRES
+
+TABLA_MATRIZ_TRANSICIONES = 'matriz_transiciones'
+CHUNK_SIZE = 200000
+
+QUERY_MATRICULA_UNIFICADA = """
+SELECT
+    cat_periodo, mrun, cod_inst, nomb_inst, nomb_carrera, area_conocimiento,
+    codigo_unico, jornada, anio_ing_carr_ori
+FROM
+    vista_matriculas_unificada
+{filtro_anios}
+ORDER BY cat_periodo;
+"""
+
+COLUMNAS_MATRIZ = ['ANIO_INICIAL', 'COD_INST_ORIGEN', 'INST_ORIGEN', 'AREA_ORIGEN', 'DENTRO_DURACION', 'PERMANECE',
+                   'COD_INST_DESTINO', 'INST_DESTINO', 'CARRERA_DESTINO', 'AREA_DESTINO']
+
+_matrices = {}
+_lock = threading.Lock()
+
+def transiciones_par(df_n, df_n_mas_1, anio):
+    """
+    Transiciones anio -> anio + 1 de todas las instituciones, agregadas en N_MRUN.
+    Es la misma regla de 'transiciones_ecas' aplicada a cada institución de origen: el estudiante cuenta en cada
+    institución donde tiene matrícula en N (fila de menor codigo_unico) y su destino es su primera fila de N+1
+    (menor codigo_unico, nulos primero; destino nulo si no tiene matrícula). PERMANECE indica si en N+1 tiene alguna
+    matrícula en la institución de origen, que es lo que cuenta la permanencia (KPI 1) aunque el destino sea otra.
+    """
+    df_n = df_n.sort_values(by='codigo_unico', kind='stable', na_position='first')
+    df_n_mas_1 = df_n_mas_1.sort_values(by='codigo_unico', kind='stable', na_position='first')
+
+    # Sin cod_inst no hay institución de origen (la fila sigue contando como destino de los demás)
+    origen = df_n[df_n['cod_inst'].notna()].drop_duplicates(subset=['mrun', 'cod_inst'])
+    duracion_teorica = np.where(origen['jornada'].str.contains('Vespertino', na=False),
+                                DURACION_VESPERTINA_SEMESTRES, DURACION_DIURNA_SEMESTRES)
+    origen = pd.DataFrame({
+        'mrun': origen['mrun'].to_numpy(),
+        'COD_INST_ORIGEN': origen['cod_inst'].to_numpy(),
+        'INST_ORIGEN': origen['nomb_inst'].to_numpy(),
+        'AREA_ORIGEN': origen['area_conocimiento'].to_numpy(),
+        'DENTRO_DURACION': ((anio - origen['anio_ing_carr_ori'].to_numpy()) * 2 < duracion_teorica).astype('int8'),
+    })
+
+    # Permanece: alguna matrícula en la misma institución en N+1
+    presentes = df_n_mas_1[['mrun', 'cod_inst']].drop_duplicates().rename(columns={'cod_inst': 'COD_INST_ORIGEN'})
+    origen = origen.merge(presentes, on=['mrun', 'COD_INST_ORIGEN'], how='left', indicator=True)
+    origen['PERMANECE'] = (origen.pop('_merge') == 'both').astype('int8')
+
+    # Destino: primera fila de N+1 (o ninguna)
+    columnas_destino = {'cod_inst': 'COD_INST_DESTINO', 'nomb_inst': 'INST_DESTINO',
+                        'nomb_carrera': 'CARRERA_DESTINO', 'area_conocimiento': 'AREA_DESTINO'}
+    destino = df_n_mas_1[['mrun'] + list(columnas_destino)].rename(columns=columnas_destino).drop_duplicates(subset='mrun')
+
+    transiciones = origen.merge(destino, on='mrun', how='left')
+    transiciones['ANIO_INICIAL'] = int(anio)
+    return transiciones.groupby(COLUMNAS_MATRIZ, dropna=False).size().reset_index(name='N_MRUN')
+
+@medir_etapa('matriz.calculo')
+def calcular_matriz_transiciones(db_conn, anio_desde=None, anio_hasta=None):
+    """
+    Lee la vista unificada una sola vez, ordenada por año y por bloques, y agrega cada par de años consecutivos
+    apenas se completa el segundo. En memoria solo quedan los dos años del par en curso.
+    """
+    params = {}
+    filtro_anios = ""
+    if anio_desde is not None and anio_hasta is not None:
+        filtro_anios = "WHERE cat_periodo BETWEEN :anio_desde AND :anio_hasta"
+        params = {'anio_desde': int(anio_desde), 'anio_hasta': int(anio_hasta)}
+
+    query = text(QUERY_MATRICULA_UNIFICADA.format(filtro_anios=filtro_anios))
+    partes = []
+    anterior = None     # (año, matrícula) del último año completo
+    en_curso = []       # Bloques del año que se está leyendo
+
+    def cerrar_anio(bloques):
+        nonlocal anterior
+        df_anio = pd.concat(bloques, ignore_index=True)
+        anio = int(df_anio['cat_periodo'].iloc[0])
+        if anterior is not None and anterior[0] + 1 == anio:
+            partes.append(transiciones_par(anterior[1], df_anio, anterior[0]))
+        anterior = (anio, df_anio)
+
+    for df in pd.read_sql(query, db_conn, params=params, chunksize=CHUNK_SIZE):
+        # Sin año o sin MRUN la fila no cruza con el año siguiente (en SQL los NULL no hacen match en el join)
+        df = df[df['cat_periodo'].notna() & df['mrun'].notna()].astype({'cat_periodo': 'int64'})
+        for anio, df_anio in df.groupby('cat_periodo', sort=True):
+            if en_curso and int(en_curso[0]['cat_periodo'].iloc[0]) != anio:
+                cerrar_anio(en_curso)
+                en_curso = []
+            en_curso.append(df_anio)
+    if en_curso:
+        cerrar_anio(en_curso)
+
+    if not partes:
+        return pd.DataFrame(columns=COLUMNAS_MATRIZ + ['N_MRUN'])
+    return pd.concat(partes, ignore_index=True)
+
+def guardar_matriz_transiciones(db_conn, anio_nuevo=None):
+    """
+    Si anio_nuevo es None recalcula y reemplaza la matriz completa; si no, solo agrega el par
+    (anio_nuevo - 1 -> anio_nuevo), como guardar_serie_permanencia. Quien llame debe actualizar la versión de datos.
+    """
+    if anio_nuevo is None:
+        df_matriz = calcular_matriz_transiciones(db_conn)
+        df_matriz.to_sql(TABLA_MATRIZ_TRANSICIONES, db_conn, if_exists='replace', index=False, chunksize=100000)
+        return df_matriz
+
+    if not _tabla_vigente(db_conn):
+        # Sin tabla (o con la de una versión anterior, sin PERMANECE) no hay a qué agregar el par: se recalcula completa
+        return guardar_matriz_transiciones(db_conn)
+
+    df_nuevo_par = calcular_matriz_transiciones(db_conn, anio_desde=anio_nuevo - 1, anio_hasta=anio_nuevo)
+    with db_conn.connect() as connection:
+        connection.execute(text(f"DELETE FROM {TABLA_MATRIZ_TRANSICIONES} WHERE ANIO_INICIAL = :anio;"), {'anio': int(anio_nuevo) - 1})
+        df_nuevo_par.to_sql(TABLA_MATRIZ_TRANSICIONES, connection, if_exists='append', index=False, chunksize=100000)
+        connection.commit()
+
+    return df_nuevo_par
+
+def _tabla_vigente(db_conn):
+    """True si la tabla de la matriz existe y tiene todas las columnas de COLUMNAS_MATRIZ."""
+    inspector = inspect(db_conn)
+    if not inspector.has_table(TABLA_MATRIZ_TRANSICIONES):
+        return False
+    return set(COLUMNAS_MATRIZ) <= {c['name'] for c in inspector.get_columns(TABLA_MATRIZ_TRANSICIONES)}
+
+def cargar_matriz(db_conn):
+    """
+    Matriz indexada por institución de origen: {'por_institucion': {cod_inst: filas ordenadas por año}, 'instituciones': df}.
+    Si la tabla no existe o es de una versión anterior lanza RuntimeError: calcularla desde la vista unificada
+    recorre toda la matrícula y no debe ocurrir dentro de una petición del dashboard.
+    """
+    if not _tabla_vigente(db_conn):
+        raise RuntimeError(f"La tabla '{TABLA_MATRIZ_TRANSICIONES}' no existe o no está al día; "
+                           "se genera con views.py (create_unified_view).")
+    df_matriz = leer_sql('sql.matriz_transiciones', f"SELECT * FROM {TABLA_MATRIZ_TRANSICIONES};", db_conn)
+    df_matriz = df_matriz.dropna(subset=['COD_INST_ORIGEN'])   # Tablas guardadas antes de descartar los orígenes nulos
+
+    df_matriz = df_matriz.sort_values(by=['COD_INST_ORIGEN', 'ANIO_INICIAL'], kind='stable')
+    # Nombre vigente de cada institución: el de su año más reciente
+    instituciones = (df_matriz.drop_duplicates(subset='COD_INST_ORIGEN', keep='last')[['COD_INST_ORIGEN', 'INST_ORIGEN']]
+                     .sort_values(by='INST_ORIGEN').reset_index(drop=True))
+    return {
+        'por_institucion': {int(cod): df.reset_index(drop=True) for cod, df in df_matriz.groupby('COD_INST_ORIGEN')},
+        'instituciones': instituciones,
+    }
+
+def get_matriz_transiciones(db_conn):
+    """Devuelve la matriz del proceso, cargándola una sola vez por versión de los datos."""
+    clave = (str(getattr(db_conn, 'url', '')), version_datos())
+    with _lock:
+        if clave not in _matrices:
+            _matrices.clear()
+            _matrices[clave] = cargar_matriz(db_conn)
+        return _matrices[clave]
+
+def filas_institucion(matriz, cod_inst, anio_n=None):
+    """Transiciones con origen en cod_inst (de la cohorte anio_n, o de todas)."""
+    df = matriz['por_institucion'].get(int(cod_inst))
+    if df is None:
+        return pd.DataFrame(columns=COLUMNAS_MATRIZ + ['N_MRUN'])
+    if anio_n:
+        anios = df['ANIO_INICIAL'].to_numpy()
+        return df.iloc[np.searchsorted(anios, int(anio_n), side='left'):np.searchsorted(anios, int(anio_n), side='right')]
+    return df
+
+def permanencia_matriz(matriz, cod_inst):
+    """Serie de permanencia de cod_inst con las columnas de calcular_permanencia (año N -> N+1)."""
+    df = filas_institucion(matriz, cod_inst)
+    iniciales = df.groupby('ANIO_INICIAL')['N_MRUN'].sum()
+    permanecen = df[df['PERMANECE'] == 1].groupby('ANIO_INICIAL')['N_MRUN'].sum()
+
+    df_permanencia = pd.DataFrame({
+        'Año': iniciales.index.astype('int64'),
+        'Estudiantes_Iniciales_ECAS': iniciales.to_numpy(),
+        'Estudiantes_Permanecen_ECAS': permanecen.reindex(iniciales.index, fill_value=0).to_numpy(),
+    })
+    df_permanencia['Tasa_Permanencia_ECAS'] = (
+        df_permanencia['Estudiantes_Permanecen_ECAS'] / df_permanencia['Estudiantes_Iniciales_ECAS'] * 100
+    ).round(2)
+    return df_permanencia
+
+def fuga_matriz(matriz, cod_inst, anio_n=None):
+    """
+    Fuga agregada de cod_inst: estudiantes dentro de la duración teórica que en N+1 están en otra institución,
+    con N_MRUN por destino. La matriz guarda conteos por cohorte, así que con anio_n=None se suman las cohortes
+    (quien se fuga en dos cohortes cuenta en ambas, a diferencia de ECAS, que cuenta MRUN distintos): el dashboard
+    lo rotula como "suma de cohortes".
+    """
+    df = filas_institucion(matriz, cod_inst, anio_n)
+    df = df[(df['DENTRO_DURACION'] == 1) & df['COD_INST_DESTINO'].notna() & (df['COD_INST_DESTINO'] != cod_inst)]
+    return df.reset_index(drop=True)
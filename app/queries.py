@@ -1,54 +1,130 @@
 #Archivo para realizar consultas SQL que nos entreguen dataframes personalizados
 #por cada KPI
+import os
+import uuid
+from contextlib import nullcontext
 import pandas as pd
 from connector_db import get_db_engine
+from cache_kpis import cache_por_cohorte
+from instrumentacion import etapa, leer_sql, medir_etapa
+from sqlalchemy import Connection, inspect, text
 import numpy as np
 
 COD_INST_ECAS = 104
 DURACION_DIURNA_SEMESTRES = 8  # 4 años
 DURACION_VESPERTINA_SEMESTRES = 9 # 4.5 años
 
-#KPI 1: Tasa de permanencia de los estudiantes año a año.
-def kpi1_permanencia_ecas(db_conn, anio=None):
-    """
-    Calcula el porcentaje de permanencia dentro de ECAS (COD_INST = 104) usando la vista unificada.
-    """
+TABLA_SERIE_PERMANENCIA = 'serie_permanencia_ecas'
+
+# Cómo se entregan los fugados a la consulta de historia del KPI 5 ('subconsulta', 'tabla_temporal' o 'lista_in',
+# ver _leer_historia_fugados). Por defecto la subconsulta: una sola sentencia con parámetros fijos, que SQL Server
+# compila una vez y reutiliza. La lista IN de literales es opcional y solo para bases locales (SQLite/DuckDB): en
+# SQL Server cada lista distinta es un plan nuevo en el caché y las listas largas no compilan (error 8623).
+ESTRATEGIA_HISTORIA_FUGADOS = os.environ.get('ECAS_ESTRATEGIA_HISTORIA_FUGADOS', 'subconsulta')
+MAX_LISTA_IN = int(os.environ.get('ECAS_MAX_LISTA_IN', 5000))
+
+# Motor de la fuga base: 'sql' (lee 'transiciones_ecas'), 'pandas' (calcular_fuga sobre la matrícula de la cohorte
+# leída de la vista, sin tablas materializadas) o 'memoria' (matrícula compacta del proceso, ver matricula_memoria.py)
+MOTOR_FUGA = os.environ.get('ECAS_MOTOR_FUGA', 'sql')
+
+#Metodo para leer los estudiantes de ECAS por año (y los años con datos) de la matrícula deduplicada
+def get_df_ecas_anual(db_conn, anio_desde=None, anio_hasta=None):
+    """Devuelve (df_ecas con columnas ANIO y mrun, lista de años presentes en la matrícula)."""
+    
+    params = {}
+    filtro_anios = ""
+    if anio_desde is not None and anio_hasta is not None:
+        filtro_anios = "AND cat_periodo BETWEEN :anio_desde AND :anio_hasta"
+        params = {'anio_desde': int(anio_desde), 'anio_hasta': int(anio_hasta)}
     
     query_base = f"""
     SELECT 
         cat_periodo AS ANIO, 
         mrun
     FROM 
-        vista_matriculas_unificada 
+        matricula_deduplicada 
     WHERE 
-        cod_inst = {COD_INST_ECAS}
-    GROUP BY cat_periodo, mrun; 
+        cod_inst = {COD_INST_ECAS} {filtro_anios}; 
     """
-    df_ecas = pd.read_sql(query_base, db_conn)
+    query_anios = f"""
+    SELECT DISTINCT cat_periodo AS ANIO 
+    FROM matricula_deduplicada 
+    WHERE 1 = 1 {filtro_anios};
+    """
+    df_ecas = leer_sql('sql.ecas_anual', text(query_base), db_conn, params=params)
+    anios_datos = leer_sql('sql.anios_datos', text(query_anios), db_conn, params=params)['ANIO'].tolist()
     
-    lista_permanencia = []
+    return df_ecas, anios_datos
+
+#Calculo vectorizado de la permanencia en ECAS para cada par de años N -> N+1 presentes en los datos
+@medir_etapa('pandas.permanencia')
+def calcular_permanencia(df_ecas, anios_datos):
     
-    for anio_n in range(2007, 2025):
-        anio_n_mas_1 = anio_n + 1
-        
-        # Estudiantes matriculados en ECAS en el año N
-        mrun_anio_n_ecas = set(df_ecas[df_ecas['ANIO'] == anio_n]['mrun'])
-        
-        # Estudiantes matriculados en ECAS en el año N+1
-        mrun_anio_n_mas_1_ecas = set(df_ecas[df_ecas['ANIO'] == anio_n_mas_1]['mrun'])
-        
-        if len(mrun_anio_n_ecas) > 0:
-            estudiantes_permanecen = len(mrun_anio_n_ecas.intersection(mrun_anio_n_mas_1_ecas))
-            tasa_permanencia = (estudiantes_permanecen / len(mrun_anio_n_ecas)) * 100
-            
-            lista_permanencia.append({
-                'Año': anio_n,
-                'Estudiantes_Iniciales_ECAS': len(mrun_anio_n_ecas),
-                'Estudiantes_Permanecen_ECAS': estudiantes_permanecen,
-                'Tasa_Permanencia_ECAS': round(tasa_permanencia, 2)
-            })
-
-    df_permanencia = pd.DataFrame(lista_permanencia)
+    df_ecas = df_ecas.drop_duplicates(subset=['ANIO', 'mrun'])
+    
+    # Estudiantes en ECAS en N que siguen en ECAS en N+1: cruce con la matrícula desplazada un año
+    df_siguiente = df_ecas.assign(ANIO=df_ecas['ANIO'] - 1)
+    permanecen = pd.merge(df_ecas, df_siguiente, on=['ANIO', 'mrun']).groupby('ANIO').size()
+    iniciales = df_ecas.groupby('ANIO').size()
+    
+    # Solo años N con matrícula registrada en N+1
+    anios_n = sorted(a for a in iniciales.index if a + 1 in set(anios_datos))
+    
+    df_permanencia = pd.DataFrame({
+        'Año': anios_n,
+        'Estudiantes_Iniciales_ECAS': iniciales.reindex(anios_n).to_numpy(),
+        'Estudiantes_Permanecen_ECAS': permanecen.reindex(anios_n, fill_value=0).to_numpy(),
+    })
+    df_permanencia['Tasa_Permanencia_ECAS'] = (
+        df_permanencia['Estudiantes_Permanecen_ECAS'] / df_permanencia['Estudiantes_Iniciales_ECAS'] * 100
+    ).round(2)
+    
+    return df_permanencia
+
+#Metodo para guardar la serie de permanencia en la DB (completa o solo el último par de años)
+def guardar_serie_permanencia(db_conn, anio_nuevo=None):
+    """
+    Si anio_nuevo es None recalcula y reemplaza la serie completa. Si se indica el año de una tabla
+    matricula_AÑO recién cargada, solo se calcula el par (anio_nuevo - 1 -> anio_nuevo) y se agrega
+    a la serie guardada. Quien llame debe actualizar la versión de datos del caché.
+    """
+    if anio_nuevo is None:
+        df_ecas, anios_datos = get_df_ecas_anual(db_conn)
+        df_permanencia = calcular_permanencia(df_ecas, anios_datos)
+        df_permanencia.rename(columns={'Año': 'ANIO'}).to_sql(TABLA_SERIE_PERMANENCIA, db_conn, if_exists='replace', index=False)
+        return df_permanencia
+
+    df_ecas, anios_datos = get_df_ecas_anual(db_conn, anio_desde=anio_nuevo - 1, anio_hasta=anio_nuevo)
+    df_nuevo_par = calcular_permanencia(df_ecas, anios_datos)
+    
+    with db_conn.connect() as connection:
+        if inspect(connection).has_table(TABLA_SERIE_PERMANENCIA):
+            connection.execute(text(f"DELETE FROM {TABLA_SERIE_PERMANENCIA} WHERE ANIO = :anio;"), {'anio': int(anio_nuevo) - 1})
+        df_nuevo_par.rename(columns={'Año': 'ANIO'}).to_sql(TABLA_SERIE_PERMANENCIA, connection, if_exists='append', index=False)
+        connection.commit()
+    
+    return df_nuevo_par
+
+#KPI 1: Tasa de permanencia de los estudiantes año a año.
+@medir_etapa('kpi.kpi1')
+@cache_por_cohorte()
+def kpi1_permanencia_ecas(db_conn, anio=None, cod_inst=COD_INST_ECAS):
+    """
+    Calcula el porcentaje de permanencia dentro de ECAS (COD_INST = 104) usando la matrícula deduplicada.
+    Si existe la serie guardada (guardar_serie_permanencia) se lee directamente de ella.
+    Para otra institución (cod_inst) la serie sale de la matriz de transiciones, con las mismas columnas.
+    """
+    
+    if cod_inst != COD_INST_ECAS:
+        # Import diferido: matriz_transiciones usa las constantes de este módulo
+        from matriz_transiciones import get_matriz_transiciones, permanencia_matriz
+        df_permanencia = permanencia_matriz(get_matriz_transiciones(db_conn), cod_inst)
+    elif inspect(db_conn).has_table(TABLA_SERIE_PERMANENCIA):
+        df_permanencia = leer_sql('sql.serie_permanencia', f"SELECT * FROM {TABLA_SERIE_PERMANENCIA} ORDER BY ANIO;", db_conn)
+        df_permanencia = df_permanencia.rename(columns={'ANIO': 'Año'})
+    else:
+        df_ecas, anios_datos = get_df_ecas_anual(db_conn)
+        df_permanencia = calcular_permanencia(df_ecas, anios_datos)
 
     if anio:
         return df_permanencia[df_permanencia['Año'] == anio]
@@ -56,178 +132,458 @@ def kpi1_permanencia_ecas(db_conn, anio=None):
         tasa_general = df_permanencia['Tasa_Permanencia_ECAS'].mean()
         return df_permanencia, round(tasa_general, 2)
 
+#Consulta de fuga sobre la tabla materializada 'transiciones_ecas' (ver views.create_materialized_tables).
+#El origen es la primera fila de ECAS del estudiante en N y el destino su primera fila de N+1 (por codigo_unico),
+#como en el cálculo original: si esa primera fila de N+1 es de otra institución, cuenta como fuga.
+QUERY_FUGA = """
+SELECT 
+    MRUN, 
+    INST_ORIGEN, 
+    CARRERA_ORIGEN, 
+    AREA_ORIGEN,
+    COD_INST_DESTINO, 
+    INST_DESTINO, 
+    CARRERA_DESTINO, 
+    AREA_DESTINO,
+    ANIO_INICIAL
+FROM 
+    transiciones_ecas
+WHERE 
+    DENTRO_DURACION = 1
+    AND COD_INST_DESTINO <> :cod_inst_ecas
+    {filtro_cohorte}
+ORDER BY ANIO_INICIAL, MRUN;
+"""
+
 #Metodo para KPIs que calculan la fuga de estudiantes
+@cache_por_cohorte()
 def get_df_fuga_base(db_conn, anio_n=None):
+    """
+    Obtiene los estudiantes que se fugaron de ECAS entre el año N y N+1 desde 'transiciones_ecas'.
+    Si anio_n es None se devuelven todas las cohortes; en otro caso solo se lee la cohorte pedida.
+    Con MOTOR_FUGA = 'memoria' la fuga se calcula sobre la matrícula compacta cargada en el proceso, y con
+    MOTOR_FUGA = 'pandas' con calcular_fuga sobre la matrícula de los años N y N+1 (o toda) leída de la vista.
+    """
+    if MOTOR_FUGA == 'memoria':
+        # Import diferido: matricula_memoria usa las constantes de este módulo
+        from matricula_memoria import get_matricula_memoria, calcular_fuga_memoria
+        return calcular_fuga_memoria(get_matricula_memoria(db_conn), anio_n=anio_n)
+    if MOTOR_FUGA == 'pandas':
+        anios = (int(anio_n), int(anio_n) + 1) if anio_n else (None, None)
+        return calcular_fuga(get_df_matriculas(db_conn, *anios), anio_n=anio_n)
+
+    params = {'cod_inst_ecas': COD_INST_ECAS}
+    filtro_cohorte = ""
+    if anio_n:
+        filtro_cohorte = "AND ANIO_INICIAL = :anio_n"
+        params['anio_n'] = int(anio_n)
+
+    query_fuga = text(QUERY_FUGA.format(filtro_cohorte=filtro_cohorte))
+    return leer_sql('sql.fuga_base', query_fuga, db_conn, params=params)
+
+#Misma fuga que QUERY_FUGA, de a un lote: se pagina cada cohorte por MRUN sobre el índice (ANIO_INICIAL, MRUN)
+#de 'transiciones_ecas', así cada lote es una búsqueda en el índice y no un OFFSET creciente.
+QUERY_FUGA_LOTE = """
+SELECT {limite_top}
+    MRUN,
+    INST_ORIGEN,
+    CARRERA_ORIGEN,
+    AREA_ORIGEN,
+    COD_INST_DESTINO,
+    INST_DESTINO,
+    CARRERA_DESTINO,
+    AREA_DESTINO,
+    ANIO_INICIAL
+FROM
+    transiciones_ecas
+WHERE
+    ANIO_INICIAL = :anio_n
+    AND MRUN > :ultimo_mrun
+    AND DENTRO_DURACION = 1
+    AND COD_INST_DESTINO <> :cod_inst_ecas
+ORDER BY MRUN
+{limite};
+"""
+
+def iter_fuga_base(db_conn, anio_n=None, tamanio_lote=50000):
+    """
+    Entrega la fuga de get_df_fuga_base, en el mismo orden, en DataFrames de a lo más tamanio_lote filas
+    (siempre al menos uno, aunque sea vacío). Cada lote pide y devuelve su propia conexión al pool, así una
+    descarga lenta no retiene conexiones entre un lote y el siguiente.
+    """
+    if MOTOR_FUGA != 'sql':
+        # La fuga de los motores en memoria y pandas ya está calculada (y cacheada) en el proceso: solo se recorre por tramos
+        df_fuga = get_df_fuga_base(db_conn, anio_n=anio_n)
+        for inicio in range(0, max(len(df_fuga), 1), tamanio_lote):
+            yield df_fuga.iloc[inicio:inicio + tamanio_lote]
+        return
 
-    # 1. Obtener todos los datos clave de la vista unificada
-    query_fuga_base = """
+    if anio_n:
+        anios = [int(anio_n)]
+    else:
+        anios = leer_sql('sql.fuga_anios', "SELECT DISTINCT ANIO_INICIAL FROM transiciones_ecas ORDER BY ANIO_INICIAL;", db_conn)
+        anios = [int(a) for a in anios['ANIO_INICIAL']]
+
+    if db_conn.dialect.name == 'mssql':
+        limite_top, limite = "TOP (:tamanio_lote)", ""
+    else:
+        limite_top, limite = "", "LIMIT :tamanio_lote"
+    query_lote = text(QUERY_FUGA_LOTE.format(limite_top=limite_top, limite=limite))
+
+    enviados = 0
+    for anio in anios or [-1]:   # Sin años se consulta igual una vez, para tener las columnas del archivo
+        params = {'anio_n': anio, 'ultimo_mrun': -1, 'cod_inst_ecas': COD_INST_ECAS, 'tamanio_lote': int(tamanio_lote)}
+        while True:
+            df_lote = leer_sql('sql.fuga_lote', query_lote, db_conn, params=params)
+            if not df_lote.empty:
+                enviados += 1
+                yield df_lote
+            if len(df_lote) < tamanio_lote:
+                break
+            params['ultimo_mrun'] = int(df_lote['MRUN'].iloc[-1])
+
+    if not enviados:
+        yield df_lote
+
+#Metodo para obtener la matrícula de la vista unificada (todas las instituciones; todos los años o un rango)
+def get_df_matriculas(db_conn, anio_desde=None, anio_hasta=None):
+    
+    params = {}
+    filtro_anios = ""
+    if anio_desde is not None and anio_hasta is not None:
+        filtro_anios = "WHERE cat_periodo BETWEEN :anio_desde AND :anio_hasta"
+        params = {'anio_desde': int(anio_desde), 'anio_hasta': int(anio_hasta)}
+
+    query_matriculas = f"""
     SELECT 
         cat_periodo AS ANIO, 
-        mrun, 
+        mrun AS MRUN, 
         cod_inst, 
         nomb_inst, 
         nomb_carrera, 
         area_conocimiento,
+        codigo_unico,
         dur_estudio_carr,  
         jornada,
         anio_ing_carr_ori
     FROM 
-        vista_matriculas_unificada; 
+        vista_matriculas_unificada
+    {filtro_anios};
+    """
+    return leer_sql('sql.matriculas', text(query_matriculas), db_conn, params=params)
+
+#Calculo de fuga en pandas sobre una matrícula ya cargada en memoria (misma lógica que 'transiciones_ecas')
+def calcular_fuga(df_completo, anio_n=None):
+    """
+    Calcula la fuga de todas las cohortes en una sola pasada: se deduplica una vez por (ANIO, MRUN)
+    (primera fila de ECAS como origen, primera fila del año como destino, en orden de codigo_unico)
+    y cada año se cruza con el siguiente mediante un único merge desplazado en un año.
+    Las filas sin año o sin MRUN no cruzan (como los NULL en los joins de SQL) y un destino con cod_inst nulo no es fuga.
     """
-    df_completo = pd.read_sql(query_fuga_base, db_conn)
     
-    df_fuga = pd.DataFrame()
+    with etapa('pandas.deduplicacion') as registro:
+        df_completo = df_completo[df_completo['ANIO'].notna() & df_completo['MRUN'].notna()].astype({'ANIO': 'int64', 'MRUN': 'int64'})
+        # Orden determinista para la deduplicación: codigo_unico con los nulos primero (ver views.ORDEN_CODIGO_UNICO)
+        df_completo = df_completo.sort_values(by='codigo_unico', kind='stable', na_position='first')
+
+        if anio_n:
+            df_completo = df_completo[df_completo['ANIO'].isin([anio_n, anio_n + 1])]
+
+        # a. Una fila por estudiante y año: la primera (destino) y la primera de ECAS (origen)
+        df_unico = df_completo.drop_duplicates(subset=['ANIO', 'MRUN'])
+        df_n_ecas = df_completo[df_completo['cod_inst'] == COD_INST_ECAS].drop_duplicates(subset=['ANIO', 'MRUN'])
+        registro['filas'] = len(df_unico)
+    
+    # b. Origen: matrícula ECAS en el año N
+    if anio_n:
+        df_n_ecas = df_n_ecas[df_n_ecas['ANIO'] == anio_n]
     
-    rango_anios = [anio_n] if anio_n else range(df_completo['ANIO'].min(), df_completo['ANIO'].max())
+    # LÓGICA DE EXCLUSIÓN: estudiantes que AÚN NO han cumplido la duración teórica
+    permanencia_semestres = (df_n_ecas['ANIO'] - df_n_ecas['anio_ing_carr_ori']) * 2
+    duracion_teorica = np.where(
+        df_n_ecas['jornada'].str.contains('Vespertino', na=False), 
+        DURACION_VESPERTINA_SEMESTRES, 
+        DURACION_DIURNA_SEMESTRES
+    )
+    df_n_filtrado = df_n_ecas[permanencia_semestres < duracion_teorica]
+    df_n_filtrado = df_n_filtrado[['ANIO', 'MRUN', 'nomb_inst', 'nomb_carrera', 'area_conocimiento']].rename(
+        columns={'ANIO': 'ANIO_INICIAL', 'nomb_inst': 'INST_ORIGEN', 'nomb_carrera': 'CARRERA_ORIGEN', 'area_conocimiento': 'AREA_ORIGEN'}
+    )
     
-    for anio in rango_anios:
-        anio_siguiente = anio + 1
-        
-        # a. Matrícula en Año N (solo ECAS - Origen)
-        df_n_ecas = df_completo[(df_completo['ANIO'] == anio) & 
-                                (df_completo['cod_inst'] == COD_INST_ECAS)].drop_duplicates(subset=['MRUN'])
-        
-        # LÓGICA DE EXCLUSIÓN
-        df_n_ecas['Permanencia_Anios'] = df_n_ecas['ANIO'] - df_n_ecas['anio_ing_carr_ori']
-        df_n_ecas['Permanencia_Semestres'] = df_n_ecas['Permanencia_Anios'] * 2
-        df_n_ecas['Duracion_Teorica'] = np.where(
-            df_n_ecas['jornada'].str.contains('Vespertino', na=False), 
-            DURACION_VESPERTINA_SEMESTRES, 
-            DURACION_DIURNA_SEMESTRES
-        )
-        
-        # Filtrar: Estudiantes que AÚN NO han cumplido la duración teórica
-        df_n_filtrado = df_n_ecas[df_n_ecas['Permanencia_Semestres'] < df_n_ecas['Duracion_Teorica']].copy()
-        
-        df_n_filtrado.rename(columns={'cod_inst': 'COD_INST_ORIGEN', 'nomb_inst': 'INST_ORIGEN', 'nomb_carrera': 'CARRERA_ORIGEN', 'area_conocimiento': 'AREA_ORIGEN'}, inplace=True)
-        
-        # b. Matrícula en Año N+1 (Destino)
-        df_n_mas_1 = df_completo[df_completo['ANIO'] == anio_siguiente].drop_duplicates(subset=['MRUN'])
-        df_n_mas_1.rename(columns={'cod_inst': 'COD_INST_DESTINO', 'nomb_inst': 'INST_DESTINO', 'nomb_carrera': 'CARRERA_DESTINO', 'area_conocimiento': 'AREA_DESTINO'}, inplace=True)
-        
-        # c. Combinar
-        cols_origen = ['MRUN', 'INST_ORIGEN', 'CARRERA_ORIGEN', 'AREA_ORIGEN']
-        cols_destino = ['MRUN', 'COD_INST_DESTINO', 'INST_DESTINO', 'CARRERA_DESTINO', 'AREA_DESTINO']
-        df_merged = pd.merge(df_n_filtrado[cols_origen], df_n_mas_1[cols_destino], on='MRUN', how='inner')
-        df_merged['ANIO_INICIAL'] = anio
-        
-        # d. Filtrar: Estudiantes que se fueron de ECAS (Fuga)
-        df_fuga_anual = df_merged[df_merged['COD_INST_DESTINO'] != COD_INST_ECAS].copy()
-        
-        df_fuga = pd.concat([df_fuga, df_fuga_anual], ignore_index=True)
+    # c. Destino: matrícula del año N+1, desplazada para cruzar con el año N
+    df_n_mas_1 = df_unico[['ANIO', 'MRUN', 'cod_inst', 'nomb_inst', 'nomb_carrera', 'area_conocimiento']].rename(
+        columns={'cod_inst': 'COD_INST_DESTINO', 'nomb_inst': 'INST_DESTINO', 'nomb_carrera': 'CARRERA_DESTINO', 'area_conocimiento': 'AREA_DESTINO'}
+    )
+    df_n_mas_1['ANIO_INICIAL'] = df_n_mas_1.pop('ANIO') - 1
+    
+    # d. Combinar y quedarse con los que se fueron de ECAS (Fuga)
+    with etapa('pandas.merge') as registro:
+        df_merged = pd.merge(df_n_filtrado, df_n_mas_1, on=['ANIO_INICIAL', 'MRUN'], how='inner')
+        df_fuga = df_merged[df_merged['COD_INST_DESTINO'].notna() & (df_merged['COD_INST_DESTINO'] != COD_INST_ECAS)]
+        registro['filas'] = len(df_fuga)
+
+    cols_fuga = ['MRUN', 'INST_ORIGEN', 'CARRERA_ORIGEN', 'AREA_ORIGEN',
+                 'COD_INST_DESTINO', 'INST_DESTINO', 'CARRERA_DESTINO', 'AREA_DESTINO', 'ANIO_INICIAL']
+    return df_fuga[cols_fuga].sort_values(by=['ANIO_INICIAL', 'MRUN']).reset_index(drop=True)
+
+#Conteos de MRUN distintos: en la fuga agregada de la matriz de transiciones (columna N_MRUN) ya vienen hechos
+def total_fugados(df_fuga):
+    return int(df_fuga['N_MRUN'].sum()) if 'N_MRUN' in df_fuga.columns else df_fuga['MRUN'].nunique()
 
-    return df_fuga
+def _fugados_por(df_fuga, columna):
+    if 'N_MRUN' in df_fuga.columns:
+        return df_fuga.groupby(columna)['N_MRUN'].sum()
+    return df_fuga.groupby(columna)['MRUN'].nunique()
 
 #KPI2: Calcula la institución de destino
+@medir_etapa('pandas.kpi2')
 def kpi2_institucion_destino(df_fuga):
     """Calcula el destino de la fuga (Institución)."""
-    total_fuga = df_fuga['MRUN'].nunique()
+    total_fuga = total_fugados(df_fuga)
     
     if total_fuga == 0:
         return pd.DataFrame(columns=['INST_DESTINO', 'Total_Fuga', 'Porcentaje'])
 
-    kpi2_df = df_fuga.groupby('INST_DESTINO')['MRUN'].nunique().sort_values(ascending=False).reset_index(name='Total_Fuga')
+    kpi2_df = _fugados_por(df_fuga, 'INST_DESTINO').sort_values(ascending=False).reset_index(name='Total_Fuga')
     kpi2_df['Porcentaje'] = (kpi2_df['Total_Fuga'] / total_fuga) * 100
     
     return kpi2_df
 
 #KPI3: Calcula la carrera de destino
+@medir_etapa('pandas.kpi3')
 def kpi3_carrera_destino(df_fuga):
     """Calcula el destino de la fuga (Carrera)."""
-    total_fuga = df_fuga['MRUN'].nunique()
+    total_fuga = total_fugados(df_fuga)
     
     if total_fuga == 0:
         return pd.DataFrame(columns=['CARRERA_DESTINO', 'Total_Fuga', 'Porcentaje'])
         
-    kpi3_df = df_fuga.groupby('CARRERA_DESTINO')['MRUN'].nunique().sort_values(ascending=False).reset_index(name='Total_Fuga')
+    kpi3_df = _fugados_por(df_fuga, 'CARRERA_DESTINO').sort_values(ascending=False).reset_index(name='Total_Fuga')
     kpi3_df['Porcentaje'] = (kpi3_df['Total_Fuga'] / total_fuga) * 100
     
     return kpi3_df
 
+@medir_etapa('pandas.kpi4')
 def kpi4_area_destino(df_fuga, solo_cambio=False):
     """
     Calcula la distribución de MRUNs por el Área de Conocimiento de Destino.
     Si solo_cambio=True, excluye a los que se quedaron en la misma área (si aplica).
     """
     
-    # Crea la bandera de cambio (si se requiere para filtrar o etiquetar)
-    df_fuga['CAMBIO_AREA'] = df_fuga['AREA_ORIGEN'] != df_fuga['AREA_DESTINO']
+    # Bandera de cambio de área (sin modificar df_fuga, que se comparte con los demás KPIs)
+    cambio_area = df_fuga['AREA_ORIGEN'] != df_fuga['AREA_DESTINO']
 
     if solo_cambio:
-        df_analisis = df_fuga[df_fuga['CAMBIO_AREA'] == True].copy()
+        df_analisis = df_fuga[cambio_area]
     else:
         # Usar todos los fugados para ver la distribución completa de destino
-        df_analisis = df_fuga.copy()
+        df_analisis = df_fuga
     
-    total_fuga = df_analisis['MRUN'].nunique()
+    total_fuga = total_fugados(df_analisis)
     
     if total_fuga == 0:
         return pd.DataFrame(columns=['AREA_DESTINO', 'Total_Fuga', 'Porcentaje'])
         
     # Agrupar por el nombre del área de destino
-    kpi4_df = df_analisis.groupby('AREA_DESTINO')['MRUN'].nunique().sort_values(ascending=False).reset_index(name='Total_Fuga')
+    kpi4_df = _fugados_por(df_analisis, 'AREA_DESTINO').sort_values(ascending=False).reset_index(name='Total_Fuga')
     
     kpi4_df['Porcentaje'] = (kpi4_df['Total_Fuga'] / total_fuga) * 100
     
     return kpi4_df
 
-#KPI 5: Estima la titulación de aquellos estudiantes que se fugaron.
-def kpi5_titulacion_fuga_estimada(db_conn, anio_n=None):
-    
-    # 1. Obtener la lista de MRUN que se fugaron de ECAS, usando la nueva función base.
-    # Esta llamada YA incluye la lógica de exclusión de titulados estimados de ECAS.
-    try:
-        # Llamar a la función base y obtener el DataFrame de MRUNs fugados
+#KPIs 2, 3 y 4 de una cohorte, calculados sobre la misma fuga base y cacheados por cohorte
+@medir_etapa('kpi.destino_fuga')
+@cache_por_cohorte()
+def kpis_destino_fuga(db_conn, anio_n=None, cod_inst=COD_INST_ECAS):
+    """
+    Devuelve (df_fuga, df_kpi2, df_kpi3, df_kpi4) para la cohorte anio_n (None = todas).
+    Para otra institución (cod_inst) df_fuga es la fuga agregada de la matriz de transiciones (N_MRUN por destino).
+    """
+    if cod_inst == COD_INST_ECAS:
         df_fuga = get_df_fuga_base(db_conn, anio_n=anio_n)
-    except NameError:
-        print("Error: get_df_fuga_base no está definida o no puede ejecutarse.")
-        return pd.DataFrame({'NOMB_CARRERA': [], 'Titulados_Estimados': []}), 0
+    else:
+        from matriz_transiciones import get_matriz_transiciones, fuga_matriz
+        df_fuga = fuga_matriz(get_matriz_transiciones(db_conn), cod_inst, anio_n=anio_n)
+    
+    df_kpi2 = kpi2_institucion_destino(df_fuga)
+    df_kpi3 = kpi3_carrera_destino(df_fuga)
+    df_kpi4 = kpi4_area_destino(df_fuga, solo_cambio=False) # Distribución de ÁREAS de destino (no solo Sí/No)
+    
+    return df_fuga, df_kpi2, df_kpi3, df_kpi4
+
+#Historia de matrícula (con duración de carrera conocida) de los estudiantes fugados
+QUERY_HISTORIA_FUGADOS = """
+SELECT 
+    h.mrun AS MRUN, 
+    h.cat_periodo AS ANIO, 
+    h.codigo_unico AS CODIGO_UNICO, 
+    h.nomb_carrera,
+    CAST(h.dur_total_carr AS INT) AS DURACION_SEMESTRES
+FROM 
+    vista_matriculas_unificada h
+    INNER JOIN ({fuente_mruns}) f ON f.MRUN = h.mrun
+WHERE 
+    h.dur_total_carr IS NOT NULL 
+ORDER BY 
+    h.mrun, h.cat_periodo, h.codigo_unico
+"""
+
+#Misma historia para una lista explícita de MRUN (como en el cálculo original)
+QUERY_HISTORIA_FUGADOS_LISTA = """
+SELECT 
+    mrun AS MRUN, 
+    cat_periodo AS ANIO, 
+    codigo_unico AS CODIGO_UNICO, 
+    nomb_carrera,
+    CAST(dur_total_carr AS INT) AS DURACION_SEMESTRES
+FROM 
+    vista_matriculas_unificada 
+WHERE 
+    mrun IN ({lista_mruns}) AND
+    dur_total_carr IS NOT NULL 
+ORDER BY 
+    mrun, cat_periodo, codigo_unico
+"""
+
+#Subconsulta con los MRUN fugados, resuelta directamente sobre 'transiciones_ecas'
+SUBQUERY_MRUNS_FUGADOS = """
+SELECT DISTINCT MRUN 
+FROM transiciones_ecas 
+WHERE DENTRO_DURACION = 1 AND COD_INST_DESTINO <> :cod_inst_ecas {filtro_cohorte}
+"""
+
+def _leer_historia_fugados(db_conn, anio_n=None, mruns_fugados=None, estrategia=None):
+    """
+    Lee la historia de matrícula de los fugados con un único join sobre la vista. Según 'estrategia'
+    (por defecto ESTRATEGIA_HISTORIA_FUGADOS) los fugados se entregan a la base como:
+    - 'subconsulta': una subconsulta sobre 'transiciones_ecas'; si se entregan mruns_fugados, la tabla temporal,
+    - 'tabla_temporal': una tabla temporal cargada con executemany (fast_executemany en SQL Server),
+    - 'lista_in': literales en un IN, hasta MAX_LISTA_IN MRUNs; solo en bases locales (en SQL Server se usa la
+      tabla temporal).
+    Sin mruns_fugados, las dos últimas toman los MRUN de get_df_fuga_base (cacheada por cohorte) y, si son
+    más de MAX_LISTA_IN, se usa la subconsulta; con mruns_fugados largos se usa la tabla temporal.
+    db_conn puede ser un Engine o una Connection ya abierta.
+    """
+    estrategia = estrategia or ESTRATEGIA_HISTORIA_FUGADOS
+    if estrategia == 'lista_in' and db_conn.dialect.name == 'mssql':
+        estrategia = 'tabla_temporal'
+    if mruns_fugados is None and estrategia != 'subconsulta':
+        mruns_fugados = get_df_fuga_base(db_conn, anio_n=anio_n)['MRUN'].unique()
+        if len(mruns_fugados) > MAX_LISTA_IN:
+            estrategia, mruns_fugados = 'subconsulta', None
+
+    if mruns_fugados is None:
+        params = {'cod_inst_ecas': COD_INST_ECAS}
+        filtro_cohorte = ""
+        if anio_n:
+            filtro_cohorte = "AND ANIO_INICIAL = :anio_n"
+            params['anio_n'] = int(anio_n)
+        fuente_mruns = SUBQUERY_MRUNS_FUGADOS.format(filtro_cohorte=filtro_cohorte)
+        return leer_sql('sql.historia_fugados', text(QUERY_HISTORIA_FUGADOS.format(fuente_mruns=fuente_mruns)), db_conn, params=params)
+
+    mruns = [int(mrun) for mrun in pd.unique(pd.Series(mruns_fugados).dropna())]
+
+    if estrategia == 'lista_in' and len(mruns) <= MAX_LISTA_IN:
+        # Los MRUN son enteros, así que se pueden escribir como literales sin riesgo (y sin el límite de parámetros)
+        lista_mruns = ", ".join(str(mrun) for mrun in mruns) or "NULL"
+        return leer_sql('sql.historia_fugados', text(QUERY_HISTORIA_FUGADOS_LISTA.format(lista_mruns=lista_mruns)), db_conn)
+
+    # La tabla temporal solo existe en la conexión que la crea, por eso todo ocurre en la misma. Si db_conn ya es
+    # una Connection se usa tal cual y la transacción queda a cargo de quien la abrió.
+    # El nombre es único por llamada para que un DROP revertido con la transacción del llamador no choque con la siguiente.
+    conexion_propia = not isinstance(db_conn, Connection)
+    with (db_conn.connect() if conexion_propia else nullcontext(db_conn)) as connection:
+        sufijo = uuid.uuid4().hex[:12]
+        if connection.dialect.name == 'mssql':
+            tabla_mruns = f'#mruns_fugados_{sufijo}'
+            connection.execute(text(f"CREATE TABLE {tabla_mruns} (MRUN BIGINT PRIMARY KEY);"))
+        else:
+            tabla_mruns = f'mruns_fugados_{sufijo}'
+            connection.execute(text(f"CREATE TEMPORARY TABLE {tabla_mruns} (MRUN BIGINT PRIMARY KEY);"))
+
+        try:
+            connection.execute(text(f"INSERT INTO {tabla_mruns} (MRUN) VALUES (:mrun);"), [{'mrun': mrun} for mrun in mruns])
+            query_titulacion = QUERY_HISTORIA_FUGADOS.format(fuente_mruns=f"SELECT MRUN FROM {tabla_mruns}")
+            df_historia = leer_sql('sql.historia_fugados', text(query_titulacion), connection)
+        finally:
+            connection.execute(text(f"DROP TABLE {tabla_mruns};"))
+            if conexion_propia:
+                connection.commit()
 
-    mruns_fugados = df_fuga['MRUN'].unique()
+    return df_historia
+
+#KPI 5: Estima la titulación de aquellos estudiantes que se fugaron.
+@medir_etapa('kpi.kpi5')
+@cache_por_cohorte(derivados=('df_fuga', 'mruns_fugados'))
+def kpi5_titulacion_fuga_estimada(db_conn, anio_n=None, df_fuga=None, mruns_fugados=None):
+    """
+    Estima la titulación de los estudiantes fugados en sus carreras de destino.
+    Acepta el DataFrame de fuga ya calculado (df_fuga) o la lista de MRUNs fugados (mruns_fugados);
+    si no se entrega ninguno, los fugados de la cohorte se obtienen con una subconsulta en SQL.
+    El resultado se cachea por anio_n: al entregar df_fuga o mruns_fugados sin su cohorte no se usa el caché.
+    """
+    
+    # 1. Obtener los MRUN que se fugaron de ECAS.
+    # La fuga base YA incluye la lógica de exclusión de titulados estimados de ECAS.
+    if mruns_fugados is None and df_fuga is not None:
+        mruns_fugados = df_fuga['MRUN'].unique()
     
-    if len(mruns_fugados) == 0:
+    if mruns_fugados is not None and len(mruns_fugados) == 0:
         return pd.DataFrame({'NOMB_CARRERA': [], 'Titulados_Estimados': []}), 0
 
+    if MOTOR_FUGA == 'memoria':
+        # Con el motor en memoria la historia de los fugados se toma de las trayectorias cargadas en el proceso
+        from trayectorias import get_trayectorias, kpi5_trayectorias
+        if mruns_fugados is None:
+            mruns_fugados = get_df_fuga_base(db_conn, anio_n=anio_n)['MRUN'].unique()
+        return kpi5_trayectorias(get_trayectorias(db_conn), mruns_fugados)
+
     # 2. Obtener la historia completa de matrículas (después de la fuga) para los MRUNs fugados.
-    mrun_list_str = ', '.join([f"'{mrun}'" for mrun in mruns_fugados])
+    df_historia = _leer_historia_fugados(db_conn, anio_n=anio_n, mruns_fugados=mruns_fugados)
     
-    # Se consulta la historia de matrícula de los fugados.
-    query_titulacion = f"""
-    SELECT 
-        mrun, 
-        cat_periodo AS ANIO, 
-        codigo_unico, 
-        nomb_carrera,
-        CAST(dur_total_carr AS INT) AS DURACION_SEMESTRES
-    FROM 
-        vista_matriculas_unificada 
-    WHERE 
-        mrun IN ({mrun_list_str}) AND
-        dur_total_carr IS NOT NULL 
-    """
-    df_historia = pd.read_sql(query_titulacion, db_conn)
-    
-    df_ultima_matricula = df_historia.groupby('MRUN')['ANIO'].max().reset_index(name='Ultimo_ANIO')
-    df_final = pd.merge(df_historia, df_ultima_matricula, on=['MRUN', 'ANIO'])
-    df_ultima_carrera = df_final.sort_values(by=['MRUN', 'ANIO'], ascending=False).drop_duplicates(subset=['MRUN'])
+    if df_historia.empty:
+        return pd.DataFrame({'NOMB_CARRERA': [], 'Titulados_Estimados': []}), 0
     
-    df_ultima_carrera['CLAVE_CARRERA_FINAL'] = df_ultima_carrera['MRUN'].astype(str) + '_' + df_ultima_carrera['CODIGO_UNICO'].astype(str)
-    df_historia['CLAVE_CARRERA_FINAL'] = df_historia['MRUN'].astype(str) + '_' + df_historia['CODIGO_UNICO'].astype(str)
-
-    claves_finales = df_ultima_carrera['CLAVE_CARRERA_FINAL'].unique()
-    df_permanencia_final = df_historia[df_historia['CLAVE_CARRERA_FINAL'].isin(claves_finales)].copy()
+    with etapa('pandas.kpi5'):
+        # 3. Última carrera de cada estudiante: la fila con el mayor ANIO (idxmax toma la primera en caso de empate,
+        # que por el ORDER BY de la consulta es el menor CODIGO_UNICO en todos los motores).
+        # Se compara con códigos enteros (factorize) en vez de concatenar MRUN y CODIGO_UNICO como texto.
+        codigo_carrera = pd.Series(pd.factorize(df_historia['CODIGO_UNICO'])[0], index=df_historia.index)
+        idx_ultima = df_historia.groupby('MRUN')['ANIO'].idxmax()
+        codigo_final = df_historia['MRUN'].map(pd.Series(codigo_carrera.loc[idx_ultima].to_numpy(), index=idx_ultima.index))
+        df_permanencia_final = df_historia[codigo_carrera == codigo_final]
 
-    df_permanencia_carrera = df_permanencia_final.groupby(['MRUN', 'CODIGO_UNICO', 'nomb_carrera', 'DURACION_SEMESTRES']).agg(
-        Anios_Matriculado=('ANIO', 'nunique')
-    ).reset_index()
+        df_permanencia_carrera = df_permanencia_final.groupby(['MRUN', 'CODIGO_UNICO', 'nomb_carrera', 'DURACION_SEMESTRES']).agg(
+            Anios_Matriculado=('ANIO', 'nunique')
+        ).reset_index()
     
-    df_permanencia_carrera['Duracion_Anios_Teorica'] = df_permanencia_carrera['DURACION_SEMESTRES'] / 2
+        df_permanencia_carrera['Duracion_Anios_Teorica'] = df_permanencia_carrera['DURACION_SEMESTRES'] / 2
     
-    df_titulados_estimados = df_permanencia_carrera[
-        df_permanencia_carrera['Anios_Matriculado'] >= df_permanencia_carrera['Duracion_Anios_Teorica']
-    ].copy()
+        df_titulados_estimados = df_permanencia_carrera[
+            df_permanencia_carrera['Anios_Matriculado'] >= df_permanencia_carrera['Duracion_Anios_Teorica']
+        ].copy()
     
-    total_estimado = df_titulados_estimados['MRUN'].nunique()
-    resultados_carrera = df_titulados_estimados.groupby('nomb_carrera')['MRUN'].nunique().reset_index(name='Titulados_Estimados')
+        total_estimado = df_titulados_estimados['MRUN'].nunique()
+        resultados_carrera = df_titulados_estimados.groupby('nomb_carrera')['MRUN'].nunique().reset_index(name='Titulados_Estimados')
     
-    return resultados_carrera, total_estimado
\ No newline at end of file
+    return resultados_carrera, total_estimado
+
+#KPI 6: Supervivencia a k años de los estudiantes de la institución (motor de trayectorias)
+@medir_etapa('kpi.kpi6')
+@cache_por_cohorte()
+def kpi6_supervivencia(db_conn, anio_n=None, cod_inst=COD_INST_ECAS):
+    """Porcentaje de los estudiantes de la cohorte que sigue en la institución y en el sistema k años después."""
+    # Import diferido: trayectorias usa las constantes de este módulo
+    from trayectorias import get_trayectorias, curva_supervivencia
+    return curva_supervivencia(get_trayectorias(db_conn), cod_inst, anio_n)
+
+#KPI 7: Retorno a la institución y titulación estimada de los fugados, por años desde la fuga
+@medir_etapa('kpi.kpi7')
+@cache_por_cohorte()
+def kpi7_trayectoria_fugados(db_conn, anio_n=None, cod_inst=COD_INST_ECAS):
+    """
+    Porcentaje acumulado de los fugados de la cohorte que volvió a la institución y que se estima titulado.
+    Los fugados siguen la regla de la fuga base (duración teórica incluida): para ECAS son los MRUN de get_df_fuga_base.
+    """
+    from trayectorias import get_trayectorias, trayectoria_fugados
+    return trayectoria_fugados(get_trayectorias(db_conn), cod_inst, anio_n)
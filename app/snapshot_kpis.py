@@ -0,0 +1,176 @@
+#Archivo para precalcular todas las cohortes ('ALL' y cada año) y guardarlas como snapshot en disco:
+#figuras de Plotly en JSON y tablas agregadas de cada KPI. Con ECAS_MODO_SNAPSHOT=1 el dashboard
+#responde los callbacks desde estos archivos, sin conexión a la base de datos.
+#Cada generación se escribe en su propia subcarpeta (version_...) y el archivo ACTUAL apunta a la vigente:
+#reemplazar ese archivo es atómico, así que un dashboard siempre lee un snapshot completo.
+
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from datetime import datetime
+import pandas as pd
+from plotly.utils import PlotlyJSONEncoder
+from cache_kpis import version_datos
+from connector_db import en_paralelo
+
+CARPETA_SNAPSHOT = os.environ.get('ECAS_CARPETA_SNAPSHOT', 'snapshot')
+ARCHIVO_MANIFEST = 'manifest.json'
+ARCHIVO_ACTUAL = 'ACTUAL'       # Nombre de la subcarpeta de la versión vigente
+PREFIJO_VERSION = 'version_'
+
+_cohortes_leidas = {}
+_lock = threading.Lock()
+
+def _ruta_cohorte(carpeta, selected_year):
+    return os.path.join(carpeta, f'cohorte_{selected_year}.json')
+
+def version_snapshot(carpeta=CARPETA_SNAPSHOT):
+    """Versión vigente del snapshot (la subcarpeta a la que apunta ACTUAL), o None si no se ha generado."""
+    try:
+        with open(os.path.join(carpeta, ARCHIVO_ACTUAL), 'r', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def _carpeta_version(carpeta):
+    """(versión vigente, su subcarpeta); FileNotFoundError si no hay snapshot."""
+    version = version_snapshot(carpeta)
+    if version is None:
+        raise FileNotFoundError(f"No hay un snapshot generado en '{carpeta}'")
+    return version, os.path.join(carpeta, version)
+
+def _publicar_version(carpeta, version):
+    """
+    Apunta ACTUAL a la nueva versión (os.replace es atómico) y borra las versiones antiguas.
+    La versión anterior se conserva hasta la próxima generación: un lector que ya resolvió el puntero
+    viejo alcanza a terminar de leerla.
+    """
+    anterior = version_snapshot(carpeta)
+    ruta_tmp = os.path.join(carpeta, ARCHIVO_ACTUAL + '.tmp')
+    with open(ruta_tmp, 'w', encoding='utf-8') as f:
+        f.write(version)
+    os.replace(ruta_tmp, os.path.join(carpeta, ARCHIVO_ACTUAL))
+    for nombre in os.listdir(carpeta):
+        if nombre.startswith(PREFIJO_VERSION) and nombre not in (version, anterior):
+            shutil.rmtree(os.path.join(carpeta, nombre), ignore_errors=True)
+
+def _tabla(df):
+    """DataFrame -> lista de registros (los tipos de numpy los resuelve PlotlyJSONEncoder)."""
+    return df.to_dict(orient='records')
+
+def _figura(contenido):
+    """Figura (dict) de un dcc.Graph, o None si el contenido es el mensaje de "Datos no disponibles"."""
+    figura = getattr(contenido, 'figure', None)
+    return figura.to_plotly_json() if figura is not None else None
+
+def _escribir_json(ruta, datos):
+    with open(ruta, 'w', encoding='utf-8') as f:
+        json.dump(datos, f, cls=PlotlyJSONEncoder, ensure_ascii=False)
+
+def generar_snapshot(engine, carpeta=CARPETA_SNAPSHOT):
+    """
+    Calcula los KPIs de 'ALL' y de cada año, arma sus gráficos con las mismas funciones del dashboard
+    y los guarda en una nueva versión dentro de 'carpeta' (un JSON por cohorte más el manifest). Los KPIs de
+    las cohortes siguientes se calculan en otros hilos mientras se arman los gráficos de la actual. ACTUAL pasa a
+    la nueva versión solo al final, para que un dashboard en modo snapshot nunca lea un snapshot a medio escribir.
+    """
+    # Import diferido: analysis crea la app de Dash y a su vez lee el snapshot con este módulo
+    from analysis import (parametros_cohorte, build_fig_kpi1, build_chart_kpi2, build_chart_kpi3,
+                          build_chart_kpi4, build_chart_kpi5, build_chart_kpi6, build_chart_kpi7)
+    from queries import (kpi1_permanencia_ecas, kpis_destino_fuga, kpi5_titulacion_fuga_estimada,
+                         kpi6_supervivencia, kpi7_trayectoria_fugados)
+
+    inicio_total = time.perf_counter()
+    version = f"{PREFIJO_VERSION}{datetime.now():%Y%m%d_%H%M%S}_{uuid.uuid4().hex[:8]}"
+    carpeta_nueva = os.path.join(carpeta, version)
+    os.makedirs(carpeta_nueva)
+
+    df_permanencia_full, tasa_general_permanencia = kpi1_permanencia_ecas(engine)
+    years_available = sorted(int(y) for y in df_permanencia_full['Año'].unique())
+
+    def calcular_kpis(selected_year):
+        anio_n_param = parametros_cohorte(selected_year)[0]
+        df_fuga, df_kpi2, df_kpi3, df_kpi4 = kpis_destino_fuga(engine, anio_n=anio_n_param)
+        df_kpi5, total_estimado = kpi5_titulacion_fuga_estimada(engine, anio_n=anio_n_param)
+        return (df_fuga, df_kpi2, df_kpi3, df_kpi4, df_kpi5, total_estimado,
+                kpi6_supervivencia(engine, anio_n=anio_n_param), kpi7_trayectoria_fugados(engine, anio_n=anio_n_param))
+
+    inicio = time.perf_counter()
+    for selected_year, resultados in en_paralelo(calcular_kpis, ['ALL'] + years_available):
+        if isinstance(resultados, Exception):
+            shutil.rmtree(carpeta_nueva)
+            return False, f"Error al calcular la cohorte {selected_year}: {resultados}"
+        df_fuga, df_kpi2, df_kpi3, df_kpi4, df_kpi5, total_estimado, df_kpi6, df_kpi7 = resultados
+        title_suffix = parametros_cohorte(selected_year)[1]
+
+        hay_fuga = not df_fuga.empty
+        _escribir_json(_ruta_cohorte(carpeta_nueva, selected_year), {
+            'title_suffix': title_suffix,
+            'total_fugados': int(df_fuga['MRUN'].nunique()),
+            'kpi2': {'figura': _figura(build_chart_kpi2(df_kpi2, title_suffix)) if hay_fuga else None, 'tabla': _tabla(df_kpi2)},
+            'kpi3': {'figura': _figura(build_chart_kpi3(df_kpi3, title_suffix)) if hay_fuga else None, 'tabla': _tabla(df_kpi3)},
+            'kpi4': {'figura': _figura(build_chart_kpi4(df_kpi4, title_suffix)) if hay_fuga else None, 'tabla': _tabla(df_kpi4)},
+            'kpi5': {'figura': _figura(build_chart_kpi5(df_kpi5, total_estimado, title_suffix)), 'tabla': _tabla(df_kpi5),
+                     'total_estimado': int(total_estimado)},
+            'kpi6': {'figura': _figura(build_chart_kpi6(df_kpi6, title_suffix)) if not df_kpi6.empty else None, 'tabla': _tabla(df_kpi6)},
+            'kpi7': {'figura': _figura(build_chart_kpi7(df_kpi7, title_suffix)) if not df_kpi7.empty else None, 'tabla': _tabla(df_kpi7)},
+        })
+        print(f"Snapshot de la cohorte {selected_year} listo a los {time.perf_counter() - inicio:.2f} s.")
+
+    _escribir_json(os.path.join(carpeta_nueva, ARCHIVO_MANIFEST), {
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'version_datos': version_datos(),
+        'years_available': years_available,
+        'tasa_general_permanencia': tasa_general_permanencia,
+        'kpi1': {
+            'figura': build_fig_kpi1(df_permanencia_full, tasa_general_permanencia).to_plotly_json(),
+            'tabla': _tabla(df_permanencia_full),
+        },
+    })
+
+    _publicar_version(carpeta, version)
+    return True, f"Snapshot de {len(years_available) + 1} cohortes guardado en '{carpeta}' ({time.perf_counter() - inicio_total:.1f} s)."
+
+def leer_manifest(carpeta=CARPETA_SNAPSHOT):
+    """
+    Manifest de la versión vigente del snapshot, con la serie del KPI 1 como DataFrame en 'df_permanencia_full'
+    y el nombre de la versión en 'version_snapshot'.
+    """
+    version, carpeta_version = _carpeta_version(carpeta)
+    with open(os.path.join(carpeta_version, ARCHIVO_MANIFEST), 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    manifest['df_permanencia_full'] = pd.DataFrame(manifest['kpi1']['tabla'])
+    manifest['version_snapshot'] = version
+    return manifest
+
+def leer_cohorte(selected_year, carpeta=CARPETA_SNAPSHOT):
+    """
+    Datos de una cohorte de la versión vigente del snapshot; cada archivo se lee una sola vez por versión,
+    así un dashboard en marcha toma el snapshot nuevo apenas se publica.
+    """
+    version, carpeta_version = _carpeta_version(carpeta)
+    clave = (carpeta, version, str(selected_year))
+    with _lock:
+        if clave not in _cohortes_leidas:
+            with open(_ruta_cohorte(carpeta_version, selected_year), 'r', encoding='utf-8') as f:
+                datos = json.load(f)
+            # Las cohortes de versiones anteriores ya no se van a pedir
+            for clave_leida in [c for c in _cohortes_leidas if c[0] == carpeta and c[1] != version]:
+                del _cohortes_leidas[clave_leida]
+            _cohortes_leidas[clave] = datos
+        return _cohortes_leidas[clave]
+
+def limpiar_snapshot_leido():
+    """Olvida las cohortes ya leídas."""
+    with _lock:
+        _cohortes_leidas.clear()
+
+if __name__ == '__main__':
+    from connector_db import get_db_engine
+    engine = get_db_engine()
+    if engine:
+        success, message = generar_snapshot(engine)
+        print(message)
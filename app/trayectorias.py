@@ -0,0 +1,266 @@
+#Archivo para el motor de trayectorias: la matrícula completa de cada MRUN como una línea de tiempo ordenada
+#(año, institución, carrera) en arreglos de enteros, con el rango de filas de cada estudiante (offsets).
+#Además guarda por estudiante los años matriculados como bits (bit i = año anio_base + i), así las preguntas
+#de varios años (supervivencia a k años, retorno, titulación estimada) se responden con operaciones vectorizadas.
+#Las líneas de tiempo se arman sobre la matrícula en memoria (matricula_memoria.py): no es otra copia leída de la
+#vista, solo sus columnas numéricas reordenadas por estudiante, y hereda su tratamiento de las claves nulas.
+
+import threading
+import numpy as np
+import pandas as pd
+from cache_kpis import version_datos
+from instrumentacion import medir_etapa
+from matricula_memoria import COD_INST_NULO, get_matricula_memoria
+from queries import COD_INST_ECAS, DURACION_DIURNA_SEMESTRES, DURACION_VESPERTINA_SEMESTRES
+
+K_MAX = 6   # Años hacia adelante de las curvas
+BITS_ANIOS = 63   # Años que caben en los bits de un int64 sin tocar el bit de signo
+
+_trayectorias = {}
+_lock = threading.Lock()
+
+@medir_etapa('trayectorias.carga')
+def cargar_trayectorias(almacen):
+    """
+    Arma las líneas de tiempo a partir del almacén de la matrícula en memoria. Las filas quedan ordenadas por
+    (MRUN, año, codigo_unico); las de un estudiante i (su MRUN_ID) son inicios[i]:inicios[i + 1].
+    Las carreras se guardan como códigos de sus categorías ordenadas, así el menor código es el menor codigo_unico.
+    """
+    df = almacen['df']
+    if df.empty:
+        return None
+
+    # El almacén está ordenado por (año, MRUN_ID, codigo_unico): un orden estable por MRUN_ID deja (MRUN_ID, año, codigo_unico)
+    orden = np.argsort(df['MRUN_ID'].to_numpy(), kind='stable')
+    estudiante = df['MRUN_ID'].to_numpy()[orden]
+    anio = df['ANIO'].to_numpy()[orden]
+    anio_base, anio_max = int(anio.min()), int(anio.max())
+    if anio_max - anio_base >= BITS_ANIOS:
+        raise ValueError(f"Las trayectorias guardan los años como bits de un int64: el rango {anio_base}-{anio_max} "
+                         f"supera los {BITS_ANIOS} años que caben.")
+
+    inicios = np.concatenate([[0], np.cumsum(np.bincount(estudiante, minlength=len(almacen['mruns'])))]).astype('int64')
+    # Primera fila de cada (estudiante, año), con su clave ordenada para buscar el destino de la fuga
+    primeras = np.flatnonzero(np.concatenate([[True], (estudiante[1:] != estudiante[:-1]) | (anio[1:] != anio[:-1])]))
+
+    tray = {
+        'mruns': almacen['mruns'],
+        'inicios': inicios,
+        'estudiante': estudiante,
+        'anio': anio,
+        'cod_inst': df['cod_inst'].to_numpy()[orden],
+        'vespertina': df['VESPERTINA'].to_numpy()[orden],
+        'anio_ingreso': df['anio_ing_carr_ori'].to_numpy()[orden],
+        'codigo': df['codigo_unico'].cat.codes.to_numpy()[orden].astype('int32'),
+        'nombre': df['nomb_carrera'].cat.codes.to_numpy()[orden].astype('int32'),
+        'nombres': np.asarray(df['nomb_carrera'].cat.categories, dtype=object),
+        'duracion': df['duracion'].to_numpy()[orden],
+        'primeras': primeras,
+        'anio_base': anio_base,
+        'anio_max': anio_max,
+        'bits_institucion': {},
+    }
+    tray['claves_primeras'] = _clave_anio(tray, estudiante[primeras], anio[primeras])
+    tray['bits_sistema'] = np.bitwise_or.reduceat(_bits_fila(tray), inicios[:-1])
+    return tray
+
+def get_trayectorias(db_conn):
+    """Devuelve las trayectorias del proceso, armadas una sola vez por versión de los datos sobre la matrícula en memoria."""
+    clave = (str(getattr(db_conn, 'url', '')), version_datos())
+    almacen = get_matricula_memoria(db_conn)
+    with _lock:
+        if clave not in _trayectorias:
+            _trayectorias.clear()
+            _trayectorias[clave] = cargar_trayectorias(almacen)
+        return _trayectorias[clave]
+
+def _bits_fila(tray, filas=slice(None)):
+    return np.left_shift(np.int64(1), (tray['anio'][filas] - tray['anio_base']).astype('int64'))
+
+def _clave_anio(tray, estudiante, anio):
+    """Clave entera de (estudiante, año), en el mismo orden que las filas (admite el año anio_max + 1)."""
+    return estudiante.astype('int64') * (tray['anio_max'] - tray['anio_base'] + 2) + (anio.astype('int64') - tray['anio_base'])
+
+def _primera_fila(tray, estudiante, anio):
+    """Fila de la primera matrícula (menor codigo_unico) de cada (estudiante, año), o -1 si no tiene matrícula ese año."""
+    claves = _clave_anio(tray, estudiante, anio)
+    posiciones = np.minimum(np.searchsorted(tray['claves_primeras'], claves), len(tray['claves_primeras']) - 1)
+    return np.where(tray['claves_primeras'][posiciones] == claves, tray['primeras'][posiciones], -1)
+
+def bits_institucion(tray, cod_inst):
+    """Años en que cada estudiante está matriculado en cod_inst (bits). Se calcula una vez por institución."""
+    cod_inst = int(cod_inst)
+    with _lock:
+        if cod_inst not in tray['bits_institucion']:
+            bits = np.where(tray['cod_inst'] == cod_inst, _bits_fila(tray), 0)
+            tray['bits_institucion'][cod_inst] = np.bitwise_or.reduceat(bits, tray['inicios'][:-1])
+        return tray['bits_institucion'][cod_inst]
+
+def _estudiantes_institucion(tray, cod_inst):
+    """(bits, ids) de los estudiantes que alguna vez estuvieron en cod_inst: las cohortes se recorren solo sobre ellos."""
+    bits_inst = bits_institucion(tray, cod_inst)
+    ids = np.flatnonzero(bits_inst)
+    return bits_inst[ids], ids
+
+def _en_anio(bits, anio, tray):
+    return ((bits >> (anio - tray['anio_base'])) & 1).astype(bool)
+
+def _cohortes(tray, anio_n):
+    return [int(anio_n)] if anio_n else list(range(tray['anio_base'], tray['anio_max']))
+
+@medir_etapa('trayectorias.supervivencia')
+def curva_supervivencia(tray, cod_inst=COD_INST_ECAS, anio_n=None, k_max=K_MAX):
+    """
+    De los estudiantes de cod_inst en el año N, cuántos siguen en la institución y en el sistema en N+k.
+    Con anio_n=None se suman todas las cohortes, cada k solo con las cohortes que ya tienen el año N+k.
+    La tasa en la institución a k = 1 es la permanencia del KPI 1.
+    """
+    bits_inst, ids = _estudiantes_institucion(tray, cod_inst)
+    bits_sistema = tray['bits_sistema'][ids]
+    estudiantes, en_inst, en_sistema = np.zeros(k_max + 1, 'int64'), np.zeros(k_max + 1, 'int64'), np.zeros(k_max + 1, 'int64')
+
+    for anio in _cohortes(tray, anio_n):
+        cohorte = _en_anio(bits_inst, anio, tray)
+        b_inst, b_sistema = bits_inst[cohorte], bits_sistema[cohorte]
+        for k in range(min(k_max, tray['anio_max'] - anio) + 1):
+            estudiantes[k] += len(b_inst)
+            en_inst[k] += _en_anio(b_inst, anio + k, tray).sum()
+            en_sistema[k] += _en_anio(b_sistema, anio + k, tray).sum()
+
+    df = pd.DataFrame({'Años': np.arange(k_max + 1), 'Estudiantes': estudiantes,
+                       'En_Institucion': en_inst, 'En_Sistema': en_sistema})
+    df = df[df['Estudiantes'] > 0].reset_index(drop=True)
+    df['Tasa_Institucion'] = (df['En_Institucion'] / df['Estudiantes'] * 100).round(2)
+    df['Tasa_Sistema'] = (df['En_Sistema'] / df['Estudiantes'] * 100).round(2)
+    return df
+
+def fugados(tray, cod_inst=COD_INST_ECAS, anio_n=None):
+    """
+    Estudiantes (ids) que se fugan de cod_inst entre N y N+1, con su año N. Es la regla de la fuga base
+    (get_df_fuga_base): el origen es su primera fila de cod_inst en N, dentro de la duración teórica de la carrera,
+    y su primera fila de N+1 es de otra institución (no nula). Con anio_n=None cada estudiante cuenta una vez, en su primera fuga.
+    """
+    cod_inst = int(cod_inst)
+    filas = np.flatnonzero(tray['cod_inst'] == cod_inst)
+    estudiante, anio = tray['estudiante'][filas], tray['anio'][filas]
+    # Primera fila de cod_inst de cada (estudiante, año): las filas ya vienen ordenadas por codigo_unico
+    primera = np.concatenate([[True], (estudiante[1:] != estudiante[:-1]) | (anio[1:] != anio[:-1])])[:len(filas)]
+    filas = filas[primera]
+
+    anio = tray['anio'][filas].astype('int64')
+    en_cohorte = (anio == int(anio_n)) if anio_n else (anio < tray['anio_max'])
+    duracion_teorica = np.where(tray['vespertina'][filas], DURACION_VESPERTINA_SEMESTRES, DURACION_DIURNA_SEMESTRES)
+    dentro_duracion = (anio - tray['anio_ingreso'][filas]) * 2 < duracion_teorica
+    filas = filas[en_cohorte & dentro_duracion]
+
+    destino = _primera_fila(tray, tray['estudiante'][filas], tray['anio'][filas] + 1)
+    filas, destino = filas[destino >= 0], destino[destino >= 0]
+    cod_inst_destino = tray['cod_inst'][destino]
+    filas = filas[(cod_inst_destino != cod_inst) & (cod_inst_destino != COD_INST_NULO)]
+
+    ids, anios = tray['estudiante'][filas].astype('int64'), tray['anio'][filas].astype('int64')
+    ids, primera = np.unique(ids, return_index=True)   # Las filas están ordenadas por año: la primera es la menor
+    return ids, anios[primera]
+
+def _filas_estudiantes(tray, ids):
+    """Filas (ordenadas) de los estudiantes ids y el índice local (0..len(ids)-1) del estudiante de cada fila."""
+    inicios = tray['inicios'][ids]
+    largos = tray['inicios'][ids + 1] - inicios
+    desplazamiento = np.repeat(inicios - (np.cumsum(largos) - largos), largos)
+    return np.arange(largos.sum()) + desplazamiento, np.repeat(np.arange(len(ids)), largos)
+
+@medir_etapa('trayectorias.titulacion')
+def titulacion_estimada(tray, ids):
+    """
+    Misma regla del KPI 5 sobre las trayectorias: la última carrera (con duración conocida) de cada estudiante
+    es la de su mayor año (el menor codigo_unico si hay empate); se estima titulado si sus años matriculado en
+    ella alcanzan la duración teórica. Devuelve un DataFrame por carrera final titulada (id local, nombre,
+    año de titulación estimado = año en que se completa la duración).
+    """
+    filas, estudiante = _filas_estudiantes(tray, ids)
+    conocida = tray['duracion'][filas] >= 0
+    filas, estudiante = filas[conocida], estudiante[conocida]
+    columnas = ['ESTUDIANTE', 'NOMBRE', 'ANIO_TITULACION']
+    if len(filas) == 0:
+        return pd.DataFrame(columns=columnas)
+
+    anio, codigo = tray['anio'][filas], tray['codigo'][filas]
+
+    # Última carrera: primera fila (menor código) del último año de cada estudiante
+    ultimo = np.concatenate([np.flatnonzero(np.diff(estudiante)), [len(estudiante) - 1]])
+    anio_final = np.empty(len(ids), dtype=anio.dtype)
+    anio_final[estudiante[ultimo]] = anio[ultimo]
+    en_ultimo_anio = anio == anio_final[estudiante]
+    con_ultimo, primera = np.unique(estudiante[en_ultimo_anio], return_index=True)
+    codigo_final = np.full(len(ids), -1, dtype='int32')
+    codigo_final[con_ultimo] = codigo[en_ultimo_anio][primera]
+
+    # Años distintos en la carrera final, por (carrera, nombre, duración) como en el groupby del KPI 5
+    en_final = (codigo == codigo_final[estudiante]) & (codigo >= 0) & (tray['nombre'][filas] >= 0)
+    df = pd.DataFrame({
+        'ESTUDIANTE': estudiante[en_final],
+        'NOMBRE': tray['nombre'][filas][en_final],
+        'DURACION': tray['duracion'][filas][en_final],
+        'ANIO': anio[en_final],
+    }).drop_duplicates()
+    grupo = df.groupby(['ESTUDIANTE', 'NOMBRE', 'DURACION'], sort=False)
+    df['ANIOS'] = grupo['ANIO'].transform('size')
+    df['ORDEN'] = grupo.cumcount() + 1
+    necesarios = np.maximum(np.ceil(df['DURACION'] / 2), 1)
+
+    titulados = df[(df['ANIOS'] >= df['DURACION'] / 2) & (df['ORDEN'] == necesarios)]
+    return titulados.rename(columns={'ANIO': 'ANIO_TITULACION'})[columnas].reset_index(drop=True)
+
+def kpi5_trayectorias(tray, mruns_fugados):
+    """(resultados por carrera, total estimado) del KPI 5 para una lista de MRUN, igual que kpi5_titulacion_fuga_estimada."""
+    mruns_fugados = np.unique(np.asarray(mruns_fugados, dtype='int64'))
+    posiciones = np.minimum(np.searchsorted(tray['mruns'], mruns_fugados), len(tray['mruns']) - 1)
+    ids = posiciones[tray['mruns'][posiciones] == mruns_fugados]
+
+    titulados = titulacion_estimada(tray, ids)
+    if titulados.empty:
+        return pd.DataFrame({'NOMB_CARRERA': [], 'Titulados_Estimados': []}), 0
+
+    titulados['nomb_carrera'] = tray['nombres'][titulados['NOMBRE'].to_numpy()]
+    resultados_carrera = titulados.groupby('nomb_carrera')['ESTUDIANTE'].nunique().reset_index(name='Titulados_Estimados')
+    return resultados_carrera, titulados['ESTUDIANTE'].nunique()
+
+@medir_etapa('trayectorias.fugados')
+def trayectoria_fugados(tray, cod_inst=COD_INST_ECAS, anio_n=None, k_max=K_MAX):
+    """
+    Para los fugados de la cohorte (ver fugados), porcentaje acumulado que volvió a cod_inst y que se estima
+    titulado, k años después de su último año en la institución. Cada k usa solo los fugados con N+k observado.
+    """
+    ids, anio_fuga = fugados(tray, cod_inst, anio_n)
+    if len(ids) == 0:
+        return pd.DataFrame(columns=['Años', 'Fugados', 'Retornaron', 'Titulados', 'Tasa_Retorno', 'Tasa_Titulacion'])
+
+    # Primer año de retorno: bit más bajo de los años en la institución posteriores a N+1
+    posteriores = bits_institucion(tray, cod_inst)[ids] >> (anio_fuga + 2 - tray['anio_base'])
+    volvio = posteriores != 0
+    anio_retorno = np.where(volvio, anio_fuga + 2 + np.log2(np.where(volvio, posteriores & -posteriores, 1)).astype('int64'), np.iinfo('int64').max)
+
+    titulados = titulacion_estimada(tray, ids).groupby('ESTUDIANTE')['ANIO_TITULACION'].min()
+    anio_titulacion = np.full(len(ids), np.iinfo('int64').max)
+    anio_titulacion[titulados.index.to_numpy()] = titulados.to_numpy()
+
+    filas = []
+    for k in range(1, k_max + 1):
+        observados = anio_fuga + k <= tray['anio_max']
+        if not observados.any():
+            break
+        filas.append({
+            'Años': k,
+            'Fugados': int(observados.sum()),
+            'Retornaron': int((anio_retorno[observados] <= anio_fuga[observados] + k).sum()),
+            'Titulados': int((anio_titulacion[observados] <= anio_fuga[observados] + k).sum()),
+        })
+
+    df = pd.DataFrame(filas, columns=['Años', 'Fugados', 'Retornaron', 'Titulados'])
+    df['Tasa_Retorno'] = (df['Retornaron'] / df['Fugados'] * 100).round(2)
+    df['Tasa_Titulacion'] = (df['Titulados'] / df['Fugados'] * 100).round(2)
+    return df
+
+def uso_memoria(tray):
+    """Bytes de los arreglos de las trayectorias (sin los bits por institución calculados después)."""
+    return int(sum(v.nbytes for v in tray.values() if isinstance(v, np.ndarray)))
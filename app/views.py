@@ -1,11 +1,19 @@
 #Archivo para la creación de vistas, como la vista unificada.
 
 from connector_db import get_db_engine
-from sqlalchemy import text
+from cache_kpis import actualizar_version_datos
+from queries import COD_INST_ECAS, DURACION_DIURNA_SEMESTRES, DURACION_VESPERTINA_SEMESTRES, guardar_serie_permanencia
+from matriz_transiciones import guardar_matriz_transiciones
+from sqlalchemy import inspect, text
+import re
 
 #Metodo para obtener los nombres de las tablas que utilizaremos.
 def get_table_names(engine):
    
+    if engine.dialect.name != 'mssql':
+        # Bases locales (SQLite/DuckDB): se filtran los nombres con la misma regla que el LIKE de SQL Server
+        return sorted(t for t in inspect(engine).get_table_names() if re.match(r'^matricula_[0-9]', t))
+
     query = """
     SELECT TABLE_NAME 
     FROM INFORMATION_SCHEMA.TABLES 
@@ -23,9 +31,135 @@ def get_table_names(engine):
         print(f"ERROR al obtener nombres de tablas: {e}")
         return []
 
-def create_unified_view():
-    """Crea o reemplaza la vista unificada 'vista_matriculas_unificada'."""
-    engine = get_db_engine()
+#Orden de las filas de un mismo (año, mrun): codigo_unico con los nulos primero (explícito, porque DuckDB
+#ordena los nulos al final y SQL Server/SQLite al principio). Es el orden que usa también la fuga en pandas.
+ORDEN_CODIGO_UNICO = "CASE WHEN codigo_unico IS NULL THEN 0 ELSE 1 END, codigo_unico"
+
+#Matrícula deduplicada: una fila por (año, mrun), priorizando la fila de ECAS y luego codigo_unico.
+#Para ECAS es su primera fila del año, así sirve para la presencia en ECAS (KPI 1) y como origen de la fuga.
+SELECT_MATRICULA_DEDUPLICADA = f"""
+SELECT 
+    cat_periodo, mrun, cod_inst, nomb_inst, nomb_carrera, area_conocimiento, 
+    codigo_unico, jornada, anio_ing_carr_ori
+FROM (
+    SELECT 
+        cat_periodo, mrun, cod_inst, nomb_inst, nomb_carrera, area_conocimiento, 
+        codigo_unico, jornada, anio_ing_carr_ori,
+        ROW_NUMBER() OVER (
+            PARTITION BY cat_periodo, mrun
+            ORDER BY CASE WHEN cod_inst = {COD_INST_ECAS} THEN 0 ELSE 1 END, {ORDEN_CODIGO_UNICO}
+        ) AS fila
+    FROM vista_matriculas_unificada
+) AS m
+WHERE fila = 1
+"""
+
+#Primera fila de cada (año, mrun) sin prioridad de institución: el destino de la fuga es la primera matrícula
+#del año N+1, como en el cálculo original (drop_duplicates sobre MRUN). Un estudiante con matrícula en ECAS y
+#en otra institución en N+1 cuenta como fuga si la fila de la otra institución va primero.
+SELECT_PRIMERA_MATRICULA = f"""
+SELECT 
+    cat_periodo, mrun, cod_inst, nomb_inst, nomb_carrera, area_conocimiento
+FROM (
+    SELECT 
+        cat_periodo, mrun, cod_inst, nomb_inst, nomb_carrera, area_conocimiento,
+        ROW_NUMBER() OVER (PARTITION BY cat_periodo, mrun ORDER BY {ORDEN_CODIGO_UNICO}) AS fila
+    FROM vista_matriculas_unificada
+) AS p
+WHERE fila = 1
+"""
+
+#Transiciones año N -> N+1 de los estudiantes de ECAS (destino NULL si no hay matrícula en N+1)
+SELECT_TRANSICIONES_ECAS = f"""
+SELECT 
+    n.mrun AS MRUN, 
+    n.cat_periodo AS ANIO_INICIAL,
+    n.nomb_inst AS INST_ORIGEN, 
+    n.nomb_carrera AS CARRERA_ORIGEN, 
+    n.area_conocimiento AS AREA_ORIGEN,
+    d.cod_inst AS COD_INST_DESTINO, 
+    d.nomb_inst AS INST_DESTINO, 
+    d.nomb_carrera AS CARRERA_DESTINO, 
+    d.area_conocimiento AS AREA_DESTINO,
+    CASE 
+        WHEN (n.cat_periodo - n.anio_ing_carr_ori) * 2 < 
+             CASE WHEN n.jornada LIKE '%Vespertino%' THEN {DURACION_VESPERTINA_SEMESTRES} ELSE {DURACION_DIURNA_SEMESTRES} END 
+        THEN 1 ELSE 0 
+    END AS DENTRO_DURACION
+FROM 
+    matricula_deduplicada n
+    LEFT JOIN ({SELECT_PRIMERA_MATRICULA}) d 
+        ON d.mrun = n.mrun AND d.cat_periodo = n.cat_periodo + 1
+WHERE 
+    n.cod_inst = {COD_INST_ECAS}
+"""
+
+def create_materialized_tables(engine):
+    """
+    Materializa las tablas indexadas que leen los KPIs a partir de la vista unificada:
+    'matricula_deduplicada' y 'transiciones_ecas'. Se reconstruyen por completo en cada llamada.
+    """
+    if engine.dialect.name != 'mssql':
+        return create_materialized_tables_local(engine, get_table_names(engine))
+
+    materialize_queries = [
+        "IF OBJECT_ID('dbo.transiciones_ecas', 'U') IS NOT NULL DROP TABLE dbo.transiciones_ecas;",
+        "IF OBJECT_ID('dbo.matricula_deduplicada', 'U') IS NOT NULL DROP TABLE dbo.matricula_deduplicada;",
+
+        f"SELECT * INTO dbo.matricula_deduplicada FROM ({SELECT_MATRICULA_DEDUPLICADA}) AS t;",
+        "CREATE UNIQUE CLUSTERED INDEX ix_matricula_deduplicada_mrun ON dbo.matricula_deduplicada (mrun, cat_periodo);",
+        "CREATE NONCLUSTERED INDEX ix_matricula_deduplicada_periodo ON dbo.matricula_deduplicada (cat_periodo, cod_inst) INCLUDE (mrun);",
+
+        f"SELECT * INTO dbo.transiciones_ecas FROM ({SELECT_TRANSICIONES_ECAS}) AS t;",
+        "CREATE UNIQUE CLUSTERED INDEX ix_transiciones_ecas_anio ON dbo.transiciones_ecas (ANIO_INICIAL, MRUN);",
+    ]
+
+    try:
+        with engine.connect() as connection:
+            for query in materialize_queries:
+                connection.execute(text(query))
+            connection.commit()
+
+            return True, "Tablas 'matricula_deduplicada' y 'transiciones_ecas' materializadas."
+
+    except Exception as e:
+        return False, f"ERROR al materializar las tablas: {e}"
+
+def create_materialized_tables_local(engine, table_names):
+    """
+    Mismas tablas que create_materialized_tables para bases locales (SQLite/DuckDB), sin sintaxis T-SQL.
+    Además indexa mrun en cada matricula_AÑO: sin ese índice SQLite resuelve la historia de los fugados
+    de una cohorte (KPI 5) recorriendo la vista unificada completa por cada tabla.
+    """
+    materialize_queries = [f"CREATE INDEX IF NOT EXISTS ix_{table}_mrun ON {table} (mrun);" for table in table_names] + [
+        "DROP TABLE IF EXISTS transiciones_ecas;",
+        "DROP TABLE IF EXISTS matricula_deduplicada;",
+
+        f"CREATE TABLE matricula_deduplicada AS {SELECT_MATRICULA_DEDUPLICADA};",
+        "CREATE UNIQUE INDEX ix_matricula_deduplicada_mrun ON matricula_deduplicada (mrun, cat_periodo);",
+        "CREATE INDEX ix_matricula_deduplicada_periodo ON matricula_deduplicada (cat_periodo, cod_inst);",
+
+        f"CREATE TABLE transiciones_ecas AS {SELECT_TRANSICIONES_ECAS};",
+        "CREATE UNIQUE INDEX ix_transiciones_ecas_anio ON transiciones_ecas (ANIO_INICIAL, MRUN);",
+    ]
+
+    try:
+        with engine.begin() as connection:
+            for query in materialize_queries:
+                connection.execute(text(query))
+
+        return True, "Tablas 'matricula_deduplicada' y 'transiciones_ecas' materializadas."
+
+    except Exception as e:
+        return False, f"ERROR al materializar las tablas: {e}"
+
+def create_unified_view(anio_nuevo=None, engine=None):
+    """
+    Crea o reemplaza la vista unificada 'vista_matriculas_unificada' y sus tablas materializadas.
+    Si anio_nuevo indica el único año recién agregado, la serie del KPI 1 solo suma ese par de años.
+    Por defecto usa el engine de get_db_engine(); se puede entregar otro (ej. una base SQLite de prueba).
+    """
+    engine = engine or get_db_engine()
     if not engine:
         return False, "Error de conexión a la DB."
         
@@ -38,6 +172,10 @@ def create_unified_view():
     IF OBJECT_ID('dbo.vista_matriculas_unificada', 'V') IS NOT NULL
         DROP VIEW dbo.vista_matriculas_unificada;
     """
+    esquema = 'dbo.'
+    if engine.dialect.name != 'mssql':
+        drop_query = "DROP VIEW IF EXISTS vista_matriculas_unificada;"
+        esquema = ''
     
     # Construcción de la parte UNION ALL
     select_statements = []
@@ -56,13 +194,13 @@ def create_unified_view():
             dur_estudio_carr, 
             dur_proceso_tit,
             anio_ing_carr_ori
-        FROM dbo.{table}
+        FROM {esquema}{table}
         """)
 
     union_query = "\nUNION ALL\n".join(select_statements)
 
     create_view_query = f"""
-    CREATE VIEW dbo.vista_matriculas_unificada AS
+    CREATE VIEW {esquema}vista_matriculas_unificada AS
     {union_query};
     """
 
@@ -76,11 +214,29 @@ def create_unified_view():
             connection.execute(text(create_view_query))
             connection.commit()
             
-            return True, f"Vista 'vista_matriculas_unificada' creada/actualizada con {len(table_names)} tablas."
-            
     except Exception as e:
         return False, f"ERROR al crear la vista SQL: {e}"
 
+    #Materializar las tablas indexadas que leen los KPIs, la serie de permanencia (KPI 1) y la matriz de transiciones
+    success, message = create_materialized_tables(engine)
+    if success:
+        try:
+            guardar_serie_permanencia(engine, anio_nuevo=anio_nuevo)
+        except Exception as e:
+            success, message = False, f"ERROR al guardar la serie de permanencia: {e}"
+    if success:
+        try:
+            guardar_matriz_transiciones(engine, anio_nuevo=anio_nuevo)
+        except Exception as e:
+            success, message = False, f"ERROR al guardar la matriz de transiciones: {e}"
+    
+    # La vista cambió: invalidar los resultados cacheados de los KPIs
+    actualizar_version_datos()
+    
+    if not success:
+        return False, message
+    return True, f"Vista 'vista_matriculas_unificada' creada/actualizada con {len(table_names)} tablas. {message}"
+
 if __name__ == '__main__':
     success, message = create_unified_view()
     print(message)
\ No newline at end of file
@@ -0,0 +1,65 @@
+#Configuración común de las pruebas: los módulos del dashboard viven en app/ y se importan por nombre,
+#y la matrícula de prueba es sintética (datos_sinteticos.py) en una base SQLite temporal.
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+@pytest.fixture(scope='session', autouse=True)
+def directorio_trabajo(tmp_path_factory):
+    """Cada sesión de pruebas trabaja en un directorio temporal (cache/, snapshot/, etc.)."""
+    directorio = tmp_path_factory.mktemp('trabajo')
+    anterior = os.getcwd()
+    os.chdir(directorio)
+    yield directorio
+    os.chdir(anterior)
+
+def matricula_prueba(n_filas=20000, semilla=1):
+    """
+    Matrícula sintética con los casos difíciles de la deduplicación: mucha doble matrícula en el mismo año
+    (ECAS y otra institución), codigo_unico nulo y años de ingreso nulos.
+    """
+    from datos_sinteticos import generar_matricula
+    df = generar_matricula(n_filas=n_filas, anio_inicio=2010, anio_fin=2020, n_instituciones=8, proporcion_ecas=0.3,
+                           tasa_doble_matricula=0.2, semilla=semilla)
+    rng = np.random.default_rng(semilla)
+    df['codigo_unico'] = df['codigo_unico'].where(rng.random(len(df)) >= 0.03, None)
+    return df
+
+@pytest.fixture(scope='session')
+def matricula_df():
+    return matricula_prueba()
+
+@pytest.fixture(scope='session')
+def engine_prueba(matricula_df, directorio_trabajo):
+    """Base SQLite con las tablas matricula_AÑO, la vista unificada y las tablas materializadas."""
+    from sqlalchemy import create_engine
+    from datos_sinteticos import cargar_matricula_sintetica
+    engine = create_engine(f"sqlite:///{directorio_trabajo / 'prueba.db'}")
+    success, message = cargar_matricula_sintetica(matricula_df, engine)
+    assert success, message
+    yield engine
+    engine.dispose()
+
+@pytest.fixture(scope='session')
+def engine_nulos(directorio_trabajo):
+    """Base SQLite como engine_prueba, pero con filas sin año, sin MRUN y sin cod_inst en las tablas anuales."""
+    from sqlalchemy import create_engine, text
+    from datos_sinteticos import cargar_matricula_sintetica
+    from views import create_unified_view, get_table_names
+    engine = create_engine(f"sqlite:///{directorio_trabajo / 'nulos.db'}")
+    success, message = cargar_matricula_sintetica(matricula_prueba(n_filas=8000, semilla=2), engine)
+    assert success, message
+    with engine.begin() as connection:
+        for tabla in get_table_names(engine):
+            connection.execute(text(f"UPDATE {tabla} SET cat_periodo = NULL WHERE rowid % 47 = 0;"))
+            connection.execute(text(f"UPDATE {tabla} SET mrun = NULL WHERE rowid % 43 = 0;"))
+            connection.execute(text(f"UPDATE {tabla} SET cod_inst = NULL WHERE rowid % 41 = 0;"))
+    success, message = create_unified_view(engine=engine)
+    assert success, message
+    yield engine
+    engine.dispose()
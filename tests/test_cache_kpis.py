@@ -0,0 +1,72 @@
+import os
+
+import pandas as pd
+
+import cache_kpis
+from cache_kpis import cache_por_cohorte
+
+class ConexionFalsa:
+    url = 'sqlite://'
+
+def _contador():
+    llamadas = []
+
+    @cache_por_cohorte(derivados=('df_fuga',))
+    def kpi(db_conn, anio_n=None, df_fuga=None):
+        llamadas.append(anio_n)
+        filas = len(df_fuga) if df_fuga is not None else 0
+        return pd.DataFrame({'anio': [anio_n], 'filas': [filas]}), filas
+
+    return kpi, llamadas
+
+def test_cachea_por_cohorte():
+    cache_kpis.limpiar_cache()
+    kpi, llamadas = _contador()
+    kpi(ConexionFalsa(), anio_n=2015)
+    kpi(ConexionFalsa(), anio_n=2015)
+    kpi(ConexionFalsa(), anio_n=2016)
+    assert llamadas == [2015, 2016]
+
+def test_derivado_sin_cohorte_no_usa_cache():
+    cache_kpis.limpiar_cache()
+    kpi, llamadas = _contador()
+    _, filas = kpi(ConexionFalsa(), df_fuga=pd.DataFrame({'MRUN': [1, 2, 3]}))
+    assert filas == 3
+    # Un df_fuga distinto sin cohorte no puede devolver el resultado anterior ni quedar guardado como 'ALL'
+    _, filas = kpi(ConexionFalsa(), df_fuga=pd.DataFrame({'MRUN': [1]}))
+    assert filas == 1
+    _, filas = kpi(ConexionFalsa())
+    assert filas == 0
+    assert len(llamadas) == 3
+
+def test_derivado_con_cohorte_usa_cache():
+    cache_kpis.limpiar_cache()
+    kpi, llamadas = _contador()
+    kpi(ConexionFalsa(), anio_n=2015, df_fuga=pd.DataFrame({'MRUN': [1, 2]}))
+    _, filas = kpi(ConexionFalsa(), anio_n=2015, df_fuga=pd.DataFrame({'MRUN': [1, 2]}))
+    assert filas == 2
+    assert llamadas == [2015]
+
+def test_comparte_el_resultado_sin_copiar():
+    cache_kpis.limpiar_cache()
+    kpi, _ = _contador()
+    df, _ = kpi(ConexionFalsa(), anio_n=2015)
+    df_otra, _ = kpi(ConexionFalsa(), anio_n=2015)
+    assert df_otra is df
+
+def test_version_sin_releer_el_archivo(monkeypatch):
+    version = cache_kpis.actualizar_version_datos()
+
+    def open_prohibido(*args, **kwargs):
+        raise AssertionError("version_datos releyó el archivo sin que cambiara")
+
+    monkeypatch.setattr(cache_kpis, 'open', open_prohibido, raising=False)
+    assert cache_kpis.version_datos() == version
+    monkeypatch.undo()
+
+    # Una carga hecha por otro proceso reemplaza el archivo: el nuevo sello se lee en la siguiente búsqueda
+    ruta_tmp = cache_kpis.ARCHIVO_VERSION + '.otro'
+    with open(ruta_tmp, 'w') as f:
+        f.write('otra_version')
+    os.replace(ruta_tmp, cache_kpis.ARCHIVO_VERSION)
+    assert cache_kpis.version_datos() == 'otra_version'
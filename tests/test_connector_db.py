@@ -0,0 +1,62 @@
+#Medición de consultas y del pool (connector_db.py) sobre un engine SQLite.
+
+import threading
+import time
+
+import pytest
+from sqlalchemy import exc, text
+
+import connector_db
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = connector_db._crear_engine(f"sqlite:///{tmp_path / 'medicion.db'}")
+    yield engine
+    engine.dispose()
+
+def test_medir_consultas_cuenta_las_sentencias(engine):
+    with connector_db.medir_consultas('prueba') as medicion:
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1;"))
+            connection.execute(text("SELECT 2;"))
+    assert medicion['consultas'] == 2
+    assert medicion['checkouts'] == 1
+    assert medicion['segundos_total'] >= medicion['segundos_sql'] >= 0
+
+def test_consulta_con_error_no_deja_inicios(engine):
+    with engine.connect() as connection:
+        for _ in range(3):
+            with pytest.raises(exc.OperationalError):
+                connection.execute(text("SELECT * FROM tabla_inexistente;"))
+            connection.rollback()
+        assert connection.info.get('inicios_consulta') == []
+
+        # Las mediciones siguientes siguen emparejando inicio y fin de cada sentencia
+        with connector_db.medir_consultas('prueba') as medicion:
+            connection.execute(text("SELECT 1;"))
+        assert medicion['consultas'] == 1
+        assert connection.info['inicios_consulta'] == []
+    assert connector_db.estadisticas_conexion()['metricas']['sql.error']['n'] >= 3
+
+def test_en_paralelo_entrega_resultados_y_errores_en_orden():
+    def dividir(x):
+        return 10 // x
+    resultados = list(connector_db.en_paralelo(dividir, [1, 0, 5]))
+    assert [valor for valor, _ in resultados] == [1, 0, 5]
+    assert resultados[0][1] == 10 and resultados[2][1] == 2
+    assert isinstance(resultados[1][1], ZeroDivisionError)
+
+def test_en_paralelo_deja_conexiones_base_libres():
+    assert connector_db.WORKERS_CONSULTAS <= max(1, connector_db.POOL_SIZE - 1)
+    activos, maximo, lock = [0], [0], threading.Lock()
+
+    def consulta(_):
+        with lock:
+            activos[0] += 1
+            maximo[0] = max(maximo[0], activos[0])
+        time.sleep(0.01)
+        with lock:
+            activos[0] -= 1
+
+    list(connector_db.en_paralelo(consulta, range(20), max_workers=connector_db.POOL_SIZE + connector_db.MAX_OVERFLOW))
+    assert maximo[0] <= connector_db.MAX_WORKERS_CONSULTAS
@@ -0,0 +1,39 @@
+#Callbacks del dashboard (analysis.py) llamados directamente, sin servidor: inicialización del estado y
+#respuestas sin conexión a la base de datos.
+
+import pandas as pd
+import pytest
+
+@pytest.fixture
+def analysis(monkeypatch, directorio_trabajo):
+    import analysis
+    # Estado limpio en cada prueba y sin el hilo de precálculo
+    monkeypatch.setattr(analysis, '_estado', {**analysis._estado, 'engine': None, 'snapshot': None,
+                                              'df_permanencia_full': pd.DataFrame(), 'years_available': []})
+    monkeypatch.setattr(analysis, 'precalcular_cohortes', lambda: None)
+    return analysis
+
+def test_falla_del_kpi1_se_reintenta(analysis, engine_prueba, monkeypatch):
+    monkeypatch.setattr(analysis, 'get_db_engine', lambda: engine_prueba)
+    original = analysis.kpi1_permanencia_ecas
+
+    def kpi1_con_falla(*args, **kwargs):
+        raise RuntimeError("tiempo de espera agotado")
+
+    monkeypatch.setattr(analysis, 'kpi1_permanencia_ecas', kpi1_con_falla)
+    assert analysis.get_estado()['engine'] is None
+
+    monkeypatch.setattr(analysis, 'kpi1_permanencia_ecas', original)
+    estado = analysis.get_estado()
+    assert estado['engine'] is engine_prueba
+    assert len(estado['years_available']) > 0
+
+def test_callbacks_sin_conexion(analysis, monkeypatch):
+    monkeypatch.setattr(analysis, 'get_db_engine', lambda: None)
+    for callback in (analysis.update_kpi2, analysis.update_kpi3, analysis.update_kpi4, analysis.update_kpi5,
+                     analysis.update_kpi6, analysis.update_kpi7):
+        contenido = callback('ALL', analysis.COD_INST_ECAS)
+        assert "Sin conexión" in str(contenido)
+    figura = analysis.update_kpi1('ALL', analysis.COD_INST_ECAS)
+    assert "Sin conexión" in str(figura.layout.annotations)
+    assert analysis.update_estado_carga(0)[0].startswith("⚠️ Sin conexión")
@@ -0,0 +1,61 @@
+#Descargas del dashboard (/exportar en analysis.py y exportar_kpis.py): respetan la institución de origen elegida
+#y las tablas de los KPIs se calculan antes de responder.
+
+import io
+
+import pandas as pd
+import pytest
+
+import exportar_kpis
+from queries import COD_INST_ECAS, kpis_destino_fuga
+
+@pytest.fixture
+def analysis(monkeypatch, engine_prueba):
+    import analysis
+    monkeypatch.setattr(analysis, '_estado', {**analysis._estado, 'engine': None, 'snapshot': None,
+                                              'df_permanencia_full': pd.DataFrame(), 'years_available': [],
+                                              'instituciones': {COD_INST_ECAS: 'ECAS'}})
+    monkeypatch.setattr(analysis, 'precalcular_cohortes', lambda: None)
+    monkeypatch.setattr(analysis, 'get_db_engine', lambda: engine_prueba)
+    analysis.get_estado()
+    return analysis
+
+@pytest.fixture
+def otra_inst(analysis):
+    return next(c for c in analysis._estado['instituciones'] if c != COD_INST_ECAS)
+
+def test_enlaces_con_la_institucion(analysis, otra_inst):
+    enlaces = [e.href for e in analysis.update_descargas('ALL', otra_inst) if hasattr(e, 'href')]
+    assert enlaces and all(f"inst={otra_inst}" in e for e in enlaces)
+    assert not any(e.startswith(('/exportar/fuga', '/exportar/kpi5')) for e in enlaces)
+    enlaces_ecas = [e.href for e in analysis.update_descargas('ALL', COD_INST_ECAS) if hasattr(e, 'href')]
+    assert any(e.startswith('/exportar/fuga') and 'formato=parquet' in e for e in enlaces_ecas)
+
+@pytest.mark.parametrize('formato', ['csv', 'parquet'])
+def test_exportar_kpi_de_otra_institucion(analysis, engine_prueba, otra_inst, formato):
+    cliente = analysis.app.server.test_client()
+    respuesta = cliente.get(f"/exportar/kpi2?cohorte=ALL&inst={otra_inst}&formato={formato}")
+    assert respuesta.status_code == 200
+    datos = respuesta.get_data()
+    respuesta.close()   # Libera el turno de descarga, como al terminar de enviarla
+    df = pd.read_csv(io.BytesIO(datos)) if formato == 'csv' else pd.read_parquet(io.BytesIO(datos))
+    esperado = kpis_destino_fuga(engine_prueba, anio_n=None, cod_inst=otra_inst)[1]
+    assert len(esperado) > 0
+    pd.testing.assert_frame_equal(df.reset_index(drop=True), esperado.reset_index(drop=True), check_dtype=False)
+
+    assert cliente.get(f"/exportar/fuga?cohorte=ALL&inst={otra_inst}").status_code == 404
+    assert cliente.get("/exportar/kpi2?cohorte=ALL&inst=999999").status_code == 404
+
+def test_tablas_calculadas_antes_de_responder(analysis, monkeypatch):
+    def kpis_con_falla(*args, **kwargs):
+        raise RuntimeError("tiempo de espera agotado")
+
+    monkeypatch.setattr(exportar_kpis, 'kpis_destino_fuga', kpis_con_falla)
+    # El error sale al armar la respuesta (no a mitad de la descarga) y el turno de descarga queda libre
+    with pytest.raises(RuntimeError):
+        with analysis.app.server.test_request_context("/exportar/kpi3?cohorte=ALL&formato=csv"):
+            analysis.exportar('kpi3')
+    turnos = [exportar_kpis.tomar_turno_exportacion() for _ in range(exportar_kpis.MAX_EXPORTACIONES)]
+    assert all(turnos)
+    for _ in turnos:
+        exportar_kpis.liberar_turno_exportacion()
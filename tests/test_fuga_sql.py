@@ -0,0 +1,97 @@
+#La fuga resuelta en SQL ('transiciones_ecas'), en pandas (calcular_fuga) y en memoria debe ser la misma del
+#cálculo original en pandas, que recorría la vista unificada año a año con drop_duplicates sobre MRUN.
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import queries
+from queries import COD_INST_ECAS, DURACION_DIURNA_SEMESTRES, DURACION_VESPERTINA_SEMESTRES
+from matricula_memoria import cargar_matricula_memoria, calcular_fuga_memoria
+
+COLUMNAS_FUGA = ['MRUN', 'INST_ORIGEN', 'CARRERA_ORIGEN', 'AREA_ORIGEN',
+                 'COD_INST_DESTINO', 'INST_DESTINO', 'CARRERA_DESTINO', 'AREA_DESTINO', 'ANIO_INICIAL']
+
+def fuga_original(df_completo, anio_n=None):
+    """Copia del get_df_fuga_base original (antes de resolverlo en SQL), sin la lectura de la vista."""
+    df_fuga = pd.DataFrame()
+    rango_anios = [anio_n] if anio_n else range(df_completo['ANIO'].min(), df_completo['ANIO'].max())
+
+    for anio in rango_anios:
+        anio_siguiente = anio + 1
+        df_n_ecas = df_completo[(df_completo['ANIO'] == anio) &
+                                (df_completo['cod_inst'] == COD_INST_ECAS)].drop_duplicates(subset=['MRUN'])
+        df_n_ecas['Permanencia_Semestres'] = (df_n_ecas['ANIO'] - df_n_ecas['anio_ing_carr_ori']) * 2
+        df_n_ecas['Duracion_Teorica'] = np.where(
+            df_n_ecas['jornada'].str.contains('Vespertino', na=False),
+            DURACION_VESPERTINA_SEMESTRES,
+            DURACION_DIURNA_SEMESTRES
+        )
+        df_n_filtrado = df_n_ecas[df_n_ecas['Permanencia_Semestres'] < df_n_ecas['Duracion_Teorica']].copy()
+        df_n_filtrado.rename(columns={'nomb_inst': 'INST_ORIGEN', 'nomb_carrera': 'CARRERA_ORIGEN', 'area_conocimiento': 'AREA_ORIGEN'}, inplace=True)
+
+        df_n_mas_1 = df_completo[df_completo['ANIO'] == anio_siguiente].drop_duplicates(subset=['MRUN'])
+        df_n_mas_1 = df_n_mas_1.rename(columns={'cod_inst': 'COD_INST_DESTINO', 'nomb_inst': 'INST_DESTINO', 'nomb_carrera': 'CARRERA_DESTINO', 'area_conocimiento': 'AREA_DESTINO'})
+
+        cols_origen = ['MRUN', 'INST_ORIGEN', 'CARRERA_ORIGEN', 'AREA_ORIGEN']
+        cols_destino = ['MRUN', 'COD_INST_DESTINO', 'INST_DESTINO', 'CARRERA_DESTINO', 'AREA_DESTINO']
+        df_merged = pd.merge(df_n_filtrado[cols_origen], df_n_mas_1[cols_destino], on='MRUN', how='inner')
+        df_merged['ANIO_INICIAL'] = anio
+
+        df_fuga = pd.concat([df_fuga, df_merged[df_merged['COD_INST_DESTINO'] != COD_INST_ECAS]], ignore_index=True)
+
+    return df_fuga
+
+def normalizar(df):
+    df = df[COLUMNAS_FUGA].astype({'MRUN': 'int64', 'COD_INST_DESTINO': 'int64', 'ANIO_INICIAL': 'int64'})
+    return df.sort_values(by=['ANIO_INICIAL', 'MRUN']).reset_index(drop=True)
+
+@pytest.fixture(scope='module')
+def vista(engine_prueba):
+    """Vista unificada en el orden que el cálculo original tomaba como 'primera fila': codigo_unico, nulos primero."""
+    df = queries.get_df_matriculas(engine_prueba)
+    return df.sort_values(by='codigo_unico', kind='stable', na_position='first').reset_index(drop=True)
+
+@pytest.fixture(scope='module')
+def cohortes(vista):
+    return [None] + sorted(int(a) for a in vista['ANIO'].unique())[:-1]
+
+def test_hay_casos_de_doble_matricula(vista):
+    # La prueba solo tiene sentido si hay estudiantes en ECAS y en otra institución el mismo año
+    por_anio = vista.groupby(['ANIO', 'MRUN'])['cod_inst'].agg(lambda c: (c == COD_INST_ECAS).any() and (c != COD_INST_ECAS).any())
+    assert por_anio.sum() > 100
+    assert vista['codigo_unico'].isna().sum() > 0
+
+def test_fuga_sql_igual_a_la_original(engine_prueba, vista, cohortes):
+    for anio_n in cohortes:
+        esperado = normalizar(fuga_original(vista, anio_n))
+        obtenido = normalizar(queries.get_df_fuga_base.sin_cache(engine_prueba, anio_n=anio_n))
+        assert len(esperado) > 0
+        pd.testing.assert_frame_equal(obtenido, esperado, check_dtype=False)
+
+def test_fuga_pandas_igual_a_la_original(vista, cohortes):
+    # calcular_fuga no depende del orden de entrada: se le entrega la vista desordenada
+    desordenada = vista.sample(frac=1, random_state=0)
+    for anio_n in cohortes:
+        pd.testing.assert_frame_equal(normalizar(queries.calcular_fuga(desordenada, anio_n)),
+                                      normalizar(fuga_original(vista, anio_n)), check_dtype=False)
+
+def test_fuga_memoria_igual_a_la_original(engine_prueba, vista, cohortes):
+    almacen = cargar_matricula_memoria(engine_prueba)
+    for anio_n in cohortes:
+        pd.testing.assert_frame_equal(normalizar(calcular_fuga_memoria(almacen, anio_n)),
+                                      normalizar(fuga_original(vista, anio_n)), check_dtype=False)
+
+@pytest.mark.parametrize('nombre_engine', ['engine_prueba', 'engine_nulos'])
+def test_motor_pandas_igual_a_query_fuga(nombre_engine, request, monkeypatch):
+    engine = request.getfixturevalue(nombre_engine)
+    anios = sorted(int(a) for a in queries.kpi1_permanencia_ecas.sin_cache(engine)[0]['Año'])
+    for anio_n in [None] + anios:
+        esperado = normalizar(queries.get_df_fuga_base.sin_cache(engine, anio_n=anio_n))
+        with monkeypatch.context() as m:
+            m.setattr(queries, 'MOTOR_FUGA', 'pandas')
+            obtenido = normalizar(queries.get_df_fuga_base.sin_cache(engine, anio_n=anio_n))
+            lotes = pd.concat(queries.iter_fuga_base(engine, anio_n=anio_n, tamanio_lote=500), ignore_index=True)
+        assert len(esperado) > 0
+        pd.testing.assert_frame_equal(obtenido, esperado, check_dtype=False)
+        pd.testing.assert_frame_equal(normalizar(lotes), esperado, check_dtype=False)
@@ -0,0 +1,61 @@
+import pandas as pd
+import pytest
+
+import queries
+
+@pytest.fixture(scope='module')
+def fuga(engine_prueba):
+    return queries.get_df_fuga_base.sin_cache(engine_prueba)
+
+def _ordenar(df):
+    return df.sort_values(by=['MRUN', 'ANIO', 'CODIGO_UNICO']).reset_index(drop=True)
+
+@pytest.mark.parametrize('anio_n', [2014, None])
+def test_estrategias_entregan_la_misma_historia(engine_prueba, fuga, anio_n):
+    mruns = fuga[fuga['ANIO_INICIAL'] == anio_n]['MRUN'].unique() if anio_n else fuga['MRUN'].unique()
+    esperado = _ordenar(queries._leer_historia_fugados(engine_prueba, anio_n=anio_n, estrategia='subconsulta'))
+    assert len(esperado) > 0
+    for estrategia in ('subconsulta', 'lista_in', 'tabla_temporal'):
+        pd.testing.assert_frame_equal(
+            _ordenar(queries._leer_historia_fugados(engine_prueba, anio_n=anio_n, mruns_fugados=mruns, estrategia=estrategia)),
+            esperado)
+        if estrategia == 'subconsulta':
+            continue
+        # Sin mruns_fugados los MRUN salen de get_df_fuga_base
+        pd.testing.assert_frame_equal(
+            _ordenar(queries._leer_historia_fugados(engine_prueba, anio_n=anio_n, estrategia=estrategia)), esperado)
+
+def test_tabla_temporal_acepta_una_connection(engine_prueba, fuga):
+    mruns = fuga['MRUN'].unique()[:50]
+    with engine_prueba.connect() as connection:
+        df = queries._leer_historia_fugados(connection, mruns_fugados=mruns, estrategia='tabla_temporal')
+        # La tabla temporal se eliminó y la conexión sigue utilizable
+        df_otra = queries._leer_historia_fugados(connection, mruns_fugados=mruns, estrategia='tabla_temporal')
+        connection.commit()
+    assert set(df['MRUN']) <= set(int(m) for m in mruns)
+    pd.testing.assert_frame_equal(df, df_otra)
+
+def test_lista_in_larga_usa_tabla_temporal(engine_prueba, fuga, monkeypatch):
+    monkeypatch.setattr(queries, 'MAX_LISTA_IN', 10)
+    mruns = fuga['MRUN'].unique()
+    df = queries._leer_historia_fugados(engine_prueba, mruns_fugados=mruns, estrategia='lista_in')
+    assert set(df['MRUN']) == set(queries._leer_historia_fugados(engine_prueba, estrategia='subconsulta')['MRUN'])
+
+def test_subconsulta_por_defecto():
+    assert queries.ESTRATEGIA_HISTORIA_FUGADOS == 'subconsulta'
+
+def test_lista_in_no_se_usa_en_sql_server(engine_prueba, fuga, monkeypatch):
+    """En SQL Server la lista de literales se reemplaza por la tabla temporal."""
+    sentencias = []
+    original = queries.leer_sql
+
+    def leer_sql_registrando(nombre, query, *args, **kwargs):
+        sentencias.append(str(query))
+        return original(nombre, query, *args, **kwargs)
+
+    monkeypatch.setattr(queries, 'leer_sql', leer_sql_registrando)
+    monkeypatch.setattr(engine_prueba.dialect, 'name', 'mssql')
+    with pytest.raises(Exception):
+        # SQLite no entiende la tabla temporal de SQL Server ('#...'): basta con ver que no se intentó el IN
+        queries._leer_historia_fugados(engine_prueba, mruns_fugados=fuga['MRUN'].unique()[:10], estrategia='lista_in')
+    assert not any('IN (' in sentencia for sentencia in sentencias)
@@ -0,0 +1,105 @@
+#El KPI 5 (titulación estimada de los fugados) debe dar lo mismo que el cálculo original, que marcaba la última
+#carrera de cada estudiante concatenando MRUN y CODIGO_UNICO como texto. Los casos delicados son los empates en el
+#último año (dos matrículas el mismo año) y CODIGO_UNICO nulo.
+
+import pandas as pd
+import pytest
+
+import queries
+from matricula_memoria import cargar_matricula_memoria
+from trayectorias import cargar_trayectorias, kpi5_trayectorias
+
+QUERY_HISTORIA = """
+SELECT mrun AS MRUN, cat_periodo AS ANIO, codigo_unico AS CODIGO_UNICO, nomb_carrera,
+       CAST(dur_total_carr AS INT) AS DURACION_SEMESTRES
+FROM vista_matriculas_unificada
+WHERE dur_total_carr IS NOT NULL
+"""
+
+def kpi5_original(df_historia, mruns_fugados):
+    """Copia del cálculo original del KPI 5 a partir de la historia ya leída (sin la consulta con la lista IN)."""
+    df_historia = df_historia[df_historia['MRUN'].isin(mruns_fugados)].copy()
+    if len(mruns_fugados) == 0:
+        return pd.DataFrame({'NOMB_CARRERA': [], 'Titulados_Estimados': []}), 0
+
+    df_ultima_matricula = df_historia.groupby('MRUN')['ANIO'].max().reset_index(name='Ultimo_ANIO')
+    df_final = pd.merge(df_historia, df_ultima_matricula, left_on=['MRUN', 'ANIO'], right_on=['MRUN', 'Ultimo_ANIO'])
+    df_ultima_carrera = df_final.sort_values(by=['MRUN', 'ANIO'], ascending=False).drop_duplicates(subset=['MRUN'])
+
+    df_ultima_carrera['CLAVE_CARRERA_FINAL'] = df_ultima_carrera['MRUN'].astype(str) + '_' + df_ultima_carrera['CODIGO_UNICO'].astype(str)
+    df_historia['CLAVE_CARRERA_FINAL'] = df_historia['MRUN'].astype(str) + '_' + df_historia['CODIGO_UNICO'].astype(str)
+
+    claves_finales = df_ultima_carrera['CLAVE_CARRERA_FINAL'].unique()
+    df_permanencia_final = df_historia[df_historia['CLAVE_CARRERA_FINAL'].isin(claves_finales)].copy()
+
+    df_permanencia_carrera = df_permanencia_final.groupby(['MRUN', 'CODIGO_UNICO', 'nomb_carrera', 'DURACION_SEMESTRES']).agg(
+        Anios_Matriculado=('ANIO', 'nunique')
+    ).reset_index()
+    df_permanencia_carrera['Duracion_Anios_Teorica'] = df_permanencia_carrera['DURACION_SEMESTRES'] / 2
+    df_titulados_estimados = df_permanencia_carrera[
+        df_permanencia_carrera['Anios_Matriculado'] >= df_permanencia_carrera['Duracion_Anios_Teorica']
+    ].copy()
+
+    total_estimado = df_titulados_estimados['MRUN'].nunique()
+    resultados_carrera = df_titulados_estimados.groupby('nomb_carrera')['MRUN'].nunique().reset_index(name='Titulados_Estimados')
+    return resultados_carrera, total_estimado
+
+def normalizar(resultados_carrera):
+    if resultados_carrera.empty:
+        return pd.DataFrame({'nomb_carrera': [], 'Titulados_Estimados': []}).astype({'Titulados_Estimados': 'int64'})
+    return resultados_carrera.sort_values(by='nomb_carrera').reset_index(drop=True).astype({'Titulados_Estimados': 'int64'})
+
+@pytest.fixture(scope='module')
+def historia(engine_prueba):
+    # El orden en que el cálculo original encontraba las filas empatadas: codigo_unico con los nulos primero
+    df = pd.read_sql(QUERY_HISTORIA, engine_prueba)
+    return df.sort_values(by=['MRUN', 'ANIO', 'CODIGO_UNICO'], kind='stable', na_position='first').reset_index(drop=True)
+
+@pytest.fixture(scope='module')
+def fuga(engine_prueba):
+    return queries.get_df_fuga_base.sin_cache(engine_prueba)
+
+@pytest.fixture(scope='module')
+def trayectorias(engine_prueba):
+    return cargar_trayectorias(cargar_matricula_memoria(engine_prueba))
+
+def _casos(fuga):
+    for anio_n in [None] + sorted(fuga['ANIO_INICIAL'].unique())[:-1]:
+        anio_n = int(anio_n) if anio_n is not None else None
+        mruns = fuga['MRUN'].unique() if anio_n is None else fuga[fuga['ANIO_INICIAL'] == anio_n]['MRUN'].unique()
+        yield anio_n, mruns
+
+def test_historia_con_empates_y_nulos(historia, fuga):
+    # La prueba solo tiene sentido si entre los fugados hay empates en el último año y carreras sin codigo_unico
+    h = historia[historia['MRUN'].isin(fuga['MRUN'])]
+    ultimo = h.groupby('MRUN')['ANIO'].transform('max')
+    empates = h[h['ANIO'] == ultimo].groupby('MRUN').size()
+    assert (empates > 1).sum() > 10
+    assert h['CODIGO_UNICO'].isna().sum() > 0
+
+def test_kpi5_sql_igual_al_original(engine_prueba, historia, fuga):
+    for anio_n, mruns in _casos(fuga):
+        esperado, total_esperado = kpi5_original(historia, mruns)
+        assert total_esperado > 0 or anio_n is not None
+        for estrategia in ('subconsulta', 'lista_in', 'tabla_temporal'):
+            df_historia = queries._leer_historia_fugados(engine_prueba, anio_n=anio_n, estrategia=estrategia,
+                                                         mruns_fugados=None if estrategia == 'subconsulta' else mruns)
+            assert set(df_historia['MRUN']) <= set(mruns)
+        resultados, total = queries.kpi5_titulacion_fuga_estimada.sin_cache(engine_prueba, anio_n=anio_n)
+        assert total == total_esperado
+        pd.testing.assert_frame_equal(normalizar(resultados), normalizar(esperado))
+
+        resultados, total = queries.kpi5_titulacion_fuga_estimada.sin_cache(engine_prueba, anio_n=anio_n, mruns_fugados=mruns)
+        assert total == total_esperado
+        pd.testing.assert_frame_equal(normalizar(resultados), normalizar(esperado))
+
+def test_kpi5_trayectorias_igual_al_original(historia, fuga, trayectorias):
+    for _, mruns in _casos(fuga):
+        esperado, total_esperado = kpi5_original(historia, mruns)
+        resultados, total = kpi5_trayectorias(trayectorias, mruns)
+        assert total == total_esperado
+        pd.testing.assert_frame_equal(normalizar(resultados), normalizar(esperado))
+
+def test_kpi5_sin_fugados(engine_prueba):
+    resultados, total = queries.kpi5_titulacion_fuga_estimada.sin_cache(engine_prueba, anio_n=2015, mruns_fugados=[])
+    assert total == 0 and resultados.empty
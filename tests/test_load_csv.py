@@ -0,0 +1,118 @@
+#Carga incremental de los CSV (load_csv.py) sobre una base SQLite: manifest, CSV eliminados y reintentos.
+
+import os
+
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, inspect
+
+import connector_db
+import load_csv
+from conftest import matricula_prueba
+
+ANIOS = (2014, 2015, 2016)
+
+@pytest.fixture
+def carga(tmp_path, monkeypatch):
+    """Carpeta de CSV por año y una base SQLite vacía como fuente de datos (los procesos de carga la heredan)."""
+    carpeta = tmp_path / 'datos'
+    carpeta.mkdir()
+    df = matricula_prueba(n_filas=3000)
+    for anio in ANIOS:
+        df[df['cat_periodo'] == anio].to_csv(carpeta / f'matricula_{anio}.csv', sep=';', index=False)
+
+    monkeypatch.setattr(connector_db, 'FUENTE_DATOS', 'sqlite')
+    monkeypatch.setattr(connector_db, 'ARCHIVO_SQLITE', str(tmp_path / 'carga.db'))
+    monkeypatch.setattr(connector_db, '_engines', {})
+    monkeypatch.setattr(load_csv, 'FOLDER_PATH', str(carpeta))
+    monkeypatch.setattr(load_csv, 'MAX_WORKERS', 2)
+    yield carpeta
+    for engine in connector_db._engines.values():
+        engine.dispose()
+
+def anios_vista():
+    engine = connector_db.get_db_engine()
+    return sorted(pd.read_sql("SELECT DISTINCT cat_periodo FROM vista_matriculas_unificada;", engine)['cat_periodo'])
+
+def test_carga_y_sin_cambios(carga):
+    success, message = load_csv.load_all_csv_to_sql()
+    assert success, message
+    assert anios_vista() == list(ANIOS)
+    assert sorted(load_csv.leer_manifest(connector_db.get_db_engine())) == [f'matricula_{a}' for a in ANIOS]
+
+    success, message = load_csv.load_all_csv_to_sql()
+    assert success and message.startswith("Sin cambios")
+
+def test_csv_eliminado_sale_de_la_vista_y_del_manifest(carga):
+    assert load_csv.load_all_csv_to_sql()[0]
+    os.remove(carga / 'matricula_2016.csv')
+
+    success, message = load_csv.load_all_csv_to_sql()
+    assert success, message
+    engine = connector_db.get_db_engine()
+    assert anios_vista() == [2014, 2015]
+    assert 'matricula_2016' not in load_csv.leer_manifest(engine)
+    assert 'matricula_2016' not in inspect(engine).get_table_names()
+
+def test_falla_de_la_vista_no_guarda_el_manifest(carga, monkeypatch):
+    assert load_csv.load_all_csv_to_sql()[0]
+    engine = connector_db.get_db_engine()
+    manifest_inicial = load_csv.leer_manifest(engine)
+
+    df = pd.read_csv(carga / 'matricula_2015.csv', sep=';')
+    df.head(100).to_csv(carga / 'matricula_2015.csv', sep=';', index=False)
+    original = load_csv.create_unified_view
+    fallas = [True]
+
+    def vista_con_falla(anio_nuevo=None):
+        if fallas:
+            fallas.pop()
+            return False, "ERROR al crear la vista SQL"
+        return original(anio_nuevo=anio_nuevo)
+
+    monkeypatch.setattr(load_csv, 'create_unified_view', vista_con_falla)
+    success, _ = load_csv.load_all_csv_to_sql()
+    assert not success
+    assert load_csv.leer_manifest(engine)['matricula_2015']['sha256'] == manifest_inicial['matricula_2015']['sha256']
+
+    # La siguiente carga detecta el mismo cambio y reconstruye la vista
+    success, message = load_csv.load_all_csv_to_sql()
+    assert success and "1 tablas cargadas" in message, message
+    assert pd.read_sql("SELECT COUNT(*) AS n FROM vista_matriculas_unificada WHERE cat_periodo = 2015;", engine)['n'][0] == 100
+
+def test_tipos_por_dtype_y_nombres_reservados(carga):
+    # Columnas que no están en TIPOS_SQL_MATRICULA, una de ellas con nombre de palabra reservada
+    df = pd.read_csv(carga / 'matricula_2014.csv', sep=';')
+    df['Order'] = range(len(df))
+    df['puntaje'] = 0.5
+    df.to_csv(carga / 'matricula_2014.csv', sep=';', index=False)
+
+    success, message = load_csv.load_all_csv_to_sql()
+    assert success, message
+    engine = connector_db.get_db_engine()
+    tipos = {c['name']: str(c['type']) for c in inspect(engine).get_columns('matricula_2014')}
+    assert tipos['order'] == 'BIGINT'
+    assert tipos['puntaje'] == 'FLOAT'
+    assert tipos['codigo_unico'] == 'VARCHAR(50)'
+    assert pd.read_sql('SELECT SUM("order") AS total FROM matricula_2014;', engine)['total'][0] == sum(range(len(df)))
+
+def test_bulk_no_se_ofrece_en_sqlite(carga):
+    success, message = load_csv.load_all_csv_to_sql(backend='bulk')
+    assert not success and "'bulk'" in message
+    assert 'matricula_2014' not in inspect(connector_db.get_db_engine()).get_table_names()
+
+def test_bulk_con_comilla_en_la_ruta_de_staging(carga, tmp_path, monkeypatch):
+    pytest.importorskip('duckdb_engine')
+    monkeypatch.setattr(load_csv, 'CARPETA_STAGING', str(tmp_path / "staging d'O:x"))
+    engine = create_engine(f"duckdb:///{tmp_path / 'carga.duckdb'}")
+    archivo = carga / 'matricula_2014.csv'
+    with engine.begin() as connection:
+        tabla = load_csv.crear_tabla_staging(connection, 'stg_matricula_2014', load_csv.get_dtypes_muestra(archivo))
+        filas = load_csv.cargar_con_bulk(connection, tabla, load_csv.leer_csv_por_bloques(archivo), 'stg_matricula_2014')
+        assert connection.exec_driver_sql(f"SELECT COUNT(*) FROM {tabla};").scalar() == filas == len(
+            pd.read_csv(archivo, sep=';'))
+    engine.dispose()
+    assert os.listdir(load_csv.CARPETA_STAGING) == []
+
+    with pytest.raises(ValueError):
+        load_csv.literal_ruta_staging(os.path.join(load_csv.CARPETA_STAGING, '..', 'fuera.csv'))
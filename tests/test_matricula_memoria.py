@@ -0,0 +1,32 @@
+#Motor de fuga en memoria (matricula_memoria.py): mismo resultado que 'transiciones_ecas' en SQL.
+
+import pandas as pd
+
+import queries
+from matricula_memoria import COD_INST_NULO, cargar_matricula_memoria, calcular_fuga_memoria, filas_anio
+
+def _ordenar(df):
+    return df.astype({'MRUN': 'int64', 'COD_INST_DESTINO': 'int64', 'ANIO_INICIAL': 'int64'}).sort_values(
+        by=['ANIO_INICIAL', 'MRUN']).reset_index(drop=True)
+
+def test_claves_nulas(engine_nulos):
+    nulos = pd.read_sql("SELECT SUM(cat_periodo IS NULL) AS anio, SUM(mrun IS NULL) AS mrun, SUM(cod_inst IS NULL) AS inst "
+                        "FROM vista_matriculas_unificada;", engine_nulos).iloc[0]
+    assert (nulos > 0).all()
+
+    almacen = cargar_matricula_memoria(engine_nulos)
+    assert (almacen['df']['cod_inst'] == COD_INST_NULO).sum() > 0
+    anios = sorted(almacen['rangos'])
+    for anio in anios[:-1]:
+        pd.testing.assert_frame_equal(_ordenar(calcular_fuga_memoria(almacen, anio)),
+                                      _ordenar(queries.get_df_fuga_base.sin_cache(engine_nulos, anio_n=anio)),
+                                      check_dtype=False)
+    pd.testing.assert_frame_equal(_ordenar(calcular_fuga_memoria(almacen)),
+                                  _ordenar(queries.get_df_fuga_base.sin_cache(engine_nulos)), check_dtype=False)
+
+def test_filas_de_un_anio_contiguas(engine_prueba):
+    almacen = cargar_matricula_memoria(engine_prueba)
+    for anio in almacen['rangos']:
+        df = filas_anio(almacen, anio)
+        assert (df['ANIO'] == anio).all()
+        assert df['MRUN_ID'].is_monotonic_increasing
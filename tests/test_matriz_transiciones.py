@@ -0,0 +1,92 @@
+#Matriz de transiciones (matriz_transiciones.py): para ECAS debe dar la misma fuga y permanencia que las
+#tablas materializadas, y sin la tabla guardada no se recalcula dentro de una petición.
+
+import shutil
+
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, text
+
+import queries
+from queries import COD_INST_ECAS
+from matriz_transiciones import (TABLA_MATRIZ_TRANSICIONES, cargar_matriz, fuga_matriz, guardar_matriz_transiciones,
+                                 permanencia_matriz)
+
+@pytest.fixture(scope='module')
+def matriz(engine_prueba):
+    return cargar_matriz(engine_prueba)
+
+@pytest.fixture
+def engine_sin_matriz(engine_prueba, tmp_path):
+    """Copia de la base de prueba sin la tabla de la matriz."""
+    ruta = tmp_path / 'sin_matriz.db'
+    shutil.copy(engine_prueba.url.database, ruta)
+    engine = create_engine(f"sqlite:///{ruta}")
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP TABLE {TABLA_MATRIZ_TRANSICIONES};"))
+    yield engine
+    engine.dispose()
+
+def test_fuga_de_ecas_igual_a_la_fuga_base(engine_prueba, matriz):
+    anios = sorted(int(a) for a in queries.kpi1_permanencia_ecas(engine_prueba)[0]['Año'])
+    for anio in anios:
+        df_fuga = queries.get_df_fuga_base(engine_prueba, anio_n=anio)
+        esperado = df_fuga.groupby('INST_DESTINO')['MRUN'].nunique().sort_index()
+        obtenido = fuga_matriz(matriz, COD_INST_ECAS, anio_n=anio).groupby('INST_DESTINO')['N_MRUN'].sum().sort_index()
+        pd.testing.assert_series_equal(obtenido, esperado, check_names=False, check_dtype=False)
+
+def test_permanencia_de_ecas_igual_a_la_serie_guardada(engine_prueba, matriz):
+    esperado = queries.kpi1_permanencia_ecas(engine_prueba)[0].reset_index(drop=True)
+    obtenido = permanencia_matriz(matriz, COD_INST_ECAS)
+    pd.testing.assert_frame_equal(obtenido[esperado.columns], esperado, check_dtype=False)
+
+def test_total_de_otra_institucion_es_la_suma_de_cohortes(matriz):
+    cod_inst = next(c for c in matriz['por_institucion'] if c != COD_INST_ECAS)
+    total = fuga_matriz(matriz, cod_inst)['N_MRUN'].sum()
+    anios = matriz['por_institucion'][cod_inst]['ANIO_INICIAL'].unique()
+    assert total == sum(fuga_matriz(matriz, cod_inst, anio_n=int(a))['N_MRUN'].sum() for a in anios)
+
+def test_sin_tabla_no_se_recalcula_en_la_peticion(engine_sin_matriz, monkeypatch, capsys):
+    with pytest.raises(RuntimeError):
+        cargar_matriz(engine_sin_matriz)
+
+    import analysis
+    monkeypatch.setattr(analysis, '_estado', {**analysis._estado, 'engine': None, 'snapshot': None,
+                                              'instituciones': {COD_INST_ECAS: 'ECAS'}})
+    monkeypatch.setattr(analysis, 'precalcular_cohortes', lambda: None)
+    monkeypatch.setattr(analysis, 'get_db_engine', lambda: engine_sin_matriz)
+    estado = analysis.get_estado()
+    assert estado['engine'] is engine_sin_matriz
+    assert estado['instituciones'] == {COD_INST_ECAS: 'ECAS'}
+    assert "matriz de transiciones" in capsys.readouterr().out
+
+def test_agregar_un_anio_sin_tabla_recalcula_la_matriz(engine_sin_matriz, matriz):
+    anio = max(int(a) for a in matriz['por_institucion'][COD_INST_ECAS]['ANIO_INICIAL']) + 1
+    guardar_matriz_transiciones(engine_sin_matriz, anio_nuevo=anio)
+    recalculada = cargar_matriz(engine_sin_matriz)
+    assert sorted(recalculada['por_institucion']) == sorted(matriz['por_institucion'])
+
+@pytest.fixture
+def analysis_limpio(monkeypatch):
+    import analysis
+    monkeypatch.setattr(analysis, '_estado', {**analysis._estado, 'engine': None, 'snapshot': None,
+                                              'instituciones': {COD_INST_ECAS: 'ECAS'}})
+    monkeypatch.setattr(analysis, 'precalcular_cohortes', lambda: None)
+    return analysis
+
+def test_selector_con_cod_inst_nulo(engine_nulos, analysis_limpio, monkeypatch, capsys):
+    assert not cargar_matriz(engine_nulos)['instituciones']['COD_INST_ORIGEN'].isna().any()
+    monkeypatch.setattr(analysis_limpio, 'get_db_engine', lambda: engine_nulos)
+    instituciones = analysis_limpio.get_estado()['instituciones']
+    assert len(instituciones) > 1
+    assert all(isinstance(cod, int) for cod in instituciones)
+    assert "Advertencia" not in capsys.readouterr().out
+
+def test_total_de_otra_institucion_rotulado_como_suma(engine_prueba, analysis_limpio, monkeypatch):
+    monkeypatch.setattr(analysis_limpio, 'get_db_engine', lambda: engine_prueba)
+    otra = next(c for c in analysis_limpio.get_estado()['instituciones'] if c != COD_INST_ECAS)
+    assert analysis_limpio.resultados_destino('ALL', otra)[-1].endswith("(suma de cohortes)")
+    assert "suma de cohortes" in analysis_limpio.update_kpi2('ALL', otra).figure.layout.title.text
+    assert "suma de cohortes" not in analysis_limpio.resultados_destino('ALL', COD_INST_ECAS)[-1]
+    anio = analysis_limpio.get_estado()['years_available'][0]
+    assert "suma de cohortes" not in analysis_limpio.resultados_destino(anio, otra)[-1]
@@ -0,0 +1,68 @@
+#Snapshot de los KPIs (snapshot_kpis.py): cada generación queda en su propia versión y el dashboard en
+#modo snapshot toma la versión nueva sin reiniciarse.
+
+import os
+
+import pandas as pd
+import pytest
+
+import snapshot_kpis
+
+@pytest.fixture
+def analysis_snapshot(monkeypatch, tmp_path):
+    import analysis
+    # El snapshot se escribe en 'snapshot/' relativo al directorio de trabajo, aislado en cada prueba
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(analysis, 'MODO_SNAPSHOT', True)
+    monkeypatch.setattr(analysis, '_estado', {**analysis._estado, 'engine': None, 'snapshot': None,
+                                              'df_permanencia_full': pd.DataFrame(), 'years_available': []})
+    monkeypatch.setattr(snapshot_kpis, '_cohortes_leidas', {})
+    return analysis
+
+def versiones(carpeta):
+    return sorted(n for n in os.listdir(carpeta) if n.startswith(snapshot_kpis.PREFIJO_VERSION))
+
+def test_regenerar_snapshot_publica_una_version_nueva(analysis_snapshot, engine_prueba):
+    carpeta = snapshot_kpis.CARPETA_SNAPSHOT
+    assert analysis_snapshot.get_estado()['snapshot'] is None   # Aún no hay snapshot
+
+    success, message = snapshot_kpis.generar_snapshot(engine_prueba)
+    assert success, message
+    primera = snapshot_kpis.version_snapshot()
+    estado = analysis_snapshot.get_estado()
+    assert estado['snapshot']['version_snapshot'] == primera
+    cohorte = snapshot_kpis.leer_cohorte('ALL')
+
+    success, message = snapshot_kpis.generar_snapshot(engine_prueba)
+    assert success, message
+    segunda = snapshot_kpis.version_snapshot()
+    assert segunda != primera
+    # La versión anterior se conserva para los lectores en curso
+    assert versiones(carpeta) == sorted([primera, segunda])
+
+    # El dashboard en marcha relee el manifest y las cohortes de la versión nueva
+    assert analysis_snapshot.get_estado()['snapshot']['version_snapshot'] == segunda
+    cohorte_nueva = snapshot_kpis.leer_cohorte('ALL')
+    assert cohorte_nueva is not cohorte
+    assert cohorte_nueva['total_fugados'] == cohorte['total_fugados']
+    assert all(clave[1] == segunda for clave in snapshot_kpis._cohortes_leidas)
+
+    success, message = snapshot_kpis.generar_snapshot(engine_prueba)
+    assert success, message
+    assert versiones(carpeta) == sorted([segunda, snapshot_kpis.version_snapshot()])
+
+def test_snapshot_fallido_no_cambia_la_version_vigente(analysis_snapshot, engine_prueba, monkeypatch):
+    success, message = snapshot_kpis.generar_snapshot(engine_prueba)
+    assert success, message
+    vigente = snapshot_kpis.version_snapshot()
+
+    import queries
+
+    def kpi6_con_falla(*args, **kwargs):
+        raise RuntimeError("tiempo de espera agotado")
+
+    monkeypatch.setattr(queries, 'kpi6_supervivencia', kpi6_con_falla)
+    success, _ = snapshot_kpis.generar_snapshot(engine_prueba)
+    assert not success
+    assert snapshot_kpis.version_snapshot() == vigente
+    assert versiones(snapshot_kpis.CARPETA_SNAPSHOT) == [vigente]
@@ -0,0 +1,39 @@
+#Motor de trayectorias (trayectorias.py): se arma sobre la matrícula en memoria y sus fugados de ECAS son los
+#mismos de la fuga base en SQL, también con años, MRUN y cod_inst nulos.
+
+import numpy as np
+import pytest
+
+import queries
+from queries import COD_INST_ECAS
+from matricula_memoria import get_matricula_memoria
+from trayectorias import BITS_ANIOS, cargar_trayectorias, fugados, get_trayectorias, trayectoria_fugados
+
+@pytest.mark.parametrize('nombre_engine', ['engine_prueba', 'engine_nulos'])
+def test_fugados_de_ecas_igual_a_la_fuga_base(nombre_engine, request):
+    engine = request.getfixturevalue(nombre_engine)
+    tray = get_trayectorias(engine)
+    # Las trayectorias comparten el arreglo de MRUN del almacén en memoria (no es otra carga de la vista)
+    assert tray['mruns'] is get_matricula_memoria(engine)['mruns']
+
+    for anio in range(tray['anio_base'], tray['anio_max']):
+        ids, anios = fugados(tray, COD_INST_ECAS, anio)
+        df_fuga = queries.get_df_fuga_base.sin_cache(engine, anio_n=anio)
+        np.testing.assert_array_equal(tray['mruns'][ids], np.sort(df_fuga['MRUN'].unique().astype('int64')))
+        assert (anios == anio).all()
+
+    # Con todas las cohortes cada estudiante cuenta una vez, en su primera fuga
+    ids, anios = fugados(tray, COD_INST_ECAS)
+    primera_fuga = queries.get_df_fuga_base.sin_cache(engine).groupby('MRUN')['ANIO_INICIAL'].min()
+    np.testing.assert_array_equal(tray['mruns'][ids], primera_fuga.index.to_numpy().astype('int64'))
+    np.testing.assert_array_equal(anios, primera_fuga.to_numpy())
+
+    df_kpi7 = trayectoria_fugados(tray, COD_INST_ECAS)
+    assert df_kpi7['Fugados'].iloc[0] == len(ids)
+
+def test_rango_de_anios_mayor_que_los_bits(engine_prueba):
+    almacen = get_matricula_memoria(engine_prueba)
+    anios = almacen['df']['ANIO'].to_numpy().copy()
+    anios[0] = anios.max() - BITS_ANIOS
+    with pytest.raises(ValueError):
+        cargar_trayectorias({**almacen, 'df': almacen['df'].assign(ANIO=anios)})